@@ -0,0 +1,285 @@
+# pylint: disable=missing-docstring
+"""
+Streaming aggregation of decoded values into fixed time windows.
+
+For every meter, window size (1 s, 1 min and 15 min by default) and OBIS
+code the Aggregator keeps count, sum, min, max and last of the values in
+the current window, and nothing else: no samples are stored, so the state
+does not grow with the rate of the lists.  When a list arrives in a later
+window the finished window is handed to on_window() as one Aggregate per
+code.  Windows are aligned to the epoch (15 min windows start at :00, :15,
+:30 and :45) and windows without lists are not reported.
+
+The cumulative energy registers (A+, A-, R+ and R-, the codes in Wh and varh
+of all registry profiles) also get the energy delta: the difference to the previous reading of the
+register, whenever it came, with since set to the time of that reading.
+Aidon meters send the registers once an hour, so most windows have no
+delta, and a delta always covers the frames missed in between.  The
+registers are 32 bit counters: a reading below the previous one is taken
+as a wrap if the counter moved forward by less than half its range that
+way, otherwise as a meter reset, and the register starts over without a
+delta.
+
+Lists are stamped with their receive time.  A list more than max_gap
+seconds after the previous one of the meter counts as a gap in the windows
+it lands in, so windows with missing frames can be told apart.  Lists for a
+window that was already reported (out of order) are left out of that window
+and counted once in late, whatever the number of window sizes.
+
+    aggregator = Aggregator(print)
+    aggregator.add(readings, receive_time, meter="/dev/ttyUSB0")
+    ...
+    aggregator.flush()
+
+    python aggregate.py CAPTURE [--windows=1,60,900] [--max-gap=30] [--out=FILE.csv]
+"""
+import sys
+from typing import NamedTuple, Optional, Tuple
+
+from capture import CaptureReader, is_capture_file
+from cosem import CosemDecoder, DecodeError
+from han_utils import LogLevel, logit
+from normalize import scaled_value
+from obis_registry import REGISTRY
+from store import meter_name
+
+WINDOWS = (1, 60, 900)
+MAX_GAP = 30.0
+COUNTER_MODULUS = 1 << 32
+CSV_HEADER = "meter,window,start,obis,unit,count,mean,min,max,last,delta,since,gaps\n"
+
+
+class Aggregate(NamedTuple):
+    meter: object
+    window: int
+    start: float
+    obis: Tuple[int, ...]
+    unit: str
+    count: int
+    mean: float
+    min: float
+    max: float
+    last: float
+    delta: Optional[float] = None
+    since: Optional[float] = None
+    gaps: int = 0
+
+
+def is_counter(obis):
+    """True for the cumulative energy registers: active and reactive, import and export."""
+    return obis in REGISTRY.counter_codes
+
+
+class _CodeStats:
+    __slots__ = ("count", "sum", "min", "max", "last", "unit", "delta", "since", "gaps")
+
+    def __init__(self, value, unit):
+        self.count = 1
+        self.sum = self.min = self.max = self.last = value
+        self.unit = unit
+        self.delta = None
+        self.since = None
+        self.gaps = 0
+
+    def add(self, value, unit):
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.last = value
+        self.unit = unit
+
+
+class _Window:
+    __slots__ = ("start", "codes")
+
+    def __init__(self, start):
+        self.start = start
+        self.codes = {}
+
+
+class _Counter:
+    """The previous reading of an energy register."""
+
+    __slots__ = ("raw", "scaler", "time")
+
+    def __init__(self, raw, scaler, time):
+        self.raw = raw
+        self.scaler = scaler
+        self.time = time
+
+
+class _Meter:
+    __slots__ = ("windows", "counters", "last_time")
+
+    def __init__(self, noof_windows):
+        self.windows = [None] * noof_windows
+        self.counters = {}
+        self.last_time = None
+
+
+class Aggregator:
+    def __init__(self, on_window, windows=WINDOWS, max_gap=MAX_GAP):
+        self.on_window = on_window
+        self.windows = tuple(windows)
+        self.max_gap = max_gap
+        self.meters = {}
+        self.lists = 0
+        self.late = 0
+        self.resets = 0
+        self.wraps = 0
+
+    def add(self, readings, timestamp, meter=None):
+        """Add the values of one decoded list, received at timestamp (epoch seconds)."""
+        state = self.meters.get(meter)
+        if state is None:
+            state = self.meters[meter] = _Meter(len(self.windows))
+        self.lists += 1
+
+        current = []
+        late = False
+        for index, size in enumerate(self.windows):
+            start = timestamp - timestamp % size
+            window = state.windows[index]
+            if window is not None and start < window.start:
+                late = True
+                continue
+            if window is None or start > window.start:
+                if window is not None:
+                    self._emit(meter, size, window)
+                window = state.windows[index] = _Window(start)
+            current.append(window)
+        if late:
+            self.late += 1
+        if not current:
+            return
+
+        gap = state.last_time is not None and timestamp - state.last_time > self.max_gap
+        if state.last_time is None or timestamp > state.last_time:
+            state.last_time = timestamp
+
+        for reading in readings:
+            value = reading.value
+            if (reading.obis is None or not isinstance(value, (int, float)) or isinstance(value, bool)
+                    or reading.obis in REGISTRY.clock_codes):
+                continue
+            delta = since = None
+            if is_counter(reading.obis) and isinstance(value, int):
+                delta, since = self._counter_delta(state, reading, timestamp)
+            scaled = scaled_value(value, reading.scaler)
+            unit = reading.unit_symbol
+            for window in current:
+                stats = window.codes.get(reading.obis)
+                if stats is None:
+                    stats = window.codes[reading.obis] = _CodeStats(scaled, unit)
+                else:
+                    stats.add(scaled, unit)
+                if gap:
+                    stats.gaps += 1
+                if delta is not None:
+                    stats.delta = delta if stats.delta is None else stats.delta + delta
+                    if stats.since is None:
+                        stats.since = since
+
+    def _counter_delta(self, state, reading, timestamp):
+        """Return (energy since the previous reading of the register, time of that reading), or (None, None)."""
+        previous = state.counters.get(reading.obis)
+        state.counters[reading.obis] = _Counter(reading.value, reading.scaler, timestamp)
+        if previous is None:
+            return None, None
+        raw = reading.value
+        if raw < previous.raw:
+            if raw + COUNTER_MODULUS - previous.raw < COUNTER_MODULUS // 2:
+                self.wraps += 1
+                raw += COUNTER_MODULUS
+            else:
+                self.resets += 1
+                logit("Register %s went back from %d to %d, taken as a meter reset", reading.obis_code,
+                      previous.raw, reading.value, lvl=LogLevel.WARNING)
+                return None, None
+        delta = scaled_value(raw, reading.scaler) - scaled_value(previous.raw, previous.scaler)
+        return delta, previous.time
+
+    def _emit(self, meter, size, window):
+        for obis, stats in window.codes.items():
+            self.on_window(Aggregate(meter, size, window.start, obis, stats.unit, stats.count,
+                                     stats.sum / stats.count, stats.min, stats.max, stats.last,
+                                     stats.delta, stats.since, stats.gaps))
+
+    def flush(self):
+        """Report all open windows, at the end of the data."""
+        for meter, state in self.meters.items():
+            for index, size in enumerate(self.windows):
+                window = state.windows[index]
+                if window is not None:
+                    self._emit(meter, size, window)
+                    state.windows[index] = None
+
+    def stats(self):
+        return {"meters": len(self.meters), "lists": self.lists, "late": self.late, "wraps": self.wraps,
+                "resets": self.resets}
+
+
+def csv_line(aggregate):
+    fields = [
+        str(aggregate.meter), str(aggregate.window), f"{aggregate.start:.0f}", ".".join(map(str, aggregate.obis)),
+        aggregate.unit, str(aggregate.count), repr(aggregate.mean), repr(aggregate.min), repr(aggregate.max),
+        repr(aggregate.last), "" if aggregate.delta is None else repr(aggregate.delta),
+        "" if aggregate.since is None else f"{aggregate.since:.3f}", str(aggregate.gaps),
+    ]
+    return ",".join(fields) + "\n"
+
+
+def aggregate_capture(file_name, on_window, windows=WINDOWS, max_gap=MAX_GAP):
+    """Aggregate all frames of a capture file (capture.py), with their receive times.
+
+    Like store.load_capture(), the lists of a port go to the meter id they carry,
+    or to port-N until one has come.
+    """
+    aggregator = Aggregator(on_window, windows, max_gap)
+    decoder = CosemDecoder()
+    last_meter = {}
+    for record in CaptureReader(file_name):
+        try:
+            readings = decoder.decode(record.frame)
+        except DecodeError as decode_error:
+            logit("Could not decode frame: %s", decode_error, lvl=LogLevel.ERROR)
+            continue
+        for reading in readings:
+            if reading.obis in REGISTRY.meter_id_codes:
+                last_meter[record.port_id] = meter_name(reading.value)
+        aggregator.add(readings, record.timestamp, last_meter.get(record.port_id, f"port-{record.port_id}"))
+    aggregator.flush()
+    return aggregator.stats()
+
+
+if __name__ == "__main__":
+    options = {"windows": ",".join(map(str, WINDOWS)), "max-gap": str(MAX_GAP), "out": None, "file": None}
+    for argument in sys.argv[1:]:
+        if argument.startswith("--") and "=" in argument:
+            key, value = argument[2:].split("=", 1)
+            if key not in options:
+                print(f"Unknown argument: {argument}")
+                sys.exit(0)
+            options[key] = value
+        else:
+            options["file"] = argument
+    if options["file"] is None:
+        print("Usage: python aggregate.py CAPTURE [--windows=1,60,900] [--max-gap=30] [--out=FILE.csv]")
+        sys.exit(0)
+    if not is_capture_file(options["file"]):
+        print(f"{options['file']} is not a capture file, record one with han_test_nve.py --capture=FILE")
+        sys.exit(0)
+
+    out = sys.stdout if options["out"] is None else open(options["out"], "w", encoding="utf-8")
+    try:
+        out.write(CSV_HEADER)
+        capture_stats = aggregate_capture(options["file"], lambda aggregate: out.write(csv_line(aggregate)),
+                                          [int(size) for size in options["windows"].split(",")],
+                                          float(options["max-gap"]))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"Aggregated: {capture_stats}", file=sys.stderr)
@@ -1,100 +1,196 @@
+"""
+DLMS date-time (COSEM blue book 4.1.6.1), as sent in the clock of List 2/3.
+
+    09 0c                   octet-string of 12 bytes
+    07 e7                   year
+    05 08 01                month, day of month, day of week
+    0c 00 00 ff             hour, minute, second, hundredths (0xff = not specified)
+    80 00                   deviation in minutes of local time to UTC (0x8000 = not specified)
+    ff                      clock status (0xff = not specified)
+
+The fields are unpacked with one struct.unpack_from(), the timezone of each
+deviation is created once and cached.  The construct based DateTime parser
+this replaced is still available as aidon_date_time.DateTime, construct is
+only imported when it is used.
+"""
 import datetime
+import struct
+from typing import NamedTuple, Optional
 
-import construct
-
-from han_utils import hexify
-
-OptionalDateTimeByte = construct.ExprAdapter(
-    construct.Int8ub,
-    decoder=lambda obj, ctx: obj if obj != 0xFF else None,
-    encoder=lambda obj, ctx: obj if obj is not None else 0xFF,
-)
-
-# See COSEM blue Book section 4.1.6.1 Date and time formats
-DateTime = construct.Struct(
-    construct.Const(0x09, construct.Int8ub),  # 9 means octet string
-    construct.Const(0x0C, construct.Int8ub),  # expect length 12
-    "year" / construct.Int16ub,
-    "month" / construct.Int8ub,
-    "day_of_month" / construct.Int8ub,
-    "day_of_week" / construct.Int8ub,
-    "hour" / OptionalDateTimeByte,
-    "minute" / OptionalDateTimeByte,
-    "second" / OptionalDateTimeByte,
-    "hundredths_of_second" / OptionalDateTimeByte,
-    "deviation"
-    / construct.ExprAdapter(
-        construct.Int16sb,
-        decoder=lambda obj, ctx: obj if obj != -0x8000 else None,
-        encoder=lambda obj, ctx: obj if obj is not None else -0x8000,
-    )
-    * ("Range -720...+720 in minutes of local time to UTC. 0x8000 = not specified"),
-    "clock_status_byte" / construct.Peek(OptionalDateTimeByte),
-    "clock_status" / construct.If(construct.this.clock_status_byte != 0xFF,
-                                  construct.BitStruct(
-                                      "invalid_value" / construct.BitsInteger(1) * ("Time could not be recovered after an incident. Detailed conditions are "
-                                                                                    "manufacturer specific (for example after the power to the clock has been "
-                                                                                    "interrupted). For a valid status, bit 0 shall not be set if bit 1 is set."
-                                                                                    ),
-                                      "doubtful_value" / construct.BitsInteger(1) * ("Time could be recovered after an incident but the value cannot be guaranteed. "
-                                                                                     "Detailed conditions are manufacturer specific. For a valid status, bit 1 shall "
-                                                                                     "not be set if bit 0 is set."
-                                                                                     ),
-                                      "different_clock_base" / construct.BitsInteger(1) * ("Bit is set if the basic timing information for the clock at the actual moment "
-                                                                                           "is taken from a timing source different from the source specified in clock_base."
-                                                                                           ),
-                                      "invalid_clock_status" / construct.BitsInteger(1) * ("This bit indicates that at least one bit of the clock status is invalid. "
-                                                                                           "Some bits may be correct. The exact meaning shall be explained in the "
-                                                                                           "manufacturer's documentation."
-                                                                                           ),
-                                      construct.BitsInteger(3), "daylight_saving_active" / construct.BitsInteger(1) * \
-                                      ("Flag set to true: the transmitted time contains the daylight saving deviation (summer time)."),
-                                  ),
-                                  ),
-    construct.If(construct.this.clock_status_byte == 0xFF, construct.Int8ub),
-    "datetime"
-    / construct.Computed(
-        lambda ctx: datetime.datetime(
-            ctx.year,
-            ctx.month,
-            ctx.day_of_month,
-            ctx.hour,
-            ctx.minute,
-            ctx.second,
-            ctx.hundredths_of_second * 10000
-            if ctx.hundredths_of_second is not None
-            else 0,
-            datetime.timezone(datetime.timedelta(minutes=ctx.deviation * -1))
-            if ctx.deviation is not None
-            else None,
-        )
-    ),
-)
+DATE_TIME_FIELDS = struct.Struct(">HBBBBBBBhB")
+NOT_SPECIFIED = 0xFF
+DEVIATION_NOT_SPECIFIED = -0x8000
 
+# deviation in minutes -> timezone
+_timezones = {}
 
-def obis_bytes_to_datetime(byte_data):
+
+class ClockStatus(NamedTuple):
+    invalid_value: int
+    doubtful_value: int
+    different_clock_base: int
+    invalid_clock_status: int
+    daylight_saving_active: int
+
+
+class DlmsDateTime(NamedTuple):
+    year: int
+    month: int
+    day_of_month: int
+    day_of_week: int
+    hour: Optional[int]
+    minute: Optional[int]
+    second: Optional[int]
+    hundredths_of_second: Optional[int]
+    deviation: Optional[int]
+    clock_status: Optional[ClockStatus]
+    datetime: datetime.datetime
+
+
+def timezone_of(deviation):
+    """Return the timezone of a deviation, which is minutes of local time to UTC (so UTC+1 is -60)."""
+    timezone = _timezones.get(deviation)
+    if timezone is None:
+        timezone = _timezones[deviation] = datetime.timezone(datetime.timedelta(minutes=-deviation))
+    return timezone
+
+
+def clock_status_of(status_byte) -> Optional[ClockStatus]:
+    """
+    Return the bits of the clock status, None if it is not specified (0xff).
+
+    The construct parser reported 0xff as all bits set, its Peek had already
+    turned the byte into None when it was compared with 0xff.
     """
-    Convert 12 byte obis to datetime.
+    if status_byte == NOT_SPECIFIED:
+        return None
+    return ClockStatus(status_byte >> 7, (status_byte >> 6) & 1, (status_byte >> 5) & 1, (status_byte >> 4) & 1,
+                       status_byte & 1)
 
 
+def unpack_date_time(buffer, offset=0):
+    """
+    Return the datetime of the 12 date-time bytes at buffer[offset:].
 
-    Parameters
-    ----------
-    bytes : _type_
-        _description_
+    An unspecified hundredths is taken as 0 and an unspecified deviation
+    gives a naive datetime.  An unspecified hour, minute or second raises
+    ValueError, as do dates out of range.
     """
-    # Just use the first 14 bytes of data for this
-    the_bytes = bytes(byte_data[:14])
-    print(f"Date bytes: {hexify(byte_data[:14])}")
-    print(f"the bytez: {the_bytes}")
-    dt = DateTime.parse(the_bytes)
-    return dt.datetime
+    year, month, day, _, hour, minute, second, hundredths, deviation, _ = DATE_TIME_FIELDS.unpack_from(buffer, offset)
+    if NOT_SPECIFIED in (hour, minute, second):
+        raise ValueError("Time of day not specified")
+    microsecond = 0 if hundredths == NOT_SPECIFIED else hundredths * 10000
+    timezone = None if deviation == DEVIATION_NOT_SPECIFIED else timezone_of(deviation)
+    return datetime.datetime(year, month, day, hour, minute, second, microsecond, timezone)
+
+
+def check_header(byte_data):
+    if len(byte_data) < 14 or byte_data[0] != 0x09 or byte_data[1] != 0x0C:
+        raise ValueError(f"Not a 12 byte date-time octet-string: {bytes(byte_data[:2]).hex()}")
+
+
+def obis_bytes_to_datetime(byte_data):
+    """Convert the date-time octet-string (09 0c + 12 bytes) at the start of byte_data to a datetime."""
+    check_header(byte_data)
+    return unpack_date_time(byte_data, 2)
+
+
+def parse_date_time(byte_data) -> DlmsDateTime:
+    """Return all fields of the date-time octet-string, None for the fields that are not specified."""
+    check_header(byte_data)
+    year, month, day, day_of_week, hour, minute, second, hundredths, deviation, status = \
+        DATE_TIME_FIELDS.unpack_from(byte_data, 2)
+
+    def optional(field):
+        return None if field == NOT_SPECIFIED else field
+
+    return DlmsDateTime(year, month, day, day_of_week, optional(hour), optional(minute), optional(second),
+                        optional(hundredths), None if deviation == DEVIATION_NOT_SPECIFIED else deviation,
+                        clock_status_of(status), unpack_date_time(byte_data, 2))
+
+
+def _construct_date_time():
+    import construct  # pylint: disable=import-outside-toplevel
+
+    OptionalDateTimeByte = construct.ExprAdapter(
+        construct.Int8ub,
+        decoder=lambda obj, ctx: obj if obj != 0xFF else None,
+        encoder=lambda obj, ctx: obj if obj is not None else 0xFF,
+    )
+
+    # See COSEM blue Book section 4.1.6.1 Date and time formats
+    return construct.Struct(
+        construct.Const(0x09, construct.Int8ub),  # 9 means octet string
+        construct.Const(0x0C, construct.Int8ub),  # expect length 12
+        "year" / construct.Int16ub,
+        "month" / construct.Int8ub,
+        "day_of_month" / construct.Int8ub,
+        "day_of_week" / construct.Int8ub,
+        "hour" / OptionalDateTimeByte,
+        "minute" / OptionalDateTimeByte,
+        "second" / OptionalDateTimeByte,
+        "hundredths_of_second" / OptionalDateTimeByte,
+        "deviation"
+        / construct.ExprAdapter(
+            construct.Int16sb,
+            decoder=lambda obj, ctx: obj if obj != -0x8000 else None,
+            encoder=lambda obj, ctx: obj if obj is not None else -0x8000,
+        )
+        * ("Range -720...+720 in minutes of local time to UTC. 0x8000 = not specified"),
+        "clock_status_byte" / construct.Peek(OptionalDateTimeByte),
+        "clock_status" / construct.If(construct.this.clock_status_byte != 0xFF,
+                                      construct.BitStruct(
+                                          "invalid_value" / construct.BitsInteger(1) * ("Time could not be recovered after an incident. Detailed conditions are "
+                                                                                        "manufacturer specific (for example after the power to the clock has been "
+                                                                                        "interrupted). For a valid status, bit 0 shall not be set if bit 1 is set."
+                                                                                        ),
+                                          "doubtful_value" / construct.BitsInteger(1) * ("Time could be recovered after an incident but the value cannot be guaranteed. "
+                                                                                         "Detailed conditions are manufacturer specific. For a valid status, bit 1 shall "
+                                                                                         "not be set if bit 0 is set."
+                                                                                         ),
+                                          "different_clock_base" / construct.BitsInteger(1) * ("Bit is set if the basic timing information for the clock at the actual moment "
+                                                                                               "is taken from a timing source different from the source specified in clock_base."
+                                                                                               ),
+                                          "invalid_clock_status" / construct.BitsInteger(1) * ("This bit indicates that at least one bit of the clock status is invalid. "
+                                                                                               "Some bits may be correct. The exact meaning shall be explained in the "
+                                                                                               "manufacturer's documentation."
+                                                                                               ),
+                                          construct.BitsInteger(3), "daylight_saving_active" / construct.BitsInteger(1) * \
+                                          ("Flag set to true: the transmitted time contains the daylight saving deviation (summer time)."),
+                                      ),
+                                      ),
+        construct.If(construct.this.clock_status_byte == 0xFF, construct.Int8ub),
+        "datetime"
+        / construct.Computed(
+            lambda ctx: datetime.datetime(
+                ctx.year,
+                ctx.month,
+                ctx.day_of_month,
+                ctx.hour,
+                ctx.minute,
+                ctx.second,
+                ctx.hundredths_of_second * 10000
+                if ctx.hundredths_of_second is not None
+                else 0,
+                datetime.timezone(datetime.timedelta(minutes=ctx.deviation * -1))
+                if ctx.deviation is not None
+                else None,
+            )
+        ),
+    )
+
+
+def __getattr__(name):
+    if name == "DateTime":
+        globals()["DateTime"] = date_time = _construct_date_time()
+        return date_time
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == "__main__":
     a = [9, 0x0c, 7, 0xe7, 5, 8, 1, 12, 0, 0, 0xff, 0x80, 0x0, 0xff]
     b = bytes(a)
-    adt = DateTime.parse(b)
+    adt = parse_date_time(b)
     print(adt)
     print("\n\n")
     print(adt.datetime)
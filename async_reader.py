@@ -0,0 +1,117 @@
+# pylint: disable=missing-docstring
+"""
+asyncio based reading of the HAN port.
+
+pyserial-asyncio calls HanProtocol.data_received() as soon as the serial
+driver hands over bytes, the bytes go straight into the framer and complete
+frames are decoded right away.  There is no polling and no sleeping, so a
+list is decoded a few milliseconds after its closing flag arrives.
+
+    async def main():
+        _, protocol = await open_han_port("/dev/ttyUSB0")
+        async for frame, readings in protocol:
+            print_readings(readings)
+"""
+import asyncio
+
+import serial
+import serial_asyncio
+
+from cosem import CosemDecoder, DecodeError
+from framer import HdlcFramer
+from han_utils import LogLevel, logit
+from metrics import (BYTES_READ, DECODE_ERRORS, DECODE_SECONDS, FRAME_SECONDS, LISTS, SINK_SECONDS, count_framer,
+                     list_label, sink_name)
+
+BAUDRATE = 2400
+QUEUE_SIZE = 100
+
+
+class HanProtocol(asyncio.Protocol):
+    """
+    Frame and decode the bytes from one HAN port.
+
+    Every frame is handed to on_frame(frame), if given, before it is decoded,
+    so it sees the frames that fail to decode too.  Decoded frames are handed
+    to on_readings(frame, readings) if a callback is given, otherwise they are
+    queued for the async iterator.  If the consumer
+    of the iterator falls more than queue_size frames behind, new frames are
+    dropped and counted in dropped_frames.
+    """
+
+    def __init__(self, on_readings=None, verify_crc=True, decoder=None, queue_size=QUEUE_SIZE, on_frame=None):
+        self.framer = HdlcFramer(verify_crc=verify_crc)
+        self.decoder = decoder if decoder is not None else CosemDecoder()
+        self.on_readings = on_readings
+        self.on_frame = on_frame
+        self.queue = asyncio.Queue(queue_size)
+        self.transport = None
+        self.dropped_frames = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        logit("HAN port opened: %s", transport, lvl=LogLevel.INFO)
+
+    def data_received(self, data):
+        BYTES_READ.inc(len(data))
+        with FRAME_SECONDS.time():
+            frames = self.framer.feed(data)
+        count_framer(self.framer)
+        for frame in frames:
+            if self.on_frame is not None:
+                with SINK_SECONDS.time(sink_name(self.on_frame)):
+                    self.on_frame(frame)
+            label = list_label(frame)
+            try:
+                with DECODE_SECONDS.time(label):
+                    readings = self.decoder.decode(frame)
+            except DecodeError as decode_error:
+                DECODE_ERRORS.inc()
+                logit("Could not decode frame: %s", decode_error, lvl=LogLevel.ERROR)
+                continue
+            LISTS.inc(label_value=label)
+
+            if self.on_readings is not None:
+                with SINK_SECONDS.time(sink_name(self.on_readings)):
+                    self.on_readings(frame, readings)
+                continue
+            try:
+                self.queue.put_nowait((frame, readings))
+            except asyncio.QueueFull:
+                self.dropped_frames += 1
+
+    def connection_lost(self, exc):
+        logit("HAN port closed: %s", exc, lvl=LogLevel.INFO if exc is None else LogLevel.ERROR)
+        self.transport = None
+        # wake up the iterator, there will be no more frames
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                break
+            except asyncio.QueueFull:
+                self.queue.get_nowait()
+                self.dropped_frames += 1
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+
+async def open_han_port(port_name, protocol_factory=HanProtocol, **kwargs):
+    """Open the serial port and return (transport, protocol)."""
+    loop = asyncio.get_running_loop()
+    return await serial_asyncio.create_serial_connection(
+        loop, lambda: protocol_factory(**kwargs), port_name, baudrate=BAUDRATE, parity=serial.PARITY_EVEN
+    )
+
+
+async def read_port(port_name, on_readings, **kwargs):
+    """Decode frames from the port until it is closed."""
+    _, protocol = await open_han_port(port_name, **kwargs)
+    async for frame, readings in protocol:
+        on_readings(frame, readings)
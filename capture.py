@@ -0,0 +1,226 @@
+# pylint: disable=missing-docstring
+"""
+Capture container: one record per HDLC frame, with a sidecar time index.
+
+Capture file:
+
+    b"HANCAP01"
+    record: <d receive time (epoch seconds)  <H port id  <B list type (0, 1, 2, 3)  <H frame length  frame bytes
+    record ...
+
+Index file (capture file name + ".idx"), one entry per port and
+index_interval seconds:
+
+    <d receive time  <Q offset of the record in the capture file  <H port id
+
+To find the frames of one port between two times, the reader starts at the
+last index entry of the port at or before the start time and reads forward
+until the records are past the end time, so at most index_interval seconds
+of records are read before the first match.  That needs receive times that
+only go forward.  The writer also indexes a record whose time went back (the
+system clock was set back), so the reader can tell from the index: if its
+times are not in order, records() reads the whole file and filters it.
+
+    python capture.py CAPTURE [--port=N] [--start=2023-05-08T14:00] [--end=2023-05-08T15:00] [--out=FRAMES.bin]
+"""
+import bisect
+import datetime
+import mmap
+import os
+import struct
+import sys
+import time
+from typing import Iterator, NamedTuple, Optional
+
+from hdlc import which_list
+
+MAGIC = b"HANCAP01"
+RECORD_HEADER = struct.Struct("<dHBH")
+INDEX_ENTRY = struct.Struct("<dQH")
+INDEX_SUFFIX = ".idx"
+INDEX_INTERVAL = 60.0
+LIST_TYPES = {"List 1": 1, "List 2": 2, "List 3": 3}
+
+
+class CaptureRecord(NamedTuple):
+    timestamp: float
+    port_id: int
+    list_type: int
+    frame: bytes
+
+
+def list_type(frame):
+    return LIST_TYPES.get(which_list(frame), 0)
+
+
+def is_capture_file(file_name):
+    with open(file_name, "rb") as capture:
+        return capture.read(len(MAGIC)) == MAGIC
+
+
+class CaptureWriter:
+    """Append frames to a capture file and its index."""
+
+    def __init__(self, file_name, index_interval=INDEX_INTERVAL):
+        self.file_name = file_name
+        self.index_interval = index_interval
+        self.capture = open(file_name, "ab")
+        if self.capture.tell() == 0:
+            self.capture.write(MAGIC)
+        self.index = open(file_name + INDEX_SUFFIX, "ab")
+        self.next_index_time = {}
+
+    def write(self, frame, port_id=0, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        offset = self.capture.tell()
+        next_index_time = self.next_index_time.get(port_id, 0.0)
+        # index the first record after the clock went back too, see the module docstring
+        if timestamp >= next_index_time or timestamp < next_index_time - self.index_interval:
+            self.index.write(INDEX_ENTRY.pack(timestamp, offset, port_id))
+            self.next_index_time[port_id] = timestamp + self.index_interval
+        self.capture.write(RECORD_HEADER.pack(timestamp, port_id, list_type(frame), len(frame)))
+        self.capture.write(frame)
+
+    def flush(self):
+        self.capture.flush()
+        self.index.flush()
+
+    def close(self):
+        self.capture.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def read_records(file_name, offset=len(MAGIC), end_offset=None) -> Iterator[CaptureRecord]:
+    """Yield the records of a capture file that start at offset or after it, and before end_offset."""
+    with open(file_name, "rb") as capture:
+        if os.fstat(capture.fileno()).st_size <= len(MAGIC):
+            return
+        with mmap.mmap(capture.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{file_name} is not a capture file")
+            size = len(mapped) if end_offset is None else min(len(mapped), end_offset)
+            while offset < size and offset + RECORD_HEADER.size <= len(mapped):
+                timestamp, record_port, record_list, length = RECORD_HEADER.unpack_from(mapped, offset)
+                frame_start = offset + RECORD_HEADER.size
+                offset = frame_start + length
+                if offset > len(mapped):
+                    break
+                yield CaptureRecord(timestamp, record_port, record_list, mapped[frame_start:offset])
+
+
+class CaptureReader:
+    """Read records from a capture file, using the index to seek by time."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.index = []
+        index_name = file_name + INDEX_SUFFIX
+        if os.path.exists(index_name):
+            with open(index_name, "rb") as index_file:
+                data = index_file.read()
+            # ignore a partly written last entry
+            data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+            self.index = list(INDEX_ENTRY.iter_unpack(data))
+        self.index_times = [entry[0] for entry in self.index]
+        self.in_order = all(earlier <= later for earlier, later in zip(self.index_times, self.index_times[1:]))
+
+    def start_offset(self, port_id=None, start=None):
+        """
+        Return the offset of the last indexed record of the port at or before start.
+
+        The index is bisected, which only works if its times are in order,
+        otherwise the offset of the first record is returned.
+        """
+        if start is None or not self.in_order:
+            return len(MAGIC)
+        position = bisect.bisect_right(self.index_times, start)
+        while position > 0:
+            position -= 1
+            _, entry_offset, entry_port = self.index[position]
+            if port_id is None or entry_port == port_id:
+                return entry_offset
+        return len(MAGIC)
+
+    def records(self, port_id=None, start=None, end=None) -> Iterator[CaptureRecord]:
+        """Yield the records of the port (all ports if None) with start <= receive time < end."""
+        for record in read_records(self.file_name, self.start_offset(port_id, start)):
+            if end is not None and record.timestamp >= end:
+                if self.in_order:
+                    break
+                continue
+            if (start is not None and record.timestamp < start) or (port_id is not None and record.port_id != port_id):
+                continue
+            yield record
+
+    def record_offsets(self) -> Iterator[int]:
+        """Yield the offset of every record, reading only the record headers."""
+        with open(self.file_name, "rb") as capture:
+            size = os.fstat(capture.fileno()).st_size
+            offset = len(MAGIC)
+            while offset + RECORD_HEADER.size <= size:
+                capture.seek(offset)
+                length = RECORD_HEADER.unpack(capture.read(RECORD_HEADER.size))[3]
+                yield offset
+                offset += RECORD_HEADER.size + length
+
+    def chunks(self, chunk_size):
+        """
+        Return (start offset, end offset) pairs of about chunk_size bytes that
+        start on a record, for read_records().  The offsets come from the
+        index, or from the record headers when there is no index.
+        """
+        size = os.path.getsize(self.file_name)
+        offsets = (entry[1] for entry in self.index) if self.index else self.record_offsets()
+        boundaries = [len(MAGIC)]
+        for offset in offsets:
+            if boundaries[-1] + chunk_size <= offset < size:
+                boundaries.append(offset)
+        boundaries.append(max(size, len(MAGIC)))
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def __iter__(self):
+        return self.records()
+
+
+def parse_time(text) -> Optional[float]:
+    return datetime.datetime.fromisoformat(text).timestamp() if text else None
+
+
+if __name__ == "__main__":
+    options = {"port": None, "start": None, "end": None, "out": None, "file": None}
+    for argument in sys.argv[1:]:
+        if argument.startswith("--") and "=" in argument:
+            key, value = argument[2:].split("=", 1)
+            if key not in options:
+                print(f"Unknown argument: {argument}")
+                sys.exit(0)
+            options[key] = value
+        else:
+            options["file"] = argument
+    if options["file"] is None:
+        print("Usage: python capture.py CAPTURE [--port=N] [--start=ISO-TIME] [--end=ISO-TIME] [--out=FRAMES.bin]")
+        sys.exit(0)
+
+    reader = CaptureReader(options["file"])
+    selected = reader.records(None if options["port"] is None else int(options["port"]),
+                              parse_time(options["start"]), parse_time(options["end"]))
+    noof_records = 0
+    if options["out"] is not None:
+        with open(options["out"], "wb") as out_file:
+            for record in selected:
+                out_file.write(record.frame)
+                noof_records += 1
+        print(f"{noof_records} frames written to {options['out']}")
+    else:
+        for record in selected:
+            noof_records += 1
+            print(f"{datetime.datetime.fromtimestamp(record.timestamp)} port {record.port_id} "
+                  f"list {record.list_type} {len(record.frame)} bytes")
+        print(f"{noof_records} frames")
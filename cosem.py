@@ -0,0 +1,445 @@
+# pylint: disable=missing-docstring
+"""
+Decode the DLMS/COSEM payload of a HDLC frame into typed readings.
+
+The decoder walks a memoryview of the frame with an integer cursor and reads
+the values with struct.unpack_from().  No hex or printable strings are built
+while decoding, Reading.hex and Reading.printable produce them on demand.
+
+Frame layout (Aidon, List 1):
+
+    7e a0 2a 41 08 83 13 04 13      HDLC header, see framer.header_length()
+    e6 e7 00                        LLC
+    0f 40 00 00 00 00               data-notification, invoke id, no date-time
+    01 01                           array of 1 element
+    02 03                           structure of 3 elements
+    09 06 01 00 01 07 00 ff         OBIS code 1.0.1.7.0.255
+    06 00 00 04 62                  double-long-unsigned value
+    02 02 0f 00 16 1b               scaler 0, unit 27 (W)
+    ae 27 7e                        FCS and closing flag
+"""
+import datetime
+import operator
+import struct
+from typing import List, Optional
+
+from aidon_date_time import unpack_date_time
+from framer import header_length
+from han_utils import bytes_printable, hexify
+from hdlc import DataType, PhysicalUnits
+from normalize import scaled_value, unit_symbol
+from obis_registry import LIST_VERSION_OBIS, REGISTRY
+
+LLC = b"\xe6\xe7\x00"
+DATA_NOTIFICATION = 0x0F
+
+# type tag -> struct for the fixed size types
+FIXED_SIZE_TYPES = {
+    DataType.BOOLEAN.value: struct.Struct(">?"),
+    DataType.DOUBLE_LONG.value: struct.Struct(">i"),
+    DataType.DOUBLE_LONG_UNSIGNED.value: struct.Struct(">I"),
+    DataType.INTEGER.value: struct.Struct(">b"),
+    DataType.LONG.value: struct.Struct(">h"),
+    DataType.UNSIGNED.value: struct.Struct(">B"),
+    DataType.LONG_UNSIGNED.value: struct.Struct(">H"),
+    DataType.LONG64.value: struct.Struct(">q"),
+    DataType.LONG64_UNSIGNED.value: struct.Struct(">Q"),
+    DataType.ENUM.value: struct.Struct(">B"),
+    23: struct.Struct(">f"),  # float32
+    24: struct.Struct(">d"),  # float64
+}
+
+ARRAY = DataType.ARRAY.value
+STRUCTURE = DataType.STRUCTURE.value
+OCTET_STRING = DataType.OCTET_STRING.value
+VISIBLE_STRING = DataType.VISIBLE_STRING.value
+UTF8_STRING = DataType.UTF8_STRING.value
+INTEGER = DataType.INTEGER.value
+ENUM = DataType.ENUM.value
+NULL_DATA = DataType.NULL_DATA.value
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class Reading:
+    """
+    One decoded value from a list.
+
+    obis is the OBIS code as a tuple of six ints (None if the meter does not
+    send codes and the registry has no layout for the list), value the decoded
+    value, scaler and unit the scaler_unit sent with the value or else the
+    default of the registry (None when unknown) and timestamp the clock of
+    the list.
+    """
+
+    __slots__ = ("obis", "value", "scaler", "unit", "timestamp", "_frame", "_start", "_end")
+
+    def __init__(self, obis, value, scaler=None, unit=None, timestamp=None, frame=b"", start=0, end=0):
+        self.obis = obis
+        self.value = value
+        self.scaler = scaler
+        self.unit = unit
+        self.timestamp = timestamp
+        self._frame = frame
+        self._start = start
+        self._end = end
+
+    @property
+    def obis_code(self):
+        return "" if self.obis is None else ".".join(map(str, self.obis))
+
+    @property
+    def name(self):
+        return "Unknown" if self.obis is None else REGISTRY.name(self.obis)
+
+    @property
+    def raw(self):
+        return self._frame[self._start:self._end]
+
+    @property
+    def hex(self):
+        return hexify(self.raw)
+
+    @property
+    def printable(self):
+        return bytes_printable(self.raw)
+
+    @property
+    def scaled_value(self):
+        """The value with the scaler applied, in the unit of unit_symbol."""
+        return scaled_value(self.value, self.scaler)
+
+    @property
+    def unit_symbol(self):
+        return unit_symbol(self.unit)
+
+    @property
+    def unit_name(self):
+        try:
+            return PhysicalUnits(self.unit).name
+        except ValueError:
+            return str(self.unit)
+
+    def __repr__(self):
+        return f"Reading({self.obis_code}, {self.value!r}, scaler={self.scaler}, unit={self.unit})"
+
+
+def decode_length(view, pos):
+    """Return (length, position after the length) of an A-XDR length field."""
+    length = view[pos]
+    if length < 0x80:
+        return length, pos + 1
+    noof_bytes = length & 0x7F
+    return int.from_bytes(view[pos + 1:pos + 1 + noof_bytes], "big"), pos + 1 + noof_bytes
+
+
+def decode_datetime(raw):
+    try:
+        return unpack_date_time(raw)
+    except (ValueError, struct.error):
+        return bytes(raw)
+
+
+def decode_visible_string(raw):
+    return str(raw, "ascii", "replace")
+
+
+def decode_utf8_string(raw):
+    return str(raw, "utf-8", "replace")
+
+
+def apply_profile(readings):
+    """
+    Complete the readings from the vendor profile of the list.
+
+    Values without OBIS code get the codes of the positional layout of the
+    list, if the registry has one, and values without scaler_unit get the
+    default scaler and unit of their code.
+    """
+    # the list version id comes first, as a visible-string or (Kaifa) an octet-string
+    list_id = None
+    first = readings[0]
+    if first.obis is None or first.obis == LIST_VERSION_OBIS:
+        if isinstance(first.value, str):
+            list_id = first.value
+        elif isinstance(first.value, bytes):
+            list_id = first.value.decode("ascii", "replace")
+    if list_id is not None:
+        profile = REGISTRY.profile_for(list_id)
+    elif readings[0].obis is None:
+        profile = REGISTRY.positional_profile(len(readings))
+    else:
+        profile = None
+
+    if profile is not None and readings[0].obis is None:
+        codes = profile.codes_for(list_id, len(readings))
+        if codes is not None:
+            for reading, code in zip(readings, codes):
+                reading.obis = code
+
+    for reading in readings:
+        if reading.scaler is None and reading.obis is not None:
+            entry = REGISTRY.get(reading.obis, profile)
+            if entry is not None and entry.scaler is not None:
+                reading.scaler = entry.scaler
+                reading.unit = entry.unit
+    return readings
+
+
+def stamp_readings(readings, timestamp):
+    """Set the timestamp of all readings to the clock of the list, if there is one."""
+    for reading in readings:
+        if reading.obis in REGISTRY.clock_codes:
+            timestamp = reading.value
+            break
+    if isinstance(timestamp, datetime.datetime):
+        for reading in readings:
+            reading.timestamp = timestamp
+    return readings
+
+
+def payload_start(view):
+    """
+    Return (index of the first byte of the notification body, raw date-time).
+
+    The date-time of the data-notification is None when the meter leaves it out.
+    """
+    pos = header_length(view)
+    if pos is None:
+        raise DecodeError("Bad HDLC address field")
+
+    if view[pos:pos + 3] == LLC:
+        pos += 3
+    if view[pos] != DATA_NOTIFICATION:
+        raise DecodeError(f"Not a data-notification: 0x{view[pos]:02x}")
+    # tag + long-invoke-id-and-priority
+    pos += 5
+
+    # optional date-time: 00 = absent, 09 0c <12 bytes> or 0c <12 bytes>
+    date_time = None
+    if view[pos] == OCTET_STRING:
+        length, pos = decode_length(view, pos + 1)
+        date_time = view[pos:pos + length]
+        pos += length
+    elif view[pos] == 0x0C:
+        date_time = view[pos + 1:pos + 13]
+        pos += 13
+    else:
+        pos += 1
+    return pos, date_time
+
+
+class DecodePlan:
+    """
+    Precompiled decoding of one list layout.
+
+    The layout of a frame is everything but the values: type tags, lengths,
+    OBIS codes and scaler_units.  A plan unpacks the whole payload with a
+    single struct.unpack_from(), where the layout bytes come out as bytes
+    fields.  If those equal the layout the plan was compiled from, the frame
+    has the same layout and the value fields are the values.
+    """
+
+    __slots__ = ("start", "struct", "layout_of", "layout", "templates", "date_time_pos")
+
+    def __init__(self, start, trace, templates, sample, date_time_pos=None):
+        fmt = ">"
+        layout_indexes = []
+        trace_to_field = {}
+        const_size = 0
+        field = 0
+        for trace_index, (size, code, _) in enumerate(trace):
+            if code is None:
+                const_size += size
+                continue
+            if const_size:
+                fmt += f"{const_size}s"
+                layout_indexes.append(field)
+                field += 1
+                const_size = 0
+            fmt += code
+            trace_to_field[trace_index] = field
+            field += 1
+        if const_size:
+            fmt += f"{const_size}s"
+            layout_indexes.append(field)
+
+        self.start = start
+        self.struct = struct.Struct(fmt)
+        self.layout_of = operator.itemgetter(*layout_indexes)
+        self.layout = self.layout_of(self.struct.unpack_from(sample, start))
+        # (obis, scaler, unit, start, end, field index, converter) per reading
+        self.templates = tuple(
+            (obis, scaler, unit, r_start, r_end, trace_to_field[trace_index], trace[trace_index][2])
+            for obis, scaler, unit, r_start, r_end, trace_index in templates
+        )
+        self.date_time_pos = date_time_pos
+
+    def decode(self, frame) -> Optional[List[Reading]]:
+        """Return the readings of the frame, or None if the frame has another layout."""
+        fields = self.struct.unpack_from(frame, self.start)
+        if self.layout_of(fields) != self.layout:
+            return None
+
+        readings = [
+            Reading(obis, fields[index] if convert is None else convert(fields[index]), scaler, unit,
+                    frame=frame, start=start, end=end)
+            for obis, scaler, unit, start, end, index, convert in self.templates
+        ]
+        timestamp = None
+        if self.date_time_pos is not None:
+            timestamp = decode_datetime(frame[self.date_time_pos:self.date_time_pos + 12])
+        return stamp_readings(readings, timestamp)
+
+
+class CosemDecoder:
+    """
+    Turn HDLC frames into lists of Reading.
+
+    Every 6 byte octet-string that is not a value is taken to be an OBIS code
+    and names the value following it.  A structure of integer + enum following
+    a value is its scaler_unit.  Codes and scaler_units the meter leaves out
+    are filled in from the OBIS registry, see apply_profile().
+
+    The first frame of each layout is decoded by walking the type tags, which
+    also compiles a DecodePlan for the layout.  Later frames of the same length
+    are tried against the plans for that length first and only fall back to
+    walking the tags if none of them match.  use_plans=False always walks.
+    """
+
+    def __init__(self, use_plans=True, max_plans=16):
+        self.frames = 0
+        self.errors = 0
+        self.use_plans = use_plans
+        self.max_plans = max_plans
+        self.plans = {}
+        self.noof_plans = 0
+        self.plan_hits = 0
+
+    def decode(self, frame) -> List[Reading]:
+        if self.use_plans:
+            for plan in self.plans.get(len(frame), ()):
+                try:
+                    readings = plan.decode(frame)
+                except struct.error:
+                    continue
+                if readings is not None:
+                    self.frames += 1
+                    self.plan_hits += 1
+                    return readings
+
+        view = memoryview(frame)
+        trace = [] if self.use_plans and self.noof_plans < self.max_plans else None
+        try:
+            pos, date_time = payload_start(view)
+            readings = self._walk(frame, view, pos, len(view) - 3, trace)
+            if readings:
+                apply_profile(readings)
+        except (IndexError, struct.error) as ex:
+            self.errors += 1
+            raise DecodeError(f"Truncated payload: {ex}") from ex
+        except DecodeError:
+            self.errors += 1
+            raise
+
+        # a list without readings has no layout to check later frames against
+        if trace is not None and readings:
+            date_time_pos = None
+            if date_time is not None and len(date_time) == 12:
+                date_time_pos = pos - 12
+            templates = [(reading.obis, reading.scaler, reading.unit, reading._start, reading._end, slot)
+                         for reading, slot in zip(readings, trace.pop())]
+            self.plans.setdefault(len(frame), []).append(DecodePlan(pos, trace, templates, frame, date_time_pos))
+            self.noof_plans += 1
+
+        self.frames += 1
+        timestamp = None if date_time is None or len(date_time) != 12 else decode_datetime(date_time)
+        return stamp_readings(readings, timestamp)
+
+    def _walk(self, frame, view, pos, end, trace=None):
+        """
+        Decode the values in view[pos:end] by their type tags.
+
+        With a trace list given, the walk is recorded in it as one
+        (size, struct code, converter) entry per run of bytes, struct code None
+        for layout bytes.  The last entry appended is the list of trace indexes
+        holding the value of each reading.
+        """
+        readings = []
+        slots = []
+        current = None
+        obis = None
+        start = pos
+        while pos < end:
+            tag = view[pos]
+
+            if tag in (ARRAY, STRUCTURE):
+                if (tag == STRUCTURE and view[pos + 1] == 2 and current is not None and current.scaler is None
+                        and view[pos + 2] == INTEGER and view[pos + 4] == ENUM):
+                    current.scaler = FIXED_SIZE_TYPES[INTEGER].unpack_from(view, pos + 3)[0]
+                    current.unit = view[pos + 5]
+                    pos += 6
+                    current._end = pos
+                    if trace is not None:
+                        trace.append((6, None, None))
+                    continue
+                pos += 2
+                if trace is not None:
+                    trace.append((2, None, None))
+                continue
+
+            if obis is None:
+                start = pos
+
+            fixed = FIXED_SIZE_TYPES.get(tag)
+            convert = None
+            if fixed is not None:
+                value = fixed.unpack_from(view, pos + 1)[0]
+                if trace is not None:
+                    trace.append((1, None, None))
+                    trace.append((fixed.size, fixed.format[1:], None))
+                pos += 1 + fixed.size
+            elif tag in (OCTET_STRING, VISIBLE_STRING, UTF8_STRING):
+                length, data_pos = decode_length(view, pos + 1)
+                string_end = data_pos + length
+                if string_end > end:
+                    raise DecodeError(f"String of {length} bytes runs past the end of the frame")
+                if tag == OCTET_STRING and length == 6 and obis is None:
+                    obis = tuple(view[data_pos:string_end])
+                    if trace is not None:
+                        trace.append((string_end - pos, None, None))
+                    pos = string_end
+                    continue
+                if tag == VISIBLE_STRING:
+                    convert = decode_visible_string
+                elif tag == UTF8_STRING:
+                    convert = decode_utf8_string
+                elif length == 12:
+                    convert = decode_datetime
+                raw = bytes(view[data_pos:string_end])
+                value = raw if convert is None else convert(raw)
+                if trace is not None:
+                    trace.append((data_pos - pos, None, None))
+                    trace.append((length, f"{length}s", convert))
+                pos = string_end
+            elif tag == NULL_DATA:
+                value = None
+                if trace is not None:
+                    trace.append((1, None, None))
+                    # a zero length bytes field stands in for the value
+                    trace.append((0, "0s", lambda _: None))
+                pos += 1
+            else:
+                raise DecodeError(f"Unsupported data type 0x{tag:02x} at offset {pos}")
+
+            current = Reading(obis, value, frame=frame, start=start, end=pos)
+            readings.append(current)
+            if trace is not None:
+                slots.append(len(trace) - 1)
+            obis = None
+
+        if trace is not None:
+            trace.append(slots)
+        return readings
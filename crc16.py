@@ -0,0 +1,52 @@
+# pylint: disable=missing-docstring
+"""
+CRC-16/X.25 as used for the HCS and FCS fields of HDLC frames.
+
+poly 0x1021 (reflected 0x8408), init 0xffff, xorout 0xffff.  The checksum is
+sent least significant byte first.
+
+crc16_x25() runs in C: the X.25 CRC is the bit reversal of the CCITT CRC
+(binascii.crc_hqx) over bit reversed input bytes, and both reversals are
+table lookups.  crc16_x25_table() is the classic 256 entry table version, kept
+as the reference implementation.
+"""
+import binascii
+
+
+def _reverse_bits(byte):
+    retval = 0
+    for _ in range(8):
+        retval = (retval << 1) | (byte & 1)
+        byte >>= 1
+    return retval
+
+
+def _make_table():
+    table = []
+    for index in range(256):
+        crc = index
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_X25_TABLE = _make_table()
+REVERSED_BYTES = bytes(_reverse_bits(byte) for byte in range(256))
+
+
+def crc16_x25_table(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ CRC16_X25_TABLE[(crc ^ byte) & 0xFF]
+    return crc ^ 0xFFFF
+
+
+def crc16_x25(data):
+    crc = binascii.crc_hqx(bytes(data).translate(REVERSED_BYTES), 0xFFFF)
+    return ((REVERSED_BYTES[crc & 0xFF] << 8) | REVERSED_BYTES[crc >> 8]) ^ 0xFFFF
+
+
+def check_crc(buf, start, end):
+    """Return True if the two bytes at buf[end:end + 2] hold the CRC of buf[start:end]."""
+    return crc16_x25(buf[start:end]) == buf[end] | (buf[end + 1] << 8)
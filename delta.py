@@ -0,0 +1,149 @@
+# pylint: disable=missing-docstring
+"""
+Change detection between the lists of a meter.
+
+Most of what a meter sends repeats: List 1 every 2.5 s and List 2 every 10 s
+carry the same list version, meter id and type every time, and voltages and
+currents move little.  DeltaFilter remembers, per meter, the value last sent
+for every OBIS code and lets a reading through only if
+
+- it has changed by more than the deadband of its code (in the unit of
+  Reading.unit_symbol, so 0.5 for voltages means 0.5 V), any change for
+  codes without a deadband and for values that are not numbers, or
+- it is the clock of the list, or
+- the list is a keyframe: the first list of a meter and then the first list
+  every keyframe_interval seconds go through in full, so a consumer that
+  starts late or lost a message has all values again within that time.
+
+Changes are measured against the value last sent, not the last one seen, so
+a value creeping up in steps below the deadband is still sent once it has
+moved by more than the deadband in total.
+
+    delta = DeltaFilter(parse_deadbands("V:0.5,W:10"), keyframe_interval=300)
+    changed = delta.changes(readings, meter=port_id)
+
+Deadbands are given per OBIS code ("1.0.32.7.0.255:1") or per unit ("V:0.5"),
+a code takes precedence over its unit.
+"""
+import time
+
+from metrics import Counter
+from obis_registry import REGISTRY, pack_obis, unpack_obis
+
+KEYFRAME_INTERVAL = 300.0
+
+DELTA_READINGS = Counter("han_delta_readings_total", "Readings through the delta stage, by outcome", label="outcome")
+KEYFRAMES = Counter("han_delta_keyframes_total", "Lists sent in full by the delta stage")
+
+_MISSING = object()
+
+
+def parse_deadbands(text):
+    """Parse "CODE:DEADBAND,UNIT:DEADBAND,..." into {OBIS tuple or unit symbol: deadband}."""
+    deadbands = {}
+    for part in text.split(","):
+        if not part.strip():
+            continue
+        key, _, deadband = part.rpartition(":")
+        key = key.strip()
+        if not key:
+            raise ValueError(f"Deadband without code or unit: {part!r}")
+        deadbands[unpack_obis(pack_obis(key)) if "." in key else key] = float(deadband)
+    return deadbands
+
+
+class MeterState:
+    """The values last sent for one meter and the time of its last keyframe."""
+
+    __slots__ = ("sent", "keyframe_time")
+
+    def __init__(self, keyframe_time):
+        self.sent = {}
+        self.keyframe_time = keyframe_time
+
+
+class DeltaFilter:
+    """Pass on the readings of every meter that changed, see the module docstring."""
+
+    def __init__(self, deadbands=None, keyframe_interval=KEYFRAME_INTERVAL):
+        self.deadbands = dict(deadbands or {})
+        self.keyframe_interval = keyframe_interval
+        self.meters = {}
+        self.readings_in = 0
+        self.readings_out = 0
+        self.keyframes = 0
+
+    def deadband(self, reading):
+        deadband = self.deadbands.get(reading.obis)
+        if deadband is None:
+            deadband = self.deadbands.get(reading.unit_symbol, 0.0)
+        return deadband
+
+    def changes(self, readings, meter=None, now=None):
+        """
+        Return the readings of the list that are to be sent, all of them for a keyframe.
+
+        meter tells the meters apart (a port id or a meter id), now is the
+        time of the list in seconds, time.monotonic() if not given.
+        """
+        now = time.monotonic() if now is None else now
+        state = self.meters.get(meter)
+        keyframe = state is None or now - state.keyframe_time >= self.keyframe_interval
+        if state is None:
+            state = self.meters[meter] = MeterState(now)
+        sent = state.sent
+        if keyframe:
+            state.keyframe_time = now
+            self.keyframes += 1
+            KEYFRAMES.inc()
+
+        changed = []
+        for reading in readings:
+            if reading.obis is None:
+                # no code to compare by
+                changed.append(reading)
+                continue
+            value = reading.scaled_value
+            if keyframe or reading.obis in REGISTRY.clock_codes or self._has_changed(
+                    reading, sent.get(reading.obis, _MISSING), value):
+                sent[reading.obis] = value
+                changed.append(reading)
+
+        self.readings_in += len(readings)
+        self.readings_out += len(changed)
+        DELTA_READINGS.inc(len(changed), "sent")
+        DELTA_READINGS.inc(len(readings) - len(changed), "suppressed")
+        return changed
+
+    def _has_changed(self, reading, previous, value):
+        if previous is _MISSING:
+            return True
+        if isinstance(value, (int, float)) and isinstance(previous, (int, float)):
+            deadband = self.deadband(reading)
+            return abs(value - previous) > deadband if deadband else value != previous
+        return value != previous
+
+    def forget(self, meter=None):
+        """Drop the state of a meter, its next list is a keyframe."""
+        self.meters.pop(meter, None)
+
+    def stats(self):
+        return {
+            "meters": len(self.meters),
+            "readings_in": self.readings_in,
+            "readings_out": self.readings_out,
+            "keyframes": self.keyframes,
+        }
+
+
+def delta_sink(sink, delta_filter, meter=None):
+    """
+    Return a pipeline sink (receive_time, frame, readings) that passes only the
+    changed readings on to sink, and nothing when no reading changed.
+    """
+    def changes_only(receive_time, frame, readings):
+        changed = delta_filter.changes(readings, meter, receive_time)
+        if changed:
+            sink(receive_time, frame, changed)
+    changes_only.__name__ = getattr(sink, "__name__", "sink")
+    return changes_only
@@ -0,0 +1,233 @@
+# pylint: disable=missing-docstring
+"""
+Columnar export of decoded lists.
+
+Values are gathered into one column per OBIS code, buffered batch_size rows
+at a time and written in one go per batch:
+
+- with pyarrow installed, as row groups of a Parquet file
+- otherwise as raw float64 files in a directory, one per column, plus
+  schema.json with the column names and row count.  load_columns() opens
+  them as numpy memmaps.  Exporting to a directory that already holds an
+  export appends to it.
+
+Every row has a timestamp (epoch seconds, the clock of the list or the time
+it was received) and one float per column, NaN where the list does not carry
+the value.  The scalers of each row are buffered next to the values and
+applied to the whole batch with normalize.scale() when it is written, so the
+columns are in W, var, Wh, varh, A and V.  normalize=False exports the
+values as sent by the meter.
+"""
+import json
+import math
+import os
+import sys
+from array import array
+
+import numpy
+
+from normalize import scale, unit_symbol
+from obis_registry import REGISTRY
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+BATCH_SIZE = 4096
+
+# column name, name of its codes in the OBIS registry (the codes differ between vendors)
+COLUMNS = (
+    ("active_power_import", "Active power+(Q1+Q4)"),
+    ("active_power_export", "Active power-(Q1+Q4)"),
+    ("reactive_power_import", "Reactive power+ (Q1+Q2)"),
+    ("reactive_power_export", "Reactive power- (Q1+Q2)"),
+    ("current_l1", "IL1"),
+    ("current_l2", "IL2"),
+    ("current_l3", "IL3"),
+    ("voltage_l1", "UL1"),
+    ("voltage_l2", "UL2"),
+    ("voltage_l3", "UL3"),
+    ("active_energy_import", "A+cumul"),
+    ("active_energy_export", "A-cumul"),
+    ("reactive_energy_import", "R+cumul"),
+    ("reactive_energy_export", "R-cumul"),
+)
+COLUMN_OF_OBIS = {obis: index for index, (_, code_name) in enumerate(COLUMNS)
+                  for obis in REGISTRY.codes_named(code_name)}
+COLUMN_NAMES = ("timestamp",) + tuple(name for name, _ in COLUMNS)
+
+
+def column_unit(code_name):
+    units = {REGISTRY.get(obis).unit for obis in REGISTRY.codes_named(code_name)}
+    return unit_symbol(units.pop()) if len(units) == 1 else ""
+
+
+COLUMN_UNITS = {"timestamp": "s", **{name: column_unit(code_name) for name, code_name in COLUMNS}}
+NO_SCALERS = (0,) * len(COLUMNS)
+SCHEMA_FILE = "schema.json"
+
+
+def readings_to_row(readings, timestamp=None):
+    """Return (clock of the list or else timestamp, value per column) for a decoded list."""
+    row = [math.nan] * len(COLUMNS)
+    clock = None
+    for reading in readings:
+        column = COLUMN_OF_OBIS.get(reading.obis)
+        if column is not None and isinstance(reading.value, (int, float)):
+            row[column] = reading.value
+        if clock is None and reading.timestamp is not None:
+            clock = reading.timestamp.timestamp()
+    return (timestamp if clock is None else clock, *row)
+
+
+def readings_to_scalers(readings):
+    """Return the scaler per column for a decoded list, 0 for columns without a value or scaler."""
+    scalers = [0] * len(COLUMNS)
+    for reading in readings:
+        column = COLUMN_OF_OBIS.get(reading.obis)
+        if column is not None and reading.scaler:
+            scalers[column] = reading.scaler
+    return tuple(scalers)
+
+
+class ColumnarExporter:
+    """
+    Buffer rows per column and write them batch_size rows at a time.
+
+    path is the Parquet file, or the directory for the raw column files when
+    pyarrow is missing or use_arrow is False.  With normalize the scalers
+    given with the rows are applied per batch.
+    """
+
+    def __init__(self, path, batch_size=BATCH_SIZE, use_arrow=None, normalize=True):
+        self.path = path
+        self.batch_size = batch_size
+        self.use_arrow = pyarrow is not None if use_arrow is None else use_arrow
+        self.normalize = normalize
+        self.columns = [array("d") for _ in COLUMN_NAMES]
+        self.scalers = [array("b") for _ in COLUMNS]
+        self.rows = 0
+        self.pending = 0
+        self.writer = None
+        self.existing_rows = None
+
+    def add(self, readings, timestamp=None):
+        self.add_row(readings_to_row(readings, timestamp), readings_to_scalers(readings) if self.normalize else None)
+
+    def add_row(self, row, scalers=None):
+        timestamp = row[0]
+        self.columns[0].append(math.nan if timestamp is None else timestamp)
+        for column, value in zip(self.columns[1:], row[1:]):
+            column.append(value)
+        if self.normalize:
+            for column, scaler in zip(self.scalers, NO_SCALERS if scalers is None else scalers):
+                column.append(scaler)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        arrays = [numpy.frombuffer(column, dtype=numpy.float64) for column in self.columns]
+        if self.normalize:
+            arrays[1:] = [scale(values, numpy.frombuffer(scalers, dtype=numpy.int8))
+                          for values, scalers in zip(arrays[1:], self.scalers)]
+        if self.use_arrow:
+            self._write_arrow(arrays)
+        else:
+            self._write_raw(arrays)
+        self.rows += self.pending
+        self.pending = 0
+        self.columns = [array("d") for _ in COLUMN_NAMES]
+        self.scalers = [array("b") for _ in COLUMNS]
+
+    def units(self):
+        """Return {column name: unit}, the units of the meter for unnormalized columns."""
+        if self.normalize:
+            return dict(COLUMN_UNITS)
+        return {name: "s" if name == "timestamp" else "raw" for name in COLUMN_NAMES}
+
+    def _write_arrow(self, arrays):
+        table = pyarrow.table(dict(zip(COLUMN_NAMES, arrays)), metadata={"units": json.dumps(self.units())})
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def _write_raw(self, arrays):
+        if self.existing_rows is None:
+            self.existing_rows = self._open_raw()
+        for name, values in zip(COLUMN_NAMES, arrays):
+            with open(os.path.join(self.path, f"{name}.f64"), "ab") as column_file:
+                values.tofile(column_file)
+        with open(os.path.join(self.path, SCHEMA_FILE), "w") as schema_file:
+            json.dump({"columns": COLUMN_NAMES, "dtype": "float64", "byteorder": sys.byteorder,
+                       "units": self.units(), "rows": self.existing_rows + self.rows + self.pending},
+                      schema_file, indent=2)
+
+    def _open_raw(self):
+        """
+        Return the number of rows already exported to the directory.  Column
+        files are cut back to that many rows, so bytes after the last
+        schema.json update do not end up in the middle of the appended rows.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        schema_name = os.path.join(self.path, SCHEMA_FILE)
+        existing_rows = 0
+        if os.path.exists(schema_name):
+            with open(schema_name) as schema_file:
+                schema = json.load(schema_file)
+            if (tuple(schema["columns"]) != COLUMN_NAMES or schema["byteorder"] != sys.byteorder
+                    or schema["units"] != self.units()):
+                raise ValueError(f"{self.path} holds an export with other columns or units")
+            existing_rows = schema["rows"]
+        for name in COLUMN_NAMES:
+            column_name = os.path.join(self.path, f"{name}.f64")
+            if os.path.exists(column_name) and os.path.getsize(column_name) > existing_rows * 8:
+                os.truncate(column_name, existing_rows * 8)
+        return existing_rows
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class ExporterGroup:
+    """Hand every list to several exporters (anything with add(readings, timestamp) and close())."""
+
+    def __init__(self, exporters):
+        self.exporters = list(exporters)
+
+    def add(self, readings, timestamp=None):
+        for exporter in self.exporters:
+            exporter.add(readings, timestamp)
+
+    def close(self):
+        for exporter in self.exporters:
+            exporter.close()
+
+
+def load_columns(path):
+    """Return {column name: numpy array} for an export, memory mapped for the raw format."""
+    if os.path.isdir(path):
+        with open(os.path.join(path, SCHEMA_FILE)) as schema_file:
+            schema = json.load(schema_file)
+        if not schema["rows"]:
+            return {name: numpy.empty(0) for name in schema["columns"]}
+        return {
+            name: numpy.memmap(os.path.join(path, f"{name}.f64"), dtype=numpy.float64, mode="r",
+                               shape=(schema["rows"],))
+            for name in schema["columns"]
+        }
+    table = pyarrow.parquet.read_table(path)
+    return {name: table.column(name).to_numpy() for name in table.column_names}
@@ -0,0 +1,223 @@
+# pylint: disable=missing-docstring
+"""
+Synthetic Aidon HAN frames, for benchmarks and for trying out the decoders
+without a meter.
+
+AidonMeter simulates a three phase Aidon meter: the power takes a random
+walk, the currents follow the power and the energy registers count up.  It
+builds List 1 (active power), List 2 (powers, currents and voltages) and
+List 3 (List 2 plus clock and energy registers) frames with the HDLC header,
+HCS and FCS a real meter sends:
+
+    meter = AidonMeter(seed=1)
+    frame = meter.list2()
+    for timestamp, frame in meter.frames(start, seconds=3600):
+        ...
+
+stream() joins frames into a byte stream as it comes from the port, with
+optional junk between the frames and random bit errors.
+
+    python framegen.py FILE [--seconds=N] [--speedup=N] [--junk=MAX] [--bit-errors=RATE] [--seed=N]
+
+writes such a stream to FILE, for reader.py --from-file or replay.py.
+"""
+import datetime
+import random
+import struct
+import sys
+
+from crc16 import crc16_x25
+from framer import FLAG, FRAME_FORMAT_TYPE_3
+
+# destination 0x41, source 0x0883 and control 0x13 as sent by Aidon meters
+HDLC_ADDRESS = b"\x41\x08\x83"
+HDLC_CONTROL = 0x13
+LLC = b"\xe6\xe7\x00"
+# data-notification, long-invoke-id-and-priority, no date-time
+NOTIFICATION = b"\x0f\x40\x00\x00\x00\x00"
+
+LIST_VERSION = b"AIDON_V0001"
+METER_ID = b"7359992907381295"
+METER_TYPE = b"6540"
+
+# the times between lists sent by Aidon meters, in seconds
+LIST1_INTERVAL = 2.5
+LIST2_INTERVAL = 10.0
+LIST3_INTERVAL = 3600.0
+
+W, VAR, WH, VARH, AMPERE, VOLT = 27, 29, 30, 32, 33, 35
+
+
+def hdlc_frame(information):
+    """Wrap the information field in a type 3 HDLC frame with HCS, FCS and flags."""
+    # format(2) + addresses and control + HCS(2) + information + FCS(2)
+    length = 2 + len(HDLC_ADDRESS) + 1 + 2 + len(information) + 2
+    header = bytes([FRAME_FORMAT_TYPE_3 | (length >> 8), length & 0xFF]) + HDLC_ADDRESS + bytes([HDLC_CONTROL])
+    header += crc16_x25(header).to_bytes(2, "little")
+    body = header + information
+    return bytes([FLAG]) + body + crc16_x25(body).to_bytes(2, "little") + bytes([FLAG])
+
+
+def obis_code(code):
+    return b"\x09\x06" + bytes(code)
+
+
+def string_element(code, value, tag=0x0A):
+    return b"\x02\x02" + obis_code(code) + bytes([tag, len(value)]) + value
+
+
+def value_element(code, tag, fmt, value, scaler, unit):
+    return (b"\x02\x03" + obis_code(code) + bytes([tag]) + struct.pack(fmt, value)
+            + b"\x02\x02\x0f" + struct.pack(">b", scaler) + bytes([0x16, unit]))
+
+
+def date_time(moment):
+    """The 12 byte DLMS date-time of a naive local datetime, deviation and clock status not specified."""
+    return struct.pack(">HBBBBBBBhB", moment.year, moment.month, moment.day, moment.isoweekday(), moment.hour,
+                       moment.minute, moment.second, 0xFF, -0x8000, 0xFF)
+
+
+def notification(elements):
+    return hdlc_frame(LLC + NOTIFICATION + bytes([0x01, len(elements)]) + b"".join(elements))
+
+
+class AidonMeter:
+    """A three phase Aidon meter with random but plausible readings."""
+
+    def __init__(self, seed=None, power=2000):
+        self.random = random.Random(seed)
+        self.power = power
+        self.reactive = 300
+        self.voltages = [2300, 2310, 2295]
+        self.energy = [17154161.0, 247279.0, 56908.0, 1701142.0]
+
+    def step(self, seconds):
+        """Advance the meter state by seconds."""
+        self.power = max(0, min(20000, self.power + int(self.random.gauss(0, 150))))
+        self.reactive = max(0, min(5000, self.reactive + int(self.random.gauss(0, 30))))
+        self.voltages = [max(2000, min(2500, voltage + self.random.randint(-3, 3))) for voltage in self.voltages]
+        # energy registers count in units of 10 Wh (scaler 1)
+        self.energy[0] += self.power * seconds / 3600 / 10
+        self.energy[3] += self.reactive * seconds / 3600 / 10
+
+    def _power_elements(self):
+        return [
+            value_element((1, 0, 1, 7, 0, 255), 0x06, ">I", self.power, 0, W),
+            value_element((1, 0, 2, 7, 0, 255), 0x06, ">I", 0, 0, W),
+            value_element((1, 0, 3, 7, 0, 255), 0x06, ">I", 0, 0, VAR),
+            value_element((1, 0, 4, 7, 0, 255), 0x06, ">I", self.reactive, 0, VAR),
+        ]
+
+    def _list2_elements(self):
+        currents = [int(self.power / 3 / voltage * 100) for voltage in self.voltages]
+        return [
+            string_element((1, 1, 0, 2, 129, 255), LIST_VERSION),
+            string_element((0, 0, 96, 1, 0, 255), METER_ID),
+            string_element((0, 0, 96, 1, 7, 255), METER_TYPE),
+            *self._power_elements(),
+            value_element((1, 0, 31, 7, 0, 255), 0x10, ">h", currents[0], -1, AMPERE),
+            value_element((1, 0, 51, 7, 0, 255), 0x10, ">h", currents[1], -1, AMPERE),
+            value_element((1, 0, 71, 7, 0, 255), 0x10, ">h", currents[2], -1, AMPERE),
+            value_element((1, 0, 32, 7, 0, 255), 0x12, ">H", self.voltages[0], -1, VOLT),
+            value_element((1, 0, 52, 7, 0, 255), 0x12, ">H", self.voltages[1], -1, VOLT),
+            value_element((1, 0, 72, 7, 0, 255), 0x12, ">H", self.voltages[2], -1, VOLT),
+        ]
+
+    def list1(self):
+        return notification(self._power_elements()[:1])
+
+    def list2(self):
+        return notification(self._list2_elements())
+
+    def list3(self, moment=None):
+        moment = moment if moment is not None else datetime.datetime.now().replace(microsecond=0)
+        return notification(self._list2_elements() + [
+            string_element((0, 0, 1, 0, 0, 255), date_time(moment), tag=0x09),
+            value_element((1, 0, 1, 8, 0, 255), 0x06, ">I", int(self.energy[0]), 1, WH),
+            value_element((1, 0, 2, 8, 0, 255), 0x06, ">I", int(self.energy[1]), 1, WH),
+            value_element((1, 0, 3, 8, 0, 255), 0x06, ">I", int(self.energy[2]), 1, VARH),
+            value_element((1, 0, 4, 8, 0, 255), 0x06, ">I", int(self.energy[3]), 1, VARH),
+        ])
+
+    def frames(self, start, seconds, list1_interval=LIST1_INTERVAL, list2_interval=LIST2_INTERVAL,
+               list3_interval=LIST3_INTERVAL):
+        """
+        Yield (timestamp, frame) for seconds from start (a datetime), each list at its own interval.
+
+        Like the meter, only the longest list is sent when two are due at the same time.
+        """
+        # (time due, -list number, interval), so min() gives the longest of the lists due first
+        schedule = [(0.0, -3, list3_interval), (0.0, -2, list2_interval), (0.0, -1, list1_interval)]
+        elapsed = -1.0
+        while True:
+            entry = min(schedule)
+            offset, list_no, interval = entry
+            if offset >= seconds:
+                return
+            schedule.remove(entry)
+            schedule.append((offset + interval, list_no, interval))
+            if offset == elapsed:
+                continue
+            self.step(offset - max(elapsed, 0.0))
+            elapsed = offset
+            moment = start + datetime.timedelta(seconds=offset)
+            if list_no == -3:
+                frame = self.list3(moment.replace(microsecond=0))
+            elif list_no == -2:
+                frame = self.list2()
+            else:
+                frame = self.list1()
+            yield moment.timestamp(), frame
+
+
+def stream(frames, junk=0, bit_error_rate=0.0, seed=None):
+    """
+    Join frames into one byte stream.
+
+    Up to junk random bytes are put between the frames and every bit is
+    flipped with probability bit_error_rate.
+    """
+    rng = random.Random(seed)
+    data = bytearray()
+    for frame in frames:
+        if junk:
+            data += rng.randbytes(rng.randint(0, junk))
+        data += frame
+    if bit_error_rate:
+        noof_errors = int(len(data) * 8 * bit_error_rate)
+        for _ in range(noof_errors):
+            bit = rng.randrange(len(data) * 8)
+            data[bit >> 3] ^= 1 << (bit & 7)
+    return bytes(data)
+
+
+USAGE = "Usage: python framegen.py FILE [--seconds=N] [--speedup=N] [--junk=MAX] [--bit-errors=RATE] [--seed=N]"
+
+
+if __name__ == "__main__":
+    options = {"seconds": "3600", "speedup": "1", "junk": "0", "bit-errors": "0", "seed": "1", "file": None}
+    for argument in sys.argv[1:]:
+        if argument.startswith("-"):
+            key, _, value = argument[2:].partition("=")
+            if argument in ("-h", "--help"):
+                print(USAGE)
+                sys.exit(0)
+            if not argument.startswith("--") or key not in options or key == "file" or not value:
+                print(f"Unknown argument: {argument}")
+                print(USAGE)
+                sys.exit(0)
+            options[key] = value
+        else:
+            options["file"] = argument
+    if options["file"] is None:
+        print(USAGE)
+        sys.exit(0)
+
+    speedup = float(options["speedup"])
+    meter = AidonMeter(seed=int(options["seed"]))
+    generated = [frame for _, frame in meter.frames(datetime.datetime.now().replace(minute=0, second=0, microsecond=0),
+                                                    float(options["seconds"]), LIST1_INTERVAL / speedup,
+                                                    LIST2_INTERVAL / speedup, LIST3_INTERVAL / speedup)]
+    with open(options["file"], "wb") as out_file:
+        out_file.write(stream(generated, int(options["junk"]), float(options["bit-errors"]), int(options["seed"])))
+    print(f"{len(generated)} frames written to {options['file']}")
@@ -0,0 +1,222 @@
+# pylint: disable=missing-docstring
+"""
+Offset based HDLC framing of the byte stream from the HAN port.
+
+The meter sends HDLC frames of type 3 (IEC 62056-46):
+
+    7e a0 2a 41 08 83 13 04 13 e6 e7 00 .... ae 27 7e
+    |  |                                          |
+    |  frame format: 0xA0 | 11 bit frame length   closing flag
+    opening flag
+
+The frame length counts every byte between the two flags, so once the
+header is seen the end of the frame is known without looking at the bytes
+in between.
+"""
+from typing import Iterator, List, Optional
+
+from crc16 import check_crc
+
+FLAG = 0x7E
+FRAME_FORMAT_TYPE_3 = 0xA0
+
+# Smallest frame we accept: format(2) + addresses(2) + control(1) + FCS(2)
+MIN_FRAME_LENGTH = 7
+MAX_ADDRESS_LENGTH = 4
+# flag + format(2) + addresses(2 * 4) + control(1) + HCS(2)
+MAX_HEADER_LENGTH = 1 + 2 + 2 * MAX_ADDRESS_LENGTH + 1 + 2
+COMPACT_THRESHOLD = 64 * 1024
+
+
+def frame_length(format_hi, format_lo):
+    """Return the frame length from the two frame format bytes."""
+    return ((format_hi & 0x07) << 8) | format_lo
+
+
+def header_length(buf, start=0, end=None):
+    """
+    Return the length of the frame header, opening flag and HCS included.
+
+    The destination and source addresses are 1 to 4 bytes each, the last byte
+    of an address has its least significant bit set.  Returns None if an
+    address does not end within four bytes, or before end (the end of buf
+    by default).
+
+        7e | a0 2a | 41 | 08 83 | 13 | 04 13
+        flag format  dest  src  control HCS
+    """
+    limit = len(buf) if end is None else min(end, len(buf))
+    index = start + 3
+    for _ in range(2):
+        address_end = min(index + MAX_ADDRESS_LENGTH, limit)
+        while index < address_end and not buf[index] & 0x01:
+            index += 1
+        if index >= address_end:
+            return None
+        index += 1
+    # control byte + HCS
+    return index + 3 - start
+
+
+def header_is_valid(buf, start, end):
+    """
+    Check the addresses and HCS of the frame from start to its closing flag
+    at end, which need not have arrived yet.  Only bytes before end are
+    looked at, and buf must hold them or MAX_HEADER_LENGTH bytes from start.
+    """
+    hdr_len = header_length(buf, start, end)
+    if hdr_len is None:
+        return False
+    hcs_index = start + hdr_len - 2
+    if hcs_index + 2 < end - 2:
+        return check_crc(buf, start + 1, hcs_index)
+    return True
+
+
+class HdlcFramer:
+    """
+    Extract complete HDLC frames from a growing byte buffer.
+
+    Bytes are appended with push(), or with feed() which also returns the
+    frames they complete.  next_frame() searches for the opening flag with
+    bytearray.find(), reads the length from the frame format field and jumps
+    directly to the closing flag.  Consumed bytes are only dropped from the
+    front of the buffer once more than compact_threshold of them have piled
+    up.
+
+    The scan state survives between calls: while a frame is incomplete its
+    start and expected end are kept in frame_start and frame_end, so the
+    bytes of a frame that trickles in a few at a time are not looked at
+    again until the closing flag is due.  With verify_crc set the HCS is
+    checked first, so a false header in line noise cannot hold back the
+    frames behind it for up to a full frame length.
+
+    With verify_crc set, a header with a bad HCS is not taken as the start of
+    a frame: its flag counts as a junk byte and the scan goes on right after
+    it, as the length field cannot be trusted.  A frame with a good header
+    and closing flag but a bad FCS is dropped and counted in crc_failures,
+    and the scan resumes after its opening flag too.  Either way the counts
+    do not depend on how the bytes are split into chunks.
+
+    Frames are returned as bytes, including both flags.
+    """
+
+    def __init__(self, compact_threshold=COMPACT_THRESHOLD, verify_crc=True):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.frame_start = None
+        self.frame_end = None
+        self.compact_threshold = compact_threshold
+        self.verify_crc = verify_crc
+        self.frames = 0
+        self.junk_bytes = 0
+        self.crc_failures = 0
+
+    def push(self, data):
+        self.buffer += data
+
+    def feed(self, chunk) -> List[bytes]:
+        """Append chunk and return the frames it completes."""
+        self.buffer += chunk
+        if self.frame_end is not None and self.frame_end >= len(self.buffer):
+            return []
+        return list(self)
+
+    def pending(self):
+        """Return the bytes that are not yet part of an extracted frame."""
+        return self.buffer[self.offset:]
+
+    def __len__(self):
+        return len(self.buffer) - self.offset
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def next_frame(self) -> Optional[bytes]:
+        buf = self.buffer
+        if self.frame_end is not None:
+            if self.frame_end >= len(buf):
+                return None
+            start, end = self.frame_start, self.frame_end
+            self.frame_start = self.frame_end = None
+            frame = self._check_frame(start, end)
+            if frame is not None:
+                return frame
+
+        while True:
+            start = buf.find(FLAG, self.offset)
+            if start < 0:
+                self.junk_bytes += len(buf) - self.offset
+                self.offset = len(buf)
+                self._compact()
+                return None
+
+            self.junk_bytes += start - self.offset
+            self.offset = start
+            if len(buf) - start < 3:
+                self._compact()
+                return None
+
+            format_hi = buf[start + 1]
+            if format_hi == FLAG:
+                # closing flag of one frame followed by the opening flag of the next
+                self.offset = start + 1
+                continue
+
+            length = frame_length(format_hi, buf[start + 2])
+            if format_hi & 0xF0 != FRAME_FORMAT_TYPE_3 or length < MIN_FRAME_LENGTH:
+                # Not the start of a frame, most likely the closing flag of a frame we lost the start of
+                self.offset = start + 1
+                self.junk_bytes += 1
+                continue
+
+            end = start + length + 1
+            if end >= len(buf):
+                if self.verify_crc:
+                    if len(buf) - start < MAX_HEADER_LENGTH:
+                        # wait for the header
+                        self._compact()
+                        return None
+                    if not header_is_valid(buf, start, end):
+                        self.offset = start + 1
+                        self.junk_bytes += 1
+                        continue
+                # wait for the rest of the frame
+                self._compact()
+                self.frame_start = self.offset
+                self.frame_end = self.offset + length + 1
+                return None
+
+            frame = self._check_frame(start, end)
+            if frame is not None:
+                return frame
+
+    def _check_frame(self, start, end) -> Optional[bytes]:
+        """Return the frame in buffer[start:end + 1] and move past it, None if it is not one."""
+        buf = self.buffer
+        if buf[end] != FLAG or (self.verify_crc and not header_is_valid(buf, start, end)):
+            # The length field did not lead to a closing flag, or came from a header that
+            # failed its check: not a frame, resync on the next flag
+            self.offset = start + 1
+            self.junk_bytes += 1
+            return None
+
+        if self.verify_crc and not check_crc(buf, start + 1, end - 2):
+            # The flag at end may be inside a real frame, or past several of them
+            self.crc_failures += 1
+            self.offset = start + 1
+            return None
+
+        # The closing flag may double as the opening flag of the next frame
+        self.offset = end
+        self.frames += 1
+        return bytes(buf[start:end + 1])
+
+    def _compact(self):
+        if self.offset >= self.compact_threshold:
+            del self.buffer[:self.offset]
+            self.offset = 0
@@ -0,0 +1,227 @@
+# pylint: disable=missing-docstring
+"""
+Benchmark of the framing and decoding paths on synthetic Aidon frames.
+
+A stream of List 1/2/3 frames from framegen.AidonMeter, with optional junk
+between the frames and bit errors, is fed chunk by chunk (as it comes from
+the serial port) through each path:
+
+    legacy   hdlc.contains_full_message / extract_next_message on a list of
+             ints, then hdlc() / after_hdlc() / the_payload()
+    framer   framer.HdlcFramer.feed() only
+    walk     HdlcFramer + cosem.CosemDecoder(use_plans=False)
+    plan     HdlcFramer + cosem.CosemDecoder() with compiled decode plans
+
+For every path it reports the frames found and the frames decoded without
+error per second, bytes/s over the whole run, the latency percentiles of
+each stage (per chunk for framing, per frame for decoding) and the peak
+memory allocated during a second, traced run.  Failed decodes are cheap, so
+only decoded frames/s compares paths fairly.
+
+    python han_bench.py [--seconds=N] [--speedup=N] [--junk=MAX] [--bit-errors=RATE] [--chunk=BYTES]
+                        [--paths=legacy,framer,walk,plan] [--seed=N] [--save=FILE] [--compare=FILE]
+                        [--tolerance=0.1]
+
+--save writes the results as JSON, --compare checks them against saved
+results and exits with status 1 if a path lost more than tolerance of its
+decoded frames/s.
+"""
+import contextlib
+import datetime
+import io
+import json
+import sys
+import time
+import tracemalloc
+
+import framegen
+from cosem import CosemDecoder, DecodeError
+from framer import HdlcFramer
+from hdlc import after_hdlc, contains_full_message, extract_next_message, hdlc, the_payload
+
+PATHS = ("legacy", "framer", "walk", "plan")
+PERCENTILES = (50, 90, 99)
+
+
+class StageTimer:
+    """Collect the duration of every call of one stage, in nanoseconds."""
+
+    def __init__(self):
+        self.samples = []
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter_ns()
+        yield
+        self.samples.append(time.perf_counter_ns() - start)
+
+    def summary(self):
+        if not self.samples:
+            return {}
+        samples = sorted(self.samples)
+        result = {f"p{p}_us": samples[min(len(samples) - 1, len(samples) * p // 100)] / 1000 for p in PERCENTILES}
+        result["max_us"] = samples[-1] / 1000
+        result["calls"] = len(samples)
+        return result
+
+
+def chunks_of(data, size):
+    return [data[index:index + size] for index in range(0, len(data), size)]
+
+
+def run_legacy(chunks, timers):
+    frames = errors = 0
+    ring = []
+    # the legacy functions print every frame they find, and tracebacks for the last element of a list
+    with contextlib.redirect_stdout(io.StringIO()) as printed, contextlib.redirect_stderr(printed):
+        for chunk in chunks:
+            ring.extend(chunk)
+            while True:
+                with timers["extract"].time():
+                    message = extract_next_message(ring) if contains_full_message(ring) else None
+                if message is None:
+                    break
+                frames += 1
+                with timers["payload"].time():
+                    try:
+                        data = bytearray(message)
+                        hdlc(data)
+                        after_hdlc(data)
+                        the_payload(data)
+                    except Exception:
+                        errors += 1
+            # do not let the captured output pile up
+            printed.seek(0)
+            printed.truncate()
+    return frames, errors
+
+
+def run_framed(chunks, timers, decoder=None):
+    frames = errors = 0
+    framer = HdlcFramer()
+    for chunk in chunks:
+        with timers["frame"].time():
+            complete = framer.feed(chunk)
+        frames += len(complete)
+        if decoder is None:
+            continue
+        for frame in complete:
+            with timers["decode"].time():
+                try:
+                    decoder.decode(frame)
+                except DecodeError:
+                    errors += 1
+    return frames, errors
+
+
+def run_path(path, chunks):
+    """Run one path over the chunks. Returns (frames, decode errors, seconds, {stage: StageTimer})."""
+    if path == "legacy":
+        timers = {"extract": StageTimer(), "payload": StageTimer()}
+        start = time.perf_counter()
+        frames, errors = run_legacy(chunks, timers)
+    else:
+        timers = {"frame": StageTimer()}
+        decoder = None
+        if path != "framer":
+            timers["decode"] = StageTimer()
+            decoder = CosemDecoder(use_plans=path == "plan")
+        start = time.perf_counter()
+        frames, errors = run_framed(chunks, timers, decoder)
+    return frames, errors, time.perf_counter() - start, timers
+
+
+def peak_memory(path, chunks):
+    tracemalloc.start()
+    try:
+        run_path(path, chunks)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(data, paths=PATHS, chunk_size=64):
+    chunks = chunks_of(data, chunk_size)
+    results = {}
+    for path in paths:
+        frames, errors, seconds, timers = run_path(path, chunks)
+        results[path] = {
+            "frames": frames,
+            "decode_errors": errors,
+            "seconds": seconds,
+            "frames_per_s": frames / seconds if seconds else 0.0,
+            "decoded_per_s": (frames - errors) / seconds if seconds else 0.0,
+            "bytes_per_s": len(data) / seconds if seconds else 0.0,
+            "stages": {name: timer.summary() for name, timer in timers.items()},
+            "peak_memory_bytes": peak_memory(path, chunks),
+        }
+    return results
+
+
+def print_results(results):
+    print(f"{'path':8} {'frames':>7} {'errors':>6} {'frames/s':>10} {'decoded/s':>10} {'kB/s':>9} {'peak kB':>8}  "
+          "stage latency (us)")
+    for path, result in results.items():
+        stages = "  ".join(
+            f"{name} p50={stage.get('p50_us', 0):.1f} p99={stage.get('p99_us', 0):.1f} "
+            f"max={stage.get('max_us', 0):.1f}"
+            for name, stage in result["stages"].items()
+        )
+        print(f"{path:8} {result['frames']:7d} {result['decode_errors']:6d} {result['frames_per_s']:10.0f} "
+              f"{result['decoded_per_s']:10.0f} {result['bytes_per_s'] / 1000:9.1f} "
+              f"{result['peak_memory_bytes'] / 1000:8.1f}  {stages}")
+
+
+def regressions(results, baseline, tolerance):
+    """Return the paths that lost more than tolerance of their decoded frames/s against the baseline."""
+    slower = []
+    for path, result in results.items():
+        before = baseline.get(path, {}).get("decoded_per_s")
+        if before and result["decoded_per_s"] < before * (1 - tolerance):
+            slower.append((path, before, result["decoded_per_s"]))
+    return slower
+
+
+def parse_command_line(argv):
+    options = {"seconds": "3600", "speedup": "1", "junk": "0", "bit-errors": "0", "chunk": "64",
+               "paths": ",".join(PATHS), "seed": "1", "save": None, "compare": None, "tolerance": "0.1"}
+    for argument in argv[1:]:
+        if argument in ("-h", "--help"):
+            print(__doc__.strip())
+            sys.exit(0)
+        key, _, value = argument[2:].partition("=")
+        if not argument.startswith("--") or key not in options:
+            print(f"Unknown argument: {argument}, see python han_bench.py --help")
+            sys.exit(0)
+        options[key] = value
+    unknown = set(options["paths"].split(",")) - set(PATHS)
+    if unknown:
+        print(f"Unknown paths: {', '.join(sorted(unknown))}, use {', '.join(PATHS)}")
+        sys.exit(0)
+    return options
+
+
+if __name__ == "__main__":
+    bench_options = parse_command_line(sys.argv)
+    speedup = float(bench_options["speedup"])
+    meter = framegen.AidonMeter(seed=int(bench_options["seed"]))
+    frames = [frame for _, frame in meter.frames(datetime.datetime(2024, 1, 1), float(bench_options["seconds"]),
+                                                 framegen.LIST1_INTERVAL / speedup, framegen.LIST2_INTERVAL / speedup,
+                                                 framegen.LIST3_INTERVAL / speedup)]
+    stream = framegen.stream(frames, int(bench_options["junk"]), float(bench_options["bit-errors"]),
+                             int(bench_options["seed"]))
+    print(f"{len(frames)} frames, {len(stream)} bytes, {bench_options['chunk']} byte chunks")
+
+    bench_results = benchmark(stream, bench_options["paths"].split(","), int(bench_options["chunk"]))
+    print_results(bench_results)
+
+    if bench_options["save"] is not None:
+        with open(bench_options["save"], "w", encoding="utf-8") as save_file:
+            json.dump(bench_results, save_file, indent=2)
+    if bench_options["compare"] is not None:
+        with open(bench_options["compare"], encoding="utf-8") as baseline_file:
+            slower_paths = regressions(bench_results, json.load(baseline_file), float(bench_options["tolerance"]))
+        for slow_path, before, after in slower_paths:
+            print(f"REGRESSION {slow_path}: {before:.0f} -> {after:.0f} decoded frames/s")
+        if slower_paths:
+            sys.exit(1)
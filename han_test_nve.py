@@ -2,14 +2,26 @@
 # pylint: disable=line-too-long
 # pylint: disable=unspecified-encoding
 # pylint: disable=consider-using-enumerate, missing-docstring, consider-using-f-string
+import asyncio
 import os.path
 import re
 import sys
-
-from comport import get_comport
-from han_utils import get_now, hexify, printable_byte
+import time
+
+from async_reader import read_port
+from capture import CaptureWriter
+from export import ColumnarExporter, ExporterGroup
+from comport import get_com_port_name, get_comport
+from cosem import CosemDecoder
+from delta import KEYFRAME_INTERVAL, DeltaFilter, parse_deadbands
+from framer import HdlcFramer
+from han_utils import get_now, hexify, printable_byte, set_log_level
 from hdlc import hdlc
-from reader import parse_data, read_data_from_file, read_data_from_serial_port
+from metrics import StatsReporter, install_profile_signals, serve, stop_profiling, toggle_sampler
+from reader import parse_file, print_readings, read_data_from_serial_port, read_data_threaded
+from replay import replay
+from ringbuffer import POLICIES, RING_CAPACITY, RingBuffer
+from store import SqliteStore
 
 # Revision history
 # ---------- -------------         ------------------------------------------
@@ -34,6 +46,21 @@ print(f"Elvia HAN tester version: {CURRENT_VERSION}")
 
 def parse_command_line(l_options):
     l_options["file_name"] = None
+    l_options["verify_crc"] = True
+    l_options["typed"] = False
+    l_options["async"] = False
+    l_options["replay_to"] = None
+    l_options["capture"] = None
+    l_options["export"] = None
+    l_options["store"] = None
+    l_options["ring_size"] = RING_CAPACITY
+    l_options["threads"] = 0
+    l_options["overflow"] = POLICIES[0]
+    l_options["metrics_port"] = None
+    l_options["stats_interval"] = None
+    l_options["profile"] = False
+    l_options["delta"] = None
+    l_options["deadbands"] = {}
     for argument in sys.argv:
         if argument == "--help":
             _print_help()
@@ -53,9 +80,61 @@ def parse_command_line(l_options):
             if os.path.exists(portname):
                 print(f"Using comport {portname}")
                 l_options["comport"] = portname
+        elif argument == "--no-crc-check":
+            l_options["verify_crc"] = False
+        elif argument == "--typed":
+            l_options["typed"] = True
+        elif argument == "--async":
+            l_options["async"] = True
+            l_options["typed"] = True
+        elif argument.startswith("--capture="):
+            l_options["capture"] = re.search(r"--capture=(.*)", argument)[1]
+        elif argument.startswith("--export="):
+            l_options["export"] = re.search(r"--export=(.*)", argument)[1]
+            l_options["typed"] = True
+        elif argument.startswith("--store="):
+            l_options["store"] = re.search(r"--store=(.*)", argument)[1]
+            l_options["typed"] = True
+        elif argument == "--threaded":
+            l_options["threads"] = 1
+            l_options["typed"] = True
+        elif argument.startswith("--threaded="):
+            l_options["threads"] = int(re.search(r"--threaded=(.*)", argument)[1])
+            l_options["typed"] = True
+        elif argument.startswith("--ring-size="):
+            l_options["ring_size"] = int(re.search(r"--ring-size=(.*)", argument)[1]) * 1024
+        elif argument.startswith("--overflow="):
+            l_options["overflow"] = re.search(r"--overflow=(.*)", argument)[1]
+            if l_options["overflow"] not in POLICIES:
+                print(f"Unknown overflow policy: {l_options['overflow']}, use one of {', '.join(POLICIES)}")
+                exit(0)
+        elif argument.startswith("--log-level="):
+            set_log_level(re.search(r"--log-level=(.*)", argument)[1])
+        elif argument.startswith("--metrics-port="):
+            l_options["metrics_port"] = int(re.search(r"--metrics-port=(.*)", argument)[1])
+        elif argument.startswith("--stats-interval="):
+            l_options["stats_interval"] = float(re.search(r"--stats-interval=(.*)", argument)[1])
+        elif argument == "--delta":
+            l_options["delta"] = KEYFRAME_INTERVAL
+            l_options["typed"] = True
+        elif argument.startswith("--delta="):
+            l_options["delta"] = float(re.search(r"--delta=(.*)", argument)[1])
+            l_options["typed"] = True
+        elif argument.startswith("--deadband="):
+            l_options["deadbands"].update(parse_deadbands(re.search(r"--deadband=(.*)", argument)[1]))
+        elif argument == "--profile":
+            l_options["profile"] = True
+        elif argument.startswith("--replay-to="):
+            l_options["replay_to"] = re.search(r"--replay-to=(.*)", argument)[1]
         elif argument != sys.argv[0]:
             print(f"Unknown argument: {argument}")
             exit(0)
+    if l_options["async"] and l_options["threads"]:
+        print("Use either --async or --threaded")
+        exit(0)
+    if not l_options["threads"] and (l_options["ring_size"] != RING_CAPACITY or l_options["overflow"] != POLICIES[0]):
+        print("--ring-size and --overflow only apply to --threaded")
+        exit(0)
 
 
 def _print_help():
@@ -66,18 +145,27 @@ def _print_help():
     print("--version")
     print("--comport=COMPORT")
     print("--from-file=FILE-NAME")
+    print("--no-crc-check          Decode frames even if their HCS/FCS is wrong")
+    print("--typed                 Decode to typed values instead of hex/printable strings")
+    print("--async                 Read the port with asyncio instead of polling it (implies --typed)")
+    print("--capture=FILE          Record every frame from the port with its receive time (see capture.py)")
+    print("--export=PATH           Also write the decoded values as columns (Parquet, or raw float64 files)")
+    print("--store=DB              Also store the decoded values in an SQLite database (query it with store.py)")
+    print("--threaded[=N]          Read, decode (N decoder threads) and write on separate threads (implies --typed)")
+    print("--ring-size=KB          With --threaded: bytes from the port kept while decoding lags behind (default 64)")
+    print("--overflow=POLICY       With --threaded: drop-oldest (default), drop-newest or block when the ring is full")
+    print("--log-level=LEVEL       DEBUG, INFO, WARNING, ERROR (default, or $HAN_LOG_LEVEL) or CRITICAL")
+    print("--replay-to=DIR         With --from-file: decode the binary capture on all cores into columns in DIR")
+    print("--delta[=SECS]          Only print the values that changed, all of them every SECS seconds (default 300)")
+    print("--deadband=SPEC         With --delta: ignore smaller changes, per code or unit,")
+    print("                        e.g. V:0.5,W:10,1.0.1.7.0.255:5")
+    print("--metrics-port=PORT     Serve counters and stage timings on http://127.0.0.1:PORT/metrics")
+    print("--stats-interval=SECS   Print a line with the rates and the busy share of every stage every SECS seconds")
+    print("--profile               Sample all threads from the start, written to han-profile-TIME.txt at the end")
+    print("                        (kill -USR1 PID toggles the sampler and kill -USR2 PID cProfile at runtime)")
     exit(0)
 
 
-list2_file = open("list2.txt", "a")
-list3_file = open("list3.txt", "a")
-list1_file = open("list1.txt", "a")
-log_file = open("rawlog.txt", "a")
-ringbuffer_log = open("ringbuffer.txt", "a")
-rawlogfile_binary = open("rawlogfile_binary.txt", "ab")
-rawlogfile_bytes = open("rawlogfile_bytes", "a")
-
-
 def printable(byte_data):
     outs = "%03d :" % 0
     for index in range(len(byte_data)):
@@ -97,15 +185,64 @@ if __name__ == "__main__":
     com_port = ''
     comport_path = options.get("comport")
     print(f"INPUT file: {input_file}")
-
-    if input_file is None:
+    decoder = CosemDecoder() if options["typed"] else None
+    exporters = [ColumnarExporter(options["export"])] if options["export"] is not None else []
+    if options["store"] is not None:
+        exporters.append(SqliteStore(options["store"]))
+    exporter = exporters[0] if len(exporters) == 1 else ExporterGroup(exporters) if exporters else None
+    delta = DeltaFilter(options["deadbands"], options["delta"]) if options["delta"] is not None else None
+
+    if input_file is None and not options["async"]:
         com_port = get_comport(comport_path) if input_file is None or comport_path is None else None
 
-    if input_file is not None:
-        parse_data(read_data_from_file(input_file))
-    elif com_port is not None:
-        read_data_from_serial_port(com_port)
-    else:
-        print("No file given. No port available.\nquitting.\n")
+    install_profile_signals()
+    if options["metrics_port"] is not None:
+        serve(options["metrics_port"])
+    if options["stats_interval"] is not None:
+        StatsReporter(options["stats_interval"]).start()
+    if options["profile"]:
+        toggle_sampler()
+
+    capture = CaptureWriter(options["capture"]) if options["capture"] is not None and input_file is None else None
+
+    def on_readings(frame, readings):
+        receive_time = time.time()
+        if capture is not None:
+            capture.write(frame, timestamp=receive_time)
+            capture.flush()
+        printed = readings if delta is None else delta.changes(readings, now=receive_time)
+        if printed:
+            print_readings(printed)
+        if exporter is not None:
+            exporter.add(readings, receive_time)
+
+    try:
+        if input_file is not None and options["replay_to"] is not None:
+            stats = replay([input_file], options["replay_to"], verify_crc=options["verify_crc"])
+            print(f"Replay: {stats}")
+        elif input_file is not None:
+            framer = HdlcFramer(verify_crc=options["verify_crc"])
+            parse_file(input_file, framer, decoder, exporter, delta)
+            print(f"Frames: {framer.frames}  dropped (CRC): {framer.crc_failures}  junk bytes: {framer.junk_bytes}")
+        elif options["async"]:
+            port_name = comport_path if comport_path is not None else get_com_port_name()[0]
+            asyncio.run(read_port(port_name, on_readings, verify_crc=options["verify_crc"]))
+        elif com_port is not None:
+            if options["threads"]:
+                ring = RingBuffer(options["ring_size"], options["overflow"])
+                stats = read_data_threaded(com_port, options["verify_crc"], options["threads"], capture, exporter,
+                                           ring, delta)
+                print(f"Pipeline: {stats}")
+            else:
+                read_data_from_serial_port(com_port, verify_crc=options["verify_crc"], decoder=decoder,
+                                           capture=capture, exporter=exporter, delta=delta)
+        else:
+            print("No file given. No port available.\nquitting.\n")
+    finally:
+        if exporter is not None:
+            exporter.close()
+        if capture is not None:
+            capture.close()
+        stop_profiling()
 
     print("\n")
@@ -1,5 +1,7 @@
 # pylint: disable=consider-using-enumerate, missing-docstring, consider-using-f-string
 import datetime
+import logging
+import os
 import string
 import sys
 from enum import Enum
@@ -14,55 +16,164 @@ class LogLevel(Enum):
     EXCEPTION = 101
 
 
-def logit(msg, lvl=LogLevel.DEBUG):
-    if lvl.value > LogLevel.WARNING.value:
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")
-        print(f"{lvl.name} {now}  ==:  {msg}")
-        sys.stdout.flush()
+LOGGING_LEVELS = {
+    LogLevel.DEBUG: logging.DEBUG,
+    LogLevel.INFO: logging.INFO,
+    LogLevel.WARNING: logging.WARNING,
+    LogLevel.ERROR: logging.ERROR,
+    LogLevel.CRITICAL: logging.CRITICAL,
+    LogLevel.EXCEPTION: logging.CRITICAL,
+}
+
+# Only errors and worse are shown unless HAN_LOG_LEVEL or set_log_level() says otherwise
+DEFAULT_LOG_LEVEL = "ERROR"
+logger = logging.getLogger("han")
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """Write to the sys.stdout of the moment, so redirecting stdout also redirects the log."""
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    def emit(self, record):
+        self.stream = sys.stdout
+        super().emit(record)
+        self.flush()
+
+
+class _Formatter(logging.Formatter):
+    def formatTime(self, record, datefmt=None):
+        return datetime.datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M:%S,%f")
+
+
+def set_log_level(level):
+    """Set the level by name ("DEBUG", "INFO", ...) or LogLevel."""
+    if isinstance(level, LogLevel):
+        level = LOGGING_LEVELS[level]
+    elif isinstance(level, str):
+        level = level.upper()
+    logger.setLevel(level)
+
+
+if not logger.handlers:
+    _handler = _StdoutHandler()
+    _handler.setFormatter(_Formatter("%(levelname)s %(asctime)s  ==:  %(message)s"))
+    logger.addHandler(_handler)
+    logger.propagate = False
+    set_log_level(os.environ.get("HAN_LOG_LEVEL", DEFAULT_LOG_LEVEL))
+
+
+def log_enabled(lvl=LogLevel.DEBUG):
+    """True if messages at this level are shown. Use it to skip building expensive log arguments."""
+    return logger.isEnabledFor(LOGGING_LEVELS[lvl])
+
+
+def logit(msg, *args, lvl=LogLevel.DEBUG):
+    """
+    Log msg % args at level lvl.
+
+    The arguments are only formatted if the level is enabled, so pass buffers
+    as lazy_hex(byte_data) instead of formatting them in an f-string.
+    """
+    level = LOGGING_LEVELS[lvl]
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args)
+
+
+class lazy_hex:  # pylint: disable=invalid-name
+    """Log argument that runs hexify() only when the message is actually formatted."""
+
+    __slots__ = ("byte_data", "breakit")
+
+    def __init__(self, byte_data, breakit=False):
+        self.byte_data = byte_data
+        self.breakit = breakit
+
+    def __str__(self):
+        return hexify(self.byte_data, self.breakit)
+
+
+class lazy_hexdump(lazy_hex):  # pylint: disable=invalid-name
+    """Log argument that runs hexdump() only when the message is actually formatted."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return hexdump(self.byte_data, wrap=self.breakit)
 
 
 def get_now():
     return f'{[datetime.datetime.now().strftime("%a, %d %B %Y %H:%M:%S")]}'
 
 
-def simple_print_byte_array(byte_data):
-    outs = hexify(byte_data)
-    readable_string = ""
-    for index, string_part in enumerate(byte_data, start=1):
-        if index % 20 == 0:
-            readable_string += "\n"
-        readable_string += "%-3s" % printable_byte(string_part)
+def _printable_char(one_byte):
+    pcand = chr(one_byte)
+    if pcand not in string.printable:
+        return " . "
+    if pcand in {"\t", " ", "\r", "\n", chr(0x0b)}:
+        return " "
+    return pcand
 
-    return outs
+
+# Lookup tables, built once: the printable form of each byte, that form padded
+# to the three character cells used by bytes_printable(), and a bytes.translate()
+# table mapping every byte to one printable ASCII character for hexdump().
+PRINTABLE_BYTES = tuple(_printable_char(one_byte) for one_byte in range(256))
+PRINTABLE_CELLS = tuple("%-3s" % printable for printable in PRINTABLE_BYTES)
+DUMP_TABLE = bytes(one_byte if 0x20 <= one_byte < 0x7F else ord(".") for one_byte in range(256))
+BREAK_EVERY = 20
+
+
+def simple_print_byte_array(byte_data):
+    return hexify(byte_data)
 
 
 def printable_byte(one_byte):
-    pcand = chr(one_byte)
-    return_printable = " . "
-    if pcand in string.printable:
-        return_printable = pcand
-        if return_printable in {"\t", " ", "\r", "\n", chr(0x0b)}:
-            return_printable = " "
-    return return_printable
+    return PRINTABLE_BYTES[one_byte]
 
 
 def hexify(byte_data, breakit=False):
-    hex_string = ""
-    for index in range(len(byte_data)):
-        byte_as_hex = " %02x" % (byte_data[index])
-        if breakit and (index + 1) % 20 == 0:
-            byte_as_hex += "\n"
-        hex_string += byte_as_hex
-    return hex_string
+    """Return " xx xx xx ...", with a newline after every 20th byte if breakit."""
+    data = bytes(byte_data)
+    if not data:
+        return ""
+    if not breakit:
+        return " " + data.hex(" ")
+    lines = [" " + data[index:index + BREAK_EVERY].hex(" ") for index in range(0, len(data), BREAK_EVERY)]
+    return "\n".join(lines) + ("\n" if len(data) % BREAK_EVERY == 0 else "")
 
 
 def bytes_printable(byte_data, breakit=False):
-    printable_string = ""
-    for index, the_byte in enumerate(byte_data, start=1):
-        if breakit and index % 20 == 0:
-            printable_string += "\n"
-        printable_string += "%-3s" % printable_byte(the_byte)
-    return printable_string
+    """Return each byte as a three character cell, with a newline before every 20th byte if breakit."""
+    cells = PRINTABLE_CELLS.__getitem__
+    if not breakit:
+        return "".join(map(cells, byte_data))
+    # the first line is one byte short, as it always was
+    first = BREAK_EVERY - 1
+    parts = ["".join(map(cells, byte_data[:first]))]
+    parts.extend("".join(map(cells, byte_data[index:index + BREAK_EVERY]))
+                 for index in range(first, len(byte_data), BREAK_EVERY))
+    return "\n".join(parts)
+
+
+def hexdump(byte_data, width=16, wrap=True):
+    """
+    Return a classic hex dump: offset, hex bytes and the printable ASCII column.
+
+        0000  7e a0 2a 41 08 83 13 04 13 e6 e7 00 0f 40 00 00  |~.*A.........@..|
+
+    With wrap=False everything goes on one line.
+    """
+    data = bytes(byte_data)
+    if not wrap:
+        return f"0000  {data.hex(' ')}  |{data.translate(DUMP_TABLE).decode('ascii')}|"
+    hex_width = width * 3 - 1
+    return "\n".join(
+        f"{index:04x}  {data[index:index + width].hex(' '):<{hex_width}}  "
+        f"|{data[index:index + width].translate(DUMP_TABLE).decode('ascii')}|"
+        for index in range(0, len(data), width)
+    )
 
 
 def find_start(byte_data):
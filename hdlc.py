@@ -2,11 +2,13 @@
 import contextlib
 import datetime
 import traceback
+from array import array
 from enum import Enum
 from typing import Tuple
 
 from aidon_date_time import obis_bytes_to_datetime
-from han_utils import LogLevel, bytes_printable, hexify, logit
+from han_utils import LogLevel, bytes_printable, hexify, lazy_hex, logit
+from obis_registry import REGISTRY, pack_obis
 
 
 class DataType(Enum):
@@ -48,24 +50,8 @@ class PhysicalUnits(Enum):
     VOLTAGE = 35
 
 
-obis = {
-    "1.0.1.7.0.255.": "Active power+(Q1+Q4)",
-    "1.0.2.7.0.255.": "Active power-(Q1+Q4)",
-    "1.0.3.7.0.255.": "Reactive power+ (Q1+Q2)",
-    "1.0.4.7.0.255.": "Reactive power- (Q1+Q2)",
-    "1.0.31.7.0.255.": "IL1",
-    "1.0.51.7.0.255.": "IL2",
-    "1.0.71.7.0.255.": "IL3",
-    "1.0.32.7.0.255.": "UL1",
-    "1.0.52.7.0.255.": "UL2",
-    "1.0.72.7.0.255.": "UL3",
-    "0.0.1.0.0.255.": "Clock",
-    "1.0.1.8.0.255.": "A+cumul",
-    "1.0.2.8.0.255.": "A-cumul",
-    "1.0.3.8.0.255.": "R+cumul",
-    "1.0.4.8.0.255.": "A-cumul",
-    "1.1.0.2.129.255.": "OBIS list version id",
-}
+# "a.b.c.d.e.f." -> name, for the text decoder and older callers
+obis = {"%d.%d.%d.%d.%d.%d." % entry.obis: entry.name for entry in REGISTRY.entries.values()}
 
 
 def oct_2_obis(oct):
@@ -73,15 +59,13 @@ def oct_2_obis(oct):
 
 
 def get_obis(obis_bytes):
-    logit(f"get_obis()         {hexify(obis_bytes)}")
-    obis_code = ''
-    obis_text = ''
-
-    for obis_byte in obis_bytes:
-        obis_code += "%d." % obis_byte
-
-    obis_text += "%15s %24s" % (obis_code, oct_2_obis(obis_code))
-    logit(f"OBIS: {obis_text}", LogLevel.DEBUG)
+    logit("get_obis()         %s", lazy_hex(obis_bytes))
+    if len(obis_bytes) == 6:
+        obis_code = "%d.%d.%d.%d.%d.%d." % tuple(obis_bytes)
+    else:
+        obis_code = "".join("%d." % obis_byte for obis_byte in obis_bytes)
+    obis_text = "%15s %24s" % (obis_code, REGISTRY.name(obis_bytes))
+    logit("OBIS: %s", obis_text)
     return obis_text
 
 
@@ -93,78 +77,191 @@ def bytes_to_number(byte_data):
     return retval
 
 
+# What a piece of a record is, to render it: the DLMS type of a basic value, or one of these
+PIECE_STRUCT = DataType.STRUCTURE.value
+PIECE_NESTED = 0x70  # the header of a structure in the structure (the scaler_unit)
+PIECE_END = 0x71  # what is left after the last record, FCS and closing flag
+PIECE_CLOCK = 0x80  # flag: the piece is the date-time octet-string of a clock record
+PIECE_END_BITS = 24  # a piece is stored as kind << PIECE_END_BITS | where it ends in the payload
+PIECE_END_MASK = (1 << PIECE_END_BITS) - 1
+NO_OBIS = -1
+NO_VALUE = -(1 << 63)
+NUMBER_PIECES = frozenset((DataType.DOUBLE_LONG_UNSIGNED.value, DataType.LONG.value, DataType.LONG_UNSIGNED.value))
+
+
+def piece_number(kind, raw):
+    if kind == DataType.INTEGER.value:
+        return int.from_bytes(raw[1:2], "big", signed=True)
+    if kind == DataType.ENUM.value:
+        return raw[1]
+    return bytes_to_number(raw[1:])
+
+
+def render_piece(kind, payload, start, end):
+    """Return (printable, decoded) of the piece in payload[start:end]."""
+    if kind & PIECE_CLOCK:
+        clock = obis_bytes_to_datetime(payload[start:end])
+        return clock, clock
+    raw = payload[start:end]
+    if kind == PIECE_STRUCT:
+        return bytes_printable(raw), ""
+    if kind == PIECE_NESTED:
+        return "    ", ""
+    if kind == PIECE_END:
+        return "hdlc", "ending"
+    if kind == DataType.OCTET_STRING.value:
+        return get_obis(raw[2:8]), ""
+    if kind == DataType.VISIBLE_STRING.value:
+        return bytes_printable(raw).replace(" ", ""), ""
+    value = piece_number(kind, raw)
+    if kind == DataType.ENUM.value:
+        try:
+            return f" {PhysicalUnits(value)}", value
+        except ValueError:
+            return f" unit {value}", value
+    return "%5d" % value, value
+
+
 class OneList:
-    def __init__(self):
-        self.records = []
-        self.last_row = None
+    """
+    The records of one list, as decoded by the_payload().
+
+    The list keeps one copy of the payload and, in arrays, the kind of every
+    piece of the records (a structure header, an OBIS code, a value, a
+    scaler_unit ...) together with where it ends in the payload, where the
+    pieces of every record end, and the OBIS code (packed into an int) and
+    the first number of every record.  Nothing else is stored: the hex and printable
+    text of a record is built from the payload when it is printed, so a
+    list costs little more than its payload while it waits to be exported.
+    """
+
+    __slots__ = ("payload", "pieces", "record_ends", "obis_codes", "values", "hdlc_header", "hdlc_end")
+
+    def __init__(self, payload=b""):
+        self.payload = bytes(payload)
+        self.pieces = array("I")
+        self.record_ends = array("I")
+        self.obis_codes = array("q")
+        self.values = array("q")
         self.hdlc_header = ''
         self.hdlc_end = ''
 
     def add_row(self, row):
-        self.last_row = row
-        self.records.append(row)
+        row.index = len(self.record_ends)
+        self.record_ends.append(len(self.pieces))
+        self.obis_codes.append(row.obis)
+        self.values.append(row.value)
+
+    @property
+    def last_row(self):
+        return OneRecord.view(self, len(self.record_ends) - 1) if self.record_ends else None
 
     def get_last_row(self):
         return self.last_row
 
+    def __len__(self):
+        return len(self.record_ends)
+
+    @property
+    def records(self):
+        return [OneRecord.view(self, index) for index in range(len(self.record_ends))]
+
     def __str__(self) -> str:
-        header = f"\nList with {len(self.records)} records\n"
-        body = ""
-        index = 0
-        for record in self.records:
-            body += "%3d: %s\n" % (index, record)  # f"{index}: {record}\n"
-            index += 1
-        return header + body
+        header = f"\nList with {len(self.record_ends)} records\n"
+        return header + "".join("%3d: %s\n" % (index, record) for index, record in enumerate(self.records))
 
 
 class OneRecord:
+    """
+    One record of a OneList: the pieces between first_piece and the end of the record in the list.
+
+    hex, printable and decoded are rendered from the payload of the list.
+    """
+
+    __slots__ = ("parent", "index", "first_piece", "has_datetime", "obis", "value")
+
     def __init__(self):
-        self.hex = ''
-        self.printable = ''
-        self.decoded = ''
         self.parent = None
+        self.index = None
+        self.first_piece = 0
         self.has_datetime = False
+        self.obis = NO_OBIS
+        self.value = NO_VALUE
+
+    @classmethod
+    def view(cls, parent, index):
+        record = cls()
+        record.parent = parent
+        record.index = index
+        record.first_piece = parent.record_ends[index - 1] if index else 0
+        record.obis = parent.obis_codes[index]
+        record.value = parent.values[index]
+        return record
 
     def set_parent(self, parent):
         self.parent = parent
+        self.first_piece = len(parent.pieces)
 
     def get_parent(self):
         return self.parent
 
-    def add_data(self, hex_string, ascii_string, value, byte_data=None):
-        logit(">>>>> Add Data <<<<<")
-        bd = []
-        if byte_data is not None:
-            bd = byte_data
-        logit(
-            f"OneRecord.add_data -> \n\thxs: {hex_string}### asc: {ascii_string}###val: {value} id: {self.has_datetime}", lvl=LogLevel.WARNING)
-        logit(f"hasdate: {self.has_datetime}, bytes: {hexify(bd[:25])}", LogLevel.WARNING)
-
-        clock_str = ''
-        if self.has_datetime and byte_data is not None and len(byte_data) >= 12 and byte_data[0] == 9 and byte_data[1] == 12:
-            print("Extracting previuously detected clock")
-            # previous data was probably OBIS code for time, thus this is the actual time....
-            clock_str = obis_bytes_to_datetime(byte_data)
-            print(clock_str)
-
-        self.hex += f"    {hex_string}"
-
-        if clock_str != '':
-            ascii_string = clock_str
-            value = clock_str
-
-        if "Clock" in ascii_string:
-            print("Found Clock")
+    def add_piece(self, kind, byte_data, value=None):
+        """
+        Add the piece of the record that ends where byte_data, the rest of the payload, starts.
+
+        value is the number of a number piece, if the caller has it.
+        """
+        parent = self.parent
+        end = len(parent.payload) - len(byte_data)
+        start = parent.pieces[-1] & PIECE_END_MASK if len(parent.pieces) > self.first_piece else self._start()
+        if kind == DataType.OCTET_STRING.value:
+            obis_bytes = parent.payload[start + 2:start + 8]
+            if self.obis == NO_OBIS and end - start == 8:
+                self.obis = pack_obis(obis_bytes)
+        elif kind in NUMBER_PIECES and self.value == NO_VALUE:
+            self.value = value if value is not None else piece_number(kind, parent.payload[start:end])
+        if self.has_datetime and kind == DataType.OCTET_STRING.value and end - start == 14 \
+                and parent.payload[start + 1] == 12:
+            # an earlier piece was the OBIS code of the clock, this one is the time
+            logit("Extracting previously detected clock", lvl=LogLevel.INFO)
+            kind |= PIECE_CLOCK
+        elif kind == DataType.OCTET_STRING.value and not self.has_datetime and "Clock" in REGISTRY.name(obis_bytes):
+            logit("Found Clock", lvl=LogLevel.INFO)
             self.has_datetime = True
-
-        self.printable += f"    {ascii_string}"
-        self.printable = self.printable.replace("\n", "")
-        self.decoded += f" {value} "
-        self.decoded = self.decoded.replace("\n", "")
+        parent.pieces.append(kind << PIECE_END_BITS | end)
+
+    def _start(self):
+        """Where the first piece of the record starts in the payload."""
+        return self.parent.pieces[self.first_piece - 1] & PIECE_END_MASK if self.first_piece else 0
+
+    def _pieces(self):
+        parent = self.parent
+        last_piece = parent.record_ends[self.index] if self.index is not None else len(parent.pieces)
+        start = self._start()
+        for piece in parent.pieces[self.first_piece:last_piece]:
+            end = piece & PIECE_END_MASK
+            yield piece >> PIECE_END_BITS, start, end
+            start = end
+
+    @property
+    def hex(self):
+        payload = self.parent.payload
+        return "".join(f"    {hexify(payload[start:end])}" for _, start, end in self._pieces())
+
+    @property
+    def printable(self):
+        payload = self.parent.payload
+        return "".join(f"    {render_piece(kind, payload, start, end)[0]}"
+                       for kind, start, end in self._pieces()).replace("\n", "")
+
+    @property
+    def decoded(self):
+        payload = self.parent.payload
+        return "".join(f" {render_piece(kind, payload, start, end)[1]} "
+                       for kind, start, end in self._pieces()).replace("\n", "")
 
     def __str__(self) -> str:
         return "%-96s  %40s" % (self.hex, self.printable)
-        # return f"{self.hex}   {self.printable}   {self.decoded}"
 
 
 def whatsit(data) -> Tuple[DataType, int]:
@@ -181,7 +278,7 @@ def whatsit(data) -> Tuple[DataType, int]:
         elif complex_data_type in [DataType.LONG]:
             noof_elements = 2
         else:
-            logit(f"Whatsit else....: {complex_data_type.name}")
+            logit("Whatsit else....: %s", complex_data_type.name)
             noof_elements = data[1]
     except ValueError as value_error:
         pass
@@ -244,8 +341,8 @@ def the_payload(byte_data):
     logit(">>> the_payload()")
     retval = "Xxxx>"
     what, noof_records = whatsit(byte_data)
-    logit(f"What: {what} - Noof Records: {noof_records}")
-    logit(f"{hexify(byte_data[:2])}")
+    logit("What: %s - Noof Records: %s", what, noof_records)
+    logit("%s", lazy_hex(byte_data[:2]))
 
     retval += hexify(byte_data[:2])
     retval += "\n"
@@ -281,118 +378,52 @@ def the_payload(byte_data):
     #  ff 10 00 00 02 02 0f ff 16 21 02 03 09 06 01 00 20 07 00 ff
     #  12 09 6b 02 02 0f ff 16 23 73 00 7e
 
-    current_list = OneList()
+    current_list = OneList(byte_data)
     for row_num in range(noof_records):
         the_row = OneRecord()
         the_row.set_parent(current_list)
 
-        logit(f"Processing ROW {row_num}")
+        logit("Processing ROW %s", row_num)
         decode_row(byte_data, the_row)
-        logit(f"<<ROW>> {the_row}")
+        logit("<<ROW>> %s", the_row)
         current_list.add_row(the_row)
-        logit(f"XXXXXXXX\n\nROW/record {row_num} is processed\n\n\n\n")
+        logit("XXXXXXXX\n\nROW/record %s is processed\n\n\n\n", row_num)
 
     print(f"======= {datetime.datetime.now()} ===============")
     print(current_list)
     return "<Done."
 
 
-def extract_visible_string(byte_data):
-    logit("Visible string")
-    _, length = whatsit(byte_data)
-    # code, length, <length bytes of data> ==> length + 2
-    hstr = hexify(byte_data[: length + 2])
-    str_str = bytes_printable(byte_data[: length + 2])
-    str_str = str_str.replace(' ', '')
-    del byte_data[: length + 2]
-    return hstr, str_str, ''
-
-
-def extract_octet_string(byte_data):
-    logit(f"Octet string> {hexify(byte_data[:10])}")
-    _, length = whatsit(byte_data)
-    # code, length, <length bytes of data> ==> length + 2
-    hstr = hexify(byte_data[: length + 2])
-    obis_bytes = byte_data[2:8]
-    logit(f"obis_bytes: {hexify(obis_bytes)}")
-    str_str = get_obis(obis_bytes)
-    del byte_data[: length + 2]
-    return hstr, str_str, ''
-
-
-def extract_double(byte_data):
-    logit("\n\ndouble - four bytes")
-    retval_hex = hexify(byte_data[:5])
-    # byte_data[0] is the "double"-marker
-    retval_v = bytes_to_number(byte_data[1:5])
-    retval_str = "%5d" % (retval_v)
-    del byte_data[:5]
-    return retval_hex, retval_str, retval_v
-
-
-def extract_int(byte_data):
-    retval_hex = hexify(byte_data[:2])
-    retval_v = byte_data[1]
-    retval_str = "%5d" % (retval_v)
-    del byte_data[:2]
-    return retval_hex, retval_str, byte_data[1]
-
-
-def extract_long(byte_data):
-    retval_hex = hexify(byte_data[:3])
-    # retval_v = (byte_data[1] << 8) + byte_data[2]
-    retval_v = bytes_to_number(byte_data[1:3])
-    retval_str = "%5d" % (retval_v)
-    del byte_data[:3]
-    return retval_hex, retval_str, retval_v
-
-
-def extract_enum(byte_data):
-    retval_hex = hexify(byte_data[:2])
-    retval_str = f" {PhysicalUnits(byte_data[1])}"
-
-    del byte_data[:2]
-    return retval_hex, retval_str, ''
+# bytes taken by the basic types of a fixed size, type included
+FIXED_SIZES = {
+    DataType.DOUBLE_LONG_UNSIGNED: 5,
+    DataType.INTEGER: 2,
+    DataType.LONG: 3,
+    DataType.LONG_UNSIGNED: 3,
+    DataType.ENUM: 2,
+}
 
 
 def extract_next_basic_data(byte_data, current_row):
-    retval_h = ""
-    retval_s = ""
-    retval_v = ""
-    logit(f"About to extract data from: {hexify(byte_data)}")
+    logit("About to extract data from: %s", lazy_hex(byte_data))
     data_type = DataType(byte_data[0])
-    logit(f"Found data type: {data_type.name}")
-    match data_type:
-        case DataType.OCTET_STRING:
-            retval_h, retval_s, retval_v = extract_octet_string(byte_data)
-            logit(f"octet string, bytes...{byte_data[:25]}")
-        case DataType.VISIBLE_STRING:
-            retval_h, retval_s, retval_v = extract_visible_string(byte_data)
-        case DataType.DOUBLE_LONG_UNSIGNED:
-            retval_h, retval_s, retval_v = extract_double(byte_data)
-        case DataType.INTEGER:
-            retval_h, retval_s, retval_v = extract_int(byte_data)
-        case DataType.LONG:
-            retval_h, retval_s, retval_v = extract_long(byte_data)
-        case DataType.LONG_UNSIGNED:
-            retval_h, retval_s, retval_v = extract_long(byte_data)
-        case DataType.ENUM:
-            retval_h, retval_s, retval_v = extract_enum(byte_data)
-        case _:
-            logit("NEXXXXT data type was something else:")
-            if len(byte_data) == 3 and byte_data[2] == 0x7e:
-                logit("nexxxxxt / HDLC")
-                return DataType.HDLC
-            else:
-                logit(f"get_next_basic_data  type is: {DataType(byte_data[0])} because: {hexify(byte_data[:10])}")
-                return data_type
-
-    if byte_data:
-        logit(f"octet string, bytes...{byte_data[:25]}")
+    logit("Found data type: %s", data_type.name)
+    if data_type in (DataType.OCTET_STRING, DataType.VISIBLE_STRING):
+        # code, length, <length bytes of data> ==> length + 2
+        size = byte_data[1] + 2
+    elif data_type in FIXED_SIZES:
+        size = FIXED_SIZES[data_type]
     else:
-        logit("No byte data")
-    current_row.add_data(retval_h, retval_s, retval_v, byte_data=byte_data)
-    logit(f"Basic data ({data_type.name}): hex:{retval_h}  <===> str:{retval_s}")
+        logit("NEXXXXT data type was something else:")
+        if len(byte_data) == 3 and byte_data[2] == 0x7e:
+            logit("nexxxxxt / HDLC")
+            return DataType.HDLC
+        logit("get_next_basic_data  type is: %s because: %s", data_type, lazy_hex(byte_data[:10]))
+        return data_type
+
+    del byte_data[:size]
+    current_row.add_piece(data_type.value, byte_data)
+    logit("Basic data (%s), %d bytes", data_type.name, size)
     return data_type
 
 
@@ -400,23 +431,21 @@ def decode_struct(byte_data, current_row, depth=0):
     data_type, noof_elements = whatsit(byte_data)
     if data_type == DataType.HDLC:
         current_row.get_parent().hdlc_end = byte_data
-        logit(f"x123row now: {current_row}")
+        logit("x123row now: %s", current_row)
         return DataType.HDLC
 
-    retval_hex = hexify(byte_data[:2])
-    retval_str = bytes_printable(byte_data[:2])
-    current_row.add_data(retval_hex, retval_str, '')
     del byte_data[:2]
+    current_row.add_piece(PIECE_STRUCT, byte_data)
 
-    logit(f">>> decode_struct() {noof_elements} elems, depth={depth} .>>>  {hexify(byte_data[:25], breakit=False)}")
+    logit(">>> decode_struct() %s elems, depth=%s .>>>  %s", noof_elements, depth, lazy_hex(byte_data[:25]))
 
     for struct_part_no in range(noof_elements):
-        logit(f"struct part: {struct_part_no}")
+        logit("struct part: %s", struct_part_no)
         next_data_type = extract_next_basic_data(byte_data, current_row)
 
         if next_data_type == DataType.STRUCTURE:
-            current_row.add_data(hexify(byte_data[:2]), '    ', '')
             del byte_data[:2]
+            current_row.add_piece(PIECE_NESTED, byte_data)
             depth += 1
             data_type = decode_struct(byte_data, current_row, depth=depth)
             if data_type == DataType.HDLC:
@@ -425,35 +454,35 @@ def decode_struct(byte_data, current_row, depth=0):
                 return DataType.HDLC
             depth -= 1
         elif next_data_type == DataType.HDLC:
-            logit("ENd of list: {byte_data}")
+            logit("ENd of list: %s", byte_data)
             break
         else:
-            logit(f"Just handled data of type: {next_data_type.name}")
+            logit("Just handled data of type: %s", next_data_type.name)
 
-    logit(f"<<<<< decode_struct() - depth:{depth}")
+    logit("<<<<< decode_struct() - depth:%s", depth)
     return None
 
 
 def decode_row(byte_data, current_row):
-    logit(f">>> decode_row(): {hexify(byte_data, breakit=False)}....")
+    logit(">>> decode_row(): %s....", lazy_hex(byte_data))
     try:
         row_type, noof_elems = whatsit(byte_data)
-        logit(f"it is a {row_type}, of {noof_elems} items")
+        logit("it is a %s, of %s items", row_type, noof_elems)
 
         if row_type == DataType.STRUCTURE:
             for j in range(noof_elems):
-                logit(f">>>>>>   Starting on ROW part: {j}")
+                logit(">>>>>>   Starting on ROW part: %s", j)
                 data_type = decode_struct(byte_data, current_row)
                 if data_type == DataType.HDLC or data_type is None:
                     return current_row
                 j += 1
-                logit(f">>>>>>   Finished on ROW part: {j}")
+                logit(">>>>>>   Finished on ROW part: %s", j)
         elif row_type == DataType.UNKNOWN and len(byte_data) == 3 and byte_data[2] == 0x7e:
             # This is what is left when the last element of the last struct has been extracted
-            logit(f"End of list for: {hexify(byte_data)}")
-            current_row.add_data(hexify(byte_data), 'hdlc', 'ending')
+            logit("End of list for: %s", lazy_hex(byte_data))
+            current_row.add_piece(PIECE_END, b"")
         else:
-            logit(f"Done: {hexify(byte_data)}")
+            logit("Done: %s", lazy_hex(byte_data))
 
     except Exception as ee_ee:
         print("ROW/RESULT===>")
@@ -480,6 +509,9 @@ def contains_full_message(byte_data):
 
     The lists start and end with 0x7e.
 
+    Only the legacy path of han_bench.py uses this, as the baseline the
+    framer is measured against; the readers frame with framer.HdlcFramer.
+
     Parameters
     ----------
     byte_data : _type_
@@ -555,6 +587,8 @@ def find_start(byte_data):
     """
     Remove everything from byte stream leading up to the first 0x7e.
 
+    Part of the han_bench.py legacy baseline, see contains_full_message().
+
     :param byte_data:
     :return:
     """
@@ -575,6 +609,11 @@ def find_start(byte_data):
 
 
 def extract_next_message(byte_data):
+    """
+    Pop the next list, from 0x7e to 0x7e, off the front of byte_data.
+
+    Part of the han_bench.py legacy baseline, see contains_full_message().
+    """
     retval = []
 
     start_located = False
@@ -591,7 +630,7 @@ def extract_next_message(byte_data):
                 the_count += 1
 
             retval.append(the_byte)
-    logit("Extracted message length: %d" % len(retval))
+    logit("Extracted message length: %d", len(retval))
     print(f"List: {which_list(retval)}")
 
     return retval
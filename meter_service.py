@@ -0,0 +1,230 @@
+# pylint: disable=missing-docstring
+"""
+Read many HAN ports concurrently in one process.
+
+Every port gets its own framer and decoder (a HanProtocol) on one asyncio
+event loop.  Decoded lists are tagged with the port and with the meter id
+(OBIS 0.0.96.1.0.255, or the code its vendor uses) and handed to one shared
+sink.  List 1 does not carry the meter id, its readings are tagged with the
+id last seen on the port.
+
+    python meter_service.py /dev/ttyUSB*
+    python meter_service.py --ports="/dev/ttyUSB*,/dev/ttyACM0" --capture=rig.hancap
+    python meter_service.py /dev/ttyUSB* --delta=300 --deadband=V:0.5,W:10
+    python meter_service.py /dev/ttyUSB* --aggregate=aggregates.csv
+    python meter_service.py /dev/ttyUSB* --store=han.db
+
+With --delta only the readings that changed since the last list of the meter
+reach the sink, and every meter sends all of them every keyframe interval
+(see delta.py).  With --aggregate the values of every meter are also
+aggregated into 1 s, 1 min and 15 min windows (see aggregate.py) and the
+windows appended to the given CSV file.  With --store all values are also
+stored in an SQLite database (see store.py).  Both go by meter id, and by
+the port name until the first list with the meter id has come in.
+"""
+import asyncio
+import glob
+import os
+import sys
+import time
+
+from aggregate import CSV_HEADER, Aggregator, csv_line
+from async_reader import open_han_port
+from capture import CaptureWriter
+from delta import KEYFRAME_INTERVAL, DeltaFilter, parse_deadbands
+from han_utils import LogLevel, get_now, logit
+from obis_registry import REGISTRY
+from sinks import get_sink
+from store import SqliteStore, meter_name
+
+
+def expand_ports(patterns):
+    """Expand glob patterns into a sorted list of port names, without duplicates."""
+    port_names = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        port_names.extend(name for name in matches if name not in port_names)
+    return port_names
+
+
+class MeterPort:
+    """The state of one port: its name, id, protocol and the meter id last seen on it."""
+
+    def __init__(self, port_id, name):
+        self.port_id = port_id
+        self.name = name
+        self.meter_id = None
+        self.protocol = None
+        self.frames = 0
+
+
+def print_sink(port, frame, readings):
+    values = "  ".join(f"{reading.obis_code}={reading.value}" for reading in readings
+                       if isinstance(reading.value, (int, float)))
+    print(f"{get_now()} {port.name} {port.meter_id} {values}")
+
+
+def capture_frames(capture):
+    """Return an on_frame callback that records each frame in the capture, tagged with the port id."""
+    def record_frame(port, frame):
+        capture.write(frame, port.port_id)
+    return record_frame
+
+
+def meter_key(port):
+    """The meter id of the port as text, its name until the id is known."""
+    return port.name if port.meter_id is None else meter_name(port.meter_id)
+
+
+def aggregate_sink(aggregator, sink):
+    """Return a sink that adds every list to the aggregator, by meter id, before passing it on."""
+    def aggregate_and_forward(port, frame, readings):
+        aggregator.add(readings, time.time(), meter_key(port))
+        sink(port, frame, readings)
+    return aggregate_and_forward
+
+
+def store_sink(store, sink):
+    """Return a sink that stores every list by meter id."""
+    def store_and_forward(port, frame, readings):
+        store.add(readings, time.time(), meter_key(port))
+        sink(port, frame, readings)
+    return store_and_forward
+
+
+def open_aggregates(file_name):
+    """Return an Aggregator appending its windows as CSV lines to file_name."""
+    new_file = not os.path.exists(file_name) or os.path.getsize(file_name) == 0
+    out = get_sink(file_name)
+    if new_file:
+        out.write(CSV_HEADER)
+    return Aggregator(lambda aggregate: out.write(csv_line(aggregate)))
+
+
+def port_delta_sink(delta, sink):
+    """Return a sink that passes on only the readings that changed for the meter, and nothing if none did."""
+    def changes_only(port, frame, readings):
+        changed = delta.changes(readings, meter_key(port))
+        if changed:
+            sink(port, frame, changed)
+    return changes_only
+
+
+class MeterService:
+    """
+    Open the given ports and feed the lists from all of them to sink(port, frame, readings).
+
+    on_frame(port, frame), if given, gets every frame before it is decoded, so
+    a capture also holds the frames that could not be decoded.
+
+    A port that fails to open or is closed later is logged and left alone,
+    the others keep running.  run() returns when all ports are closed.
+    """
+
+    def __init__(self, port_names, sink=print_sink, verify_crc=True, on_frame=None):
+        self.ports = [MeterPort(port_id, name) for port_id, name in enumerate(port_names)]
+        self.sink = sink
+        self.verify_crc = verify_crc
+        self.on_frame = on_frame
+
+    def _on_readings(self, port, frame, readings):
+        port.frames += 1
+        for reading in readings:
+            if reading.obis in REGISTRY.meter_id_codes:
+                port.meter_id = reading.value
+                break
+        self.sink(port, frame, readings)
+
+    async def _serve(self, port):
+        try:
+            _, port.protocol = await open_han_port(
+                port.name,
+                on_readings=lambda frame, readings: self._on_readings(port, frame, readings),
+                verify_crc=self.verify_crc,
+                on_frame=(lambda frame: self.on_frame(port, frame)) if self.on_frame is not None else None,
+            )
+        except Exception as ex:
+            logit("Could not open %s: %s", port.name, ex, lvl=LogLevel.ERROR)
+            return
+
+        # Frames go to the callback, the iterator only ends when the port is closed
+        async for _ in port.protocol:
+            pass
+
+    async def run(self):
+        await asyncio.gather(*(self._serve(port) for port in self.ports))
+
+    def stats(self):
+        return [
+            (port.name, port.meter_id, port.frames,
+             port.protocol.framer.crc_failures if port.protocol is not None else 0)
+            for port in self.ports
+        ]
+
+
+def parse_command_line(argv):
+    patterns = []
+    capture_name = None
+    keyframe_interval = None
+    deadbands = {}
+    aggregate_name = None
+    store_name = None
+    for argument in argv[1:]:
+        if argument.startswith("--ports="):
+            patterns.extend(part for part in argument[len("--ports="):].split(",") if part)
+        elif argument.startswith("--capture="):
+            capture_name = argument[len("--capture="):]
+        elif argument.startswith("--aggregate="):
+            aggregate_name = argument[len("--aggregate="):]
+        elif argument.startswith("--store="):
+            store_name = argument[len("--store="):]
+        elif argument == "--delta":
+            keyframe_interval = KEYFRAME_INTERVAL
+        elif argument.startswith("--delta="):
+            keyframe_interval = float(argument[len("--delta="):])
+        elif argument.startswith("--deadband="):
+            deadbands.update(parse_deadbands(argument[len("--deadband="):]))
+        elif argument.startswith("--"):
+            print(f"Unknown argument: {argument}")
+            sys.exit(0)
+        else:
+            patterns.append(argument)
+    delta = DeltaFilter(deadbands, keyframe_interval) if keyframe_interval is not None else None
+    return expand_ports(patterns), capture_name, delta, aggregate_name, store_name
+
+
+if __name__ == "__main__":
+    port_list, capture_file, port_delta, aggregate_file, store_file = parse_command_line(sys.argv)
+    if not port_list:
+        print("No ports given.\nUsage: python meter_service.py /dev/ttyUSB* | --ports=PATTERN[,PATTERN...] "
+              "[--capture=FILE] [--delta[=SECS]] [--deadband=SPEC] [--aggregate=FILE.csv] [--store=DB]")
+        sys.exit(0)
+
+    print(f"Reading {len(port_list)} ports: {', '.join(f'{i}={name}' for i, name in enumerate(port_list))}")
+    service_capture = CaptureWriter(capture_file) if capture_file is not None else None
+    service_sink = print_sink if port_delta is None else port_delta_sink(port_delta, print_sink)
+    aggregator = open_aggregates(aggregate_file) if aggregate_file is not None else None
+    if aggregator is not None:
+        service_sink = aggregate_sink(aggregator, service_sink)
+    service_store = SqliteStore(store_file) if store_file is not None else None
+    if service_store is not None:
+        service_sink = store_sink(service_store, service_sink)
+    service = MeterService(port_list, service_sink,
+                           on_frame=capture_frames(service_capture) if service_capture is not None else None)
+    try:
+        asyncio.run(service.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if service_capture is not None:
+            service_capture.close()
+        if aggregator is not None:
+            aggregator.flush()
+        if service_store is not None:
+            service_store.close()
+    for name, meter_id, frames, crc_failures in service.stats():
+        print(f"{name}: meter {meter_id}, {frames} frames, {crc_failures} CRC failures")
+    if port_delta is not None:
+        print(f"Delta: {port_delta.stats()}")
+    if aggregator is not None:
+        print(f"Aggregated: {aggregator.stats()}")
@@ -0,0 +1,439 @@
+# pylint: disable=missing-docstring
+"""
+Counters and timing histograms for every stage of reading the HAN port.
+
+    bytes read --> framing --> decoding (per list) --> sinks (per sink)
+
+The readers count what goes through each stage in the instruments below.
+They can be looked at three ways, without stopping the reader:
+
+- serve(port) answers http://127.0.0.1:PORT/metrics in the Prometheus text
+  format, and /profile?seconds=N with a sampled profile of all threads
+- StatsReporter(interval) prints one line every interval seconds with the
+  rates and the share of the interval each stage was busy, so the stage
+  that falls behind is the one near 100 %
+- install_profile_signals() makes SIGUSR1 toggle the sampling profiler (all
+  threads) and SIGUSR2 toggle cProfile (the main thread, where the polling
+  reader runs); the profile is written to a file when it is toggled off
+
+    with DECODE_SECONDS.time("List 2"):
+        readings = decoder.decode(frame)
+"""
+import bisect
+import collections
+import contextlib
+import cProfile
+import os
+import signal
+import sys
+import threading
+import time
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from han_utils import LogLevel, logit
+from hdlc import which_list
+
+# seconds, from 10 us (a list 1 decode) to 1 s (a stalled disk)
+TIME_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                0.25, 0.5, 1.0)
+STATS_INTERVAL = 60.0
+SAMPLE_INTERVAL = 0.005
+PROFILE_SECONDS = 10.0
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_instruments = []
+
+
+def _label_text(label, value, extra=""):
+    pairs = [f'{label}="{value}"'] if label is not None else []
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A count that only goes up, optionally one per value of label."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        _instruments.append(self)
+
+    def inc(self, amount=1, label_value=None):
+        if amount:
+            with self.lock:
+                self.values[label_value] += amount
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+    def expose(self):
+        with self.lock:
+            values = dict(self.values)
+        if not values and self.label is None:
+            values[None] = 0
+        for label_value, value in sorted(values.items(), key=lambda item: str(item[0])):
+            yield f"{self.name}{_label_text(self.label, label_value)} {value}"
+
+
+class Gauge:
+    """
+    A value that goes up and down, read from function when the metrics are exposed.
+
+    function returns a number, or {label value: number} for a gauge with a label.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.function = None
+        _instruments.append(self)
+
+    def set_function(self, function):
+        self.function = function
+
+    def read(self):
+        if self.function is None:
+            return {}
+        try:
+            values = self.function()
+        except Exception as ex:
+            logit("Gauge %s failed: %s", self.name, ex, lvl=LogLevel.ERROR)
+            return {}
+        return values if isinstance(values, dict) else {None: values}
+
+    def expose(self):
+        for label_value, value in self.read().items():
+            yield f"{self.name}{_label_text(self.label, label_value)} {value}"
+
+
+class Histogram:
+    """Durations in seconds, counted in TIME_BUCKETS, optionally one histogram per value of label."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label=None, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        # label value -> [count per bucket (the last one is +Inf), count, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        _instruments.append(self)
+
+    def observe(self, seconds, label_value=None):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            value = self.values.get(label_value)
+            if value is None:
+                value = self.values[label_value] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            value[0][index] += 1
+            value[1] += 1
+            value[2] += seconds
+
+    @contextlib.contextmanager
+    def time(self, label_value=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, label_value)
+
+    def totals(self):
+        """Return {label value: (count, sum of seconds)}."""
+        with self.lock:
+            return {label_value: (value[1], value[2]) for label_value, value in self.values.items()}
+
+    def expose(self):
+        with self.lock:
+            values = {label_value: (list(value[0]), value[1], value[2]) for label_value, value in self.values.items()}
+        for label_value, (counts, count, seconds) in sorted(values.items(), key=lambda item: str(item[0])):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le_pair = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                yield f"{self.name}_bucket{_label_text(self.label, label_value, le_pair)} {cumulative}"
+            yield f"{self.name}_sum{_label_text(self.label, label_value)} {seconds}"
+            yield f"{self.name}_count{_label_text(self.label, label_value)} {count}"
+
+
+BYTES_READ = Counter("han_bytes_read_total", "Bytes read from the HAN port")
+FRAMES = Counter("han_frames_total", "Complete frames found by the framer")
+CRC_FAILURES = Counter("han_crc_failures_total", "Frames dropped for a bad HCS or FCS")
+JUNK_BYTES = Counter("han_junk_bytes_total", "Bytes skipped between frames")
+DROPPED_BYTES = Counter("han_dropped_bytes_total", "Bytes lost in ring buffer overflows")
+DECODE_ERRORS = Counter("han_decode_errors_total", "Frames that could not be decoded")
+LISTS = Counter("han_lists_total", "Decoded lists by list type", label="list")
+SINK_ERRORS = Counter("han_sink_errors_total", "Sink writes that raised", label="sink")
+FRAME_SECONDS = Histogram("han_frame_seconds", "Time spent finding frames in the bytes read, per call of the framer")
+DECODE_SECONDS = Histogram("han_decode_seconds", "Time to decode one frame", label="list")
+SINK_SECONDS = Histogram("han_sink_write_seconds", "Time of one write to a sink", label="sink")
+QUEUE_DEPTH = Gauge("han_queue_depth", "Bytes or items waiting in front of a stage", label="queue")
+
+# the counts of every framer and ring buffer at the last count_framer() / count_ring() call
+_framers_seen = weakref.WeakKeyDictionary()
+_rings_seen = weakref.WeakKeyDictionary()
+
+
+def count_framer(framer):
+    """Add what framer (a framer.HdlcFramer) counted since the last call for it to the counters."""
+    seen = _framers_seen.get(framer, (0, 0, 0))
+    now = (framer.frames, framer.crc_failures, framer.junk_bytes)
+    FRAMES.inc(now[0] - seen[0])
+    CRC_FAILURES.inc(now[1] - seen[1])
+    JUNK_BYTES.inc(now[2] - seen[2])
+    _framers_seen[framer] = now
+
+
+def count_ring(ring):
+    """Add the bytes ring (a ringbuffer.RingBuffer) dropped since the last call for it to DROPPED_BYTES."""
+    DROPPED_BYTES.inc(ring.dropped_bytes - _rings_seen.get(ring, 0))
+    _rings_seen[ring] = ring.dropped_bytes
+
+
+def list_label(frame):
+    """The list type of a frame, for the labels."""
+    return which_list(frame) or "other"
+
+
+def sink_name(sink):
+    return getattr(sink, "__name__", type(sink).__name__)
+
+
+def exposition():
+    """All instruments in the Prometheus text format."""
+    lines = []
+    for instrument in _instruments:
+        lines.append(f"# HELP {instrument.name} {instrument.help_text}")
+        lines.append(f"# TYPE {instrument.name} {instrument.kind}")
+        lines.extend(instrument.expose())
+    return "\n".join(lines) + "\n"
+
+
+def snapshot():
+    """Counter totals and the (count, seconds) of every histogram label, for stats_line()."""
+    return {
+        "time": time.monotonic(),
+        "bytes": BYTES_READ.total(),
+        "frames": FRAMES.total(),
+        "crc": CRC_FAILURES.total(),
+        "dropped": DROPPED_BYTES.total(),
+        "errors": DECODE_ERRORS.total(),
+        "stages": {
+            "frame": FRAME_SECONDS.totals(),
+            "decode": DECODE_SECONDS.totals(),
+            "sink": SINK_SECONDS.totals(),
+        },
+    }
+
+
+def stats_line(before, after):
+    """
+    One line with what happened between two snapshots.
+
+    For every stage (and label) the number of calls, the mean time per call
+    and the share of the interval spent in it.
+    """
+    seconds = max(after["time"] - before["time"], 1e-9)
+    parts = [
+        f"{(after['bytes'] - before['bytes']) / seconds:.0f} B/s",
+        f"frames {after['frames'] - before['frames']}",
+        f"crc {after['crc'] - before['crc']}",
+        f"dropped {after['dropped'] - before['dropped']} B",
+        f"errors {after['errors'] - before['errors']}",
+    ]
+    for stage, totals in after["stages"].items():
+        for label_value, (count, busy) in sorted(totals.items(), key=lambda item: str(item[0])):
+            count_before, busy_before = before["stages"][stage].get(label_value, (0, 0.0))
+            calls = count - count_before
+            if not calls:
+                continue
+            name = stage if label_value is None else f"{stage}[{label_value}]"
+            busy -= busy_before
+            parts.append(f"{name} {calls}x{busy / calls * 1e6:.0f}us {busy / seconds:.1%}")
+    depths = QUEUE_DEPTH.read()
+    if depths:
+        parts.append("queues " + " ".join(f"{name}={depth}" for name, depth in depths.items()))
+    return "  ".join(parts)
+
+
+class StatsReporter:
+    """Print stats_line() every interval seconds on a background thread."""
+
+    def __init__(self, interval=STATS_INTERVAL, out=print):
+        self.interval = interval
+        self.out = out
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="han-stats", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        before = snapshot()
+        while not self.stopped.wait(self.interval):
+            after = snapshot()
+            self.out(f"Stats: {stats_line(before, after)}")
+            before = after
+
+
+class Sampler:
+    """
+    A sampling profiler: every interval seconds the stack of every thread is
+    recorded.  collapsed() returns the stacks in the folded format of
+    flamegraph.pl and speedscope, one "thread;outer;...;inner count" per line.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self._run, name="han-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while self.running.is_set():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def sample(seconds=PROFILE_SECONDS, interval=SAMPLE_INTERVAL):
+    """Sample all threads for seconds and return the collapsed stacks."""
+    sampler = Sampler(interval)
+    sampler.start()
+    time.sleep(seconds)
+    sampler.stop()
+    return sampler.collapsed()
+
+
+_profilers = {}
+
+
+def _profile_file(kind, suffix):
+    return f"han-{kind}-{time.strftime('%Y%m%d-%H%M%S')}.{suffix}"
+
+
+def toggle_sampler():
+    """Start the sampling profiler, or stop it and write the stacks to han-profile-TIME.txt."""
+    sampler = _profilers.pop("sampler", None)
+    if sampler is None:
+        sampler = _profilers["sampler"] = Sampler()
+        sampler.start()
+        logit("Sampling profiler started", lvl=LogLevel.WARNING)
+        return None
+    sampler.stop()
+    file_name = _profile_file("profile", "txt")
+    with open(file_name, "w", encoding="utf-8") as profile_file:
+        profile_file.write(sampler.collapsed())
+    logit("Sampling profiler stopped after %d samples, written to %s", sampler.samples, file_name,
+          lvl=LogLevel.WARNING)
+    return file_name
+
+
+def toggle_cprofile():
+    """Start cProfile in the calling thread, or stop it and write the pstats to han-cprofile-TIME.pstats."""
+    profiler = _profilers.pop("cprofile", None)
+    if profiler is None:
+        profiler = _profilers["cprofile"] = cProfile.Profile()
+        profiler.enable()
+        logit("cProfile started", lvl=LogLevel.WARNING)
+        return None
+    profiler.disable()
+    file_name = _profile_file("cprofile", "pstats")
+    profiler.dump_stats(file_name)
+    logit("cProfile stopped, written to %s (python -m pstats %s)", file_name, file_name, lvl=LogLevel.WARNING)
+    return file_name
+
+
+def stop_profiling():
+    """Stop whichever profilers run and write their files."""
+    if "sampler" in _profilers:
+        toggle_sampler()
+    if "cprofile" in _profilers:
+        toggle_cprofile()
+
+
+def install_profile_signals():
+    """Toggle the sampler on SIGUSR1 and cProfile on SIGUSR2, where the OS has them."""
+    if not hasattr(signal, "SIGUSR1") or threading.current_thread() is not threading.main_thread():
+        return False
+    signal.signal(signal.SIGUSR1, lambda *_: toggle_sampler())
+    signal.signal(signal.SIGUSR2, lambda *_: toggle_cprofile())
+    return True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            body = exposition()
+        elif url.path == "/profile":
+            try:
+                seconds = float(parse_qs(url.query).get("seconds", [PROFILE_SECONDS])[0])
+            except ValueError:
+                self.send_error(400, "seconds must be a number")
+                return
+            body = sample(min(seconds, 300.0))
+        else:
+            self.send_error(404, "Use /metrics or /profile?seconds=N")
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logit("metrics %s - " + format, self.address_string(), *args)
+
+
+def serve(port, host="127.0.0.1"):
+    """Serve /metrics and /profile on a background thread. Returns the server, shutdown() stops it."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="han-metrics", daemon=True).start()
+    logit("Metrics on http://%s:%d/metrics", host, server.server_address[1], lvl=LogLevel.INFO)
+    return server
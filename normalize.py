@@ -0,0 +1,42 @@
+# pylint: disable=missing-docstring
+"""
+Scaler/unit normalization of decoded values.
+
+Meters send integers with a scaler_unit: 2379 with scaler -1 and unit 35 is
+237.9 V.  The scaler is a signed power of ten, so 0xff is -1.  Instead of
+scaling one value at a time, the normalization works on whole batches: the
+values and their scalers are numpy arrays of the same shape and
+
+    scale(values, scalers)
+
+returns the float64 values in the unit of the meter: W, var, Wh, varh, A
+and V.  The powers of ten come from a table indexed by the scaler.  Values
+with a negative scaler are divided by the (exact) positive power of ten
+rather than multiplied by the inexact negative one, so 2379 with scaler -1
+comes out as 237.9 and not 237.90000000000001.
+"""
+import numpy
+
+UNIT_SYMBOLS = {27: "W", 28: "VA", 29: "var", 30: "Wh", 32: "varh", 33: "A", 35: "V"}
+
+# 10 ** abs(scaler) for every int8 scaler, indexed by scaler + 128
+POWERS_OF_TEN = numpy.power(10.0, numpy.abs(numpy.arange(-128, 128, dtype=numpy.float64)))
+
+
+def unit_symbol(unit):
+    return UNIT_SYMBOLS.get(unit, "" if unit is None else str(unit))
+
+
+def scale(values, scalers):
+    """Return values * 10 ** scalers as float64, scalers being signed ints.  NaN values stay NaN."""
+    values = numpy.asarray(values, dtype=numpy.float64)
+    scalers = numpy.asarray(scalers, dtype=numpy.int16)
+    powers = POWERS_OF_TEN[scalers + 128]
+    return numpy.where(scalers < 0, values / powers, values * powers)
+
+
+def scaled_value(value, scaler):
+    """Scale a single value, for printing.  Values that are not numbers are returned as they are."""
+    if not scaler or not isinstance(value, (int, float)) or isinstance(value, bool):
+        return value
+    return value / 10 ** -scaler if scaler < 0 else value * 10 ** scaler
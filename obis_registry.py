@@ -0,0 +1,172 @@
+# pylint: disable=missing-docstring
+"""
+Registry of OBIS codes and vendor profiles.
+
+OBIS codes are keyed on the six code bytes packed into one int, so a lookup
+is a single dict access whether the code comes as a tuple, as bytes from the
+frame or as an int already:
+
+    >>> REGISTRY.name((1, 0, 1, 7, 0, 255))
+    'Active power+(Q1+Q4)'
+    >>> REGISTRY.get(b"\\x01\\x00\\x1f\\x07\\x00\\xff").scaler
+    -1
+
+The profiles are read from obis_profiles.json next to this file, and from
+the file named by the HAN_OBIS_PROFILES environment variable, if set, whose
+names and defaults take precedence.  Each vendor lists the list version ids
+it sends, its codes with name, unit, default scaler and value type (the DLMS
+type tag) and, for meters that do not send OBIS codes, the codes of the
+values by position:
+
+    "kaifa": {
+      "list_ids": ["Kfm_001"],
+      "codes": [{"obis": "1.0.31.7.0.255", "name": "IL1", "unit": 33, "scaler": -3, "type": 6}, ...],
+      "positional": {"Kfm_001": {"9": ["1.1.0.2.129.255", ...]}}
+    }
+
+The positional layouts are keyed on the list version id (the empty string
+for lists without one) and the number of values in the list.
+
+Vendors use different codes for the same quantity (Kamstrup sends 1.1.x
+codes where Aidon and Kaifa send 1.0.x), so code that looks for a quantity
+goes by its name, REGISTRY.codes_named("A+cumul"), or by the sets of clock,
+meter id and energy register codes of all profiles.
+"""
+import json
+import os
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+PROFILES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "obis_profiles.json")
+PROFILES_ENV = "HAN_OBIS_PROFILES"
+LIST_VERSION_OBIS = (1, 1, 0, 2, 129, 255)
+DATE_TIME_TYPE = 25
+METER_ID_NAME = "Meter ID"
+# Wh and varh: the cumulative energy registers
+COUNTER_UNITS = (30, 32)
+
+
+def pack_obis(code) -> int:
+    """Pack a code given as a tuple, bytes, "a.b.c.d.e.f" text or int into the registry key."""
+    if isinstance(code, int):
+        return code
+    if isinstance(code, str):
+        code = [int(part) for part in code.strip(".").split(".")]
+    return int.from_bytes(bytes(code), "big")
+
+
+def unpack_obis(key) -> Tuple[int, ...]:
+    return tuple(key.to_bytes(6, "big"))
+
+
+class ObisEntry(NamedTuple):
+    obis: Tuple[int, ...]
+    name: str
+    unit: Optional[int] = None
+    scaler: Optional[int] = None
+    value_type: Optional[int] = None
+
+
+class ObisProfile:
+    """The codes, list version ids and positional layouts of one vendor."""
+
+    def __init__(self, vendor, list_ids=(), entries=None, positional=None):
+        self.vendor = vendor
+        self.list_ids = tuple(list_ids)
+        self.entries: Dict[int, ObisEntry] = entries or {}
+        self.positional: Dict[str, Dict[int, List[Tuple[int, ...]]]] = positional or {}
+
+    @classmethod
+    def from_dict(cls, vendor, data):
+        entries = {}
+        for item in data.get("codes", ()):
+            key = pack_obis(item["obis"])
+            entries[key] = ObisEntry(unpack_obis(key), item["name"], item.get("unit"), item.get("scaler"),
+                                     item.get("type"))
+        positional = {
+            list_id: {int(count): [unpack_obis(pack_obis(code)) for code in codes] for count, codes in layouts.items()}
+            for list_id, layouts in data.get("positional", {}).items()
+        }
+        return cls(vendor, data.get("list_ids", ()), entries, positional)
+
+    def codes_for(self, list_id, count):
+        """Return the codes of a list of count values without OBIS codes, or None."""
+        return self.positional.get(list_id or "", {}).get(count)
+
+
+class ObisRegistry:
+    """
+    All known codes, with the vendor profiles they came from.
+
+    entries holds the code of every profile.  Where vendors disagree on a
+    default the first profile loaded wins, unless a later one is added with
+    override=True.  Vendor specific defaults are looked up with
+    get(code, profile).
+    """
+
+    def __init__(self):
+        self.profiles: Dict[str, ObisProfile] = {}
+        self.entries: Dict[int, ObisEntry] = {}
+        self.by_list_id: Dict[str, ObisProfile] = {}
+        self.by_name: Dict[str, set] = {}
+        self.clock_codes = set()
+        self.meter_id_codes = set()
+        self.counter_codes = set()
+
+    def add_profile(self, profile, override=False):
+        self.profiles[profile.vendor] = profile
+        for list_id in profile.list_ids:
+            self.by_list_id[list_id] = profile
+        for key, entry in profile.entries.items():
+            if override or key not in self.entries:
+                self.entries[key] = entry
+            self.by_name.setdefault(entry.name, set()).add(entry.obis)
+            if entry.value_type == DATE_TIME_TYPE:
+                self.clock_codes.add(entry.obis)
+            if entry.name == METER_ID_NAME:
+                self.meter_id_codes.add(entry.obis)
+            if entry.unit in COUNTER_UNITS:
+                self.counter_codes.add(entry.obis)
+
+    def load(self, path, override=False):
+        with open(path, encoding="utf-8") as profiles_file:
+            data = json.load(profiles_file)
+        for vendor, profile_data in data.items():
+            self.add_profile(ObisProfile.from_dict(vendor, profile_data), override)
+        return self
+
+    def get(self, code, profile=None) -> Optional[ObisEntry]:
+        key = pack_obis(code)
+        if profile is not None:
+            entry = profile.entries.get(key)
+            if entry is not None:
+                return entry
+        return self.entries.get(key)
+
+    def name(self, code, default="Unknown"):
+        entry = self.entries.get(pack_obis(code))
+        return default if entry is None else entry.name
+
+    def codes_named(self, name):
+        """Return the codes of all profiles with the name, as tuples."""
+        return self.by_name.get(name, set())
+
+    def profile_for(self, list_id) -> Optional[ObisProfile]:
+        return self.by_list_id.get(list_id)
+
+    def positional_profile(self, count) -> Optional[ObisProfile]:
+        """Return the profile with a layout for lists of count values without a list version id."""
+        for profile in self.profiles.values():
+            if profile.codes_for("", count) is not None:
+                return profile
+        return None
+
+
+def load_registry():
+    registry = ObisRegistry().load(PROFILES_FILE)
+    extra = os.environ.get(PROFILES_ENV)
+    if extra:
+        registry.load(extra, override=True)
+    return registry
+
+
+REGISTRY = load_registry()
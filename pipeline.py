@@ -0,0 +1,186 @@
+# pylint: disable=missing-docstring
+"""
+Threaded reading of the HAN port, with bounded queues between the stages.
+
+    serial reader --> ring buffer --> framer --> frame queue --> decoder(s) --> sink queue --> writer
+       thread          (bytes)        thread     (frames)         threads       (readings)      thread
+
+The serial reader thread does nothing but move bytes from the port into the
+ring buffer, so it is back waiting on the port right away whatever the other
+stages are doing.  If decoding or writing stalls, the queues fill up, the
+framer blocks, and the ring buffer sheds bytes by its policy and counts them.
+Memory stays bounded and the OS serial buffer is always drained (unless the
+ring buffer has the BLOCK policy, then the serial reader waits instead).
+
+The writer calls every sink as sink(receive_time, frame, readings).  A sink
+that raises is logged and the writer carries on with the next item.  Every
+stage is counted and timed in metrics.py, and the fill levels of the ring
+buffer and the queues are the han_queue_depth gauge.
+
+    pipeline = Pipeline(com_port, sinks=[lambda _, __, readings: print_readings(readings)])
+    pipeline.start()
+    ...
+    pipeline.stop()
+"""
+import queue
+import threading
+import time
+
+from cosem import CosemDecoder, DecodeError
+from framer import HdlcFramer
+from han_utils import LogLevel, logit
+from metrics import (BYTES_READ, DECODE_ERRORS, DECODE_SECONDS, FRAME_SECONDS, LISTS, QUEUE_DEPTH, SINK_ERRORS,
+                     SINK_SECONDS, count_framer, count_ring, list_label, sink_name)
+from ringbuffer import RingBuffer
+
+QUEUE_SIZE = 256
+READ_TIMEOUT = 0.1
+STATS_INTERVAL = 60.0
+
+# marks the end of the stream in the queues
+_STOP = None
+
+
+class Pipeline:
+    """
+    Read, frame, decode and write on separate threads.
+
+    decoders is the number of decoder threads, each with its own
+    CosemDecoder.  With more than one, lists may reach the sinks out of
+    order.  queue_size bounds the frame and the sink queue.
+    """
+
+    def __init__(self, com_port, sinks=(), verify_crc=True, decoders=1, ring=None, queue_size=QUEUE_SIZE):
+        self.com_port = com_port
+        self.sinks = list(sinks)
+        self.ring = ring if ring is not None else RingBuffer()
+        self.framer = HdlcFramer(verify_crc=verify_crc)
+        self.frame_queue = queue.Queue(queue_size)
+        self.sink_queue = queue.Queue(queue_size)
+        self.noof_decoders = decoders
+        self.decoders = []
+        self.running = threading.Event()
+        self.threads = []
+        self.bytes_read = 0
+        self.decode_errors = 0
+        self.sink_errors = 0
+        self.lists_written = 0
+
+    def start(self):
+        self.running.set()
+        QUEUE_DEPTH.set_function(self.depths)
+        self.decoders = [CosemDecoder() for _ in range(self.noof_decoders)]
+        targets = [("serial-reader", self._read_serial, ()), ("framer", self._frame, ())]
+        targets += [(f"decoder-{index}", self._decode, (decoder,)) for index, decoder in enumerate(self.decoders)]
+        targets.append(("writer", self._write, ()))
+        self.threads = [threading.Thread(target=target, args=args, name=f"han-{name}", daemon=True)
+                        for name, target, args in targets]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop reading and let the frames already read run through the pipeline."""
+        self.running.clear()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def depths(self):
+        """Return the fill level of each stage: bytes in the ring buffer and items in the queues."""
+        return {
+            "ring_bytes": len(self.ring),
+            "frame_queue": self.frame_queue.qsize(),
+            "sink_queue": self.sink_queue.qsize(),
+        }
+
+    def stats(self):
+        return {
+            "bytes_read": self.bytes_read,
+            "frames": self.framer.frames,
+            "crc_failures": self.framer.crc_failures,
+            "junk_bytes": self.framer.junk_bytes,
+            "decode_errors": self.decode_errors,
+            "lists_written": self.lists_written,
+            "sink_errors": self.sink_errors,
+            "dropped_bytes": self.ring.dropped_bytes,
+            "dropped_frames": self.ring.dropped_frames,
+            **self.depths(),
+        }
+
+    def _read_serial(self):
+        com_port = self.com_port
+        while self.running.is_set():
+            try:
+                # returns after the first byte or the port timeout, whatever is waiting comes along
+                data = com_port.read(max(1, com_port.in_waiting))
+            except Exception as ex:
+                logit("Serial read failed: %s", ex, lvl=LogLevel.ERROR)
+                break
+            if data:
+                self.bytes_read += len(data)
+                BYTES_READ.inc(len(data))
+                self.ring.write(data)
+                count_ring(self.ring)
+        self.running.clear()
+
+    def _frame(self):
+        while self.running.is_set() or len(self.ring):
+            data = self.ring.read(timeout=READ_TIMEOUT)
+            if not data:
+                continue
+            receive_time = time.time()
+            with FRAME_SECONDS.time():
+                frames = self.framer.feed(data)
+            count_framer(self.framer)
+            for frame in frames:
+                self.frame_queue.put((receive_time, frame))
+        for _ in self.decoders:
+            self.frame_queue.put(_STOP)
+
+    def _decode(self, decoder):
+        while (item := self.frame_queue.get()) is not _STOP:
+            receive_time, frame = item
+            label = list_label(frame)
+            try:
+                with DECODE_SECONDS.time(label):
+                    readings = decoder.decode(frame)
+            except DecodeError as decode_error:
+                self.decode_errors += 1
+                DECODE_ERRORS.inc()
+                logit("Could not decode frame: %s", decode_error, lvl=LogLevel.ERROR)
+                continue
+            LISTS.inc(label_value=label)
+            self.sink_queue.put((receive_time, frame, readings))
+        self.sink_queue.put(_STOP)
+
+    def _write(self):
+        running_decoders = len(self.decoders)
+        sinks = [(sink, sink_name(sink)) for sink in self.sinks]
+        while running_decoders:
+            item = self.sink_queue.get()
+            if item is _STOP:
+                running_decoders -= 1
+                continue
+            for sink, name in sinks:
+                try:
+                    with SINK_SECONDS.time(name):
+                        sink(*item)
+                except Exception as ex:
+                    self.sink_errors += 1
+                    SINK_ERRORS.inc(label_value=name)
+                    logit("Sink %s failed: %s", sink, ex, lvl=LogLevel.ERROR)
+            self.lists_written += 1
+
+
+def run_pipeline(pipeline, stats_interval=STATS_INTERVAL):
+    """Run the pipeline until the port fails or Ctrl-C, logging the queue depths every stats_interval seconds."""
+    pipeline.start()
+    serial_reader = pipeline.threads[0]
+    try:
+        while serial_reader.is_alive():
+            serial_reader.join(stats_interval)
+            logit("Pipeline: %s", pipeline.stats(), lvl=LogLevel.INFO)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pipeline.stop()
+    return pipeline.stats()
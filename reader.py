@@ -4,28 +4,38 @@
 # import serial
 # import serial.tools.list_ports as lp
 import datetime
+import mmap
 import os.path
 import re
 import string
 import sys
 import time
 
+from capture import CaptureReader, is_capture_file
 from comport import get_comport
-from han_utils import LogLevel, hexify, logit, simple_print_byte_array
-from hdlc import (after_hdlc, contains_full_message, extract_next_message,
-                  hdlc, the_payload)
+from cosem import DecodeError
+from delta import delta_sink
+from framer import HdlcFramer
+from han_utils import LogLevel, hexify, lazy_hexdump, logit
+from hdlc import after_hdlc, hdlc, the_payload, which_list
+from metrics import (BYTES_READ, DECODE_ERRORS, DECODE_SECONDS, FRAME_SECONDS, LISTS, SINK_SECONDS, count_framer,
+                     list_label)
+from pipeline import Pipeline, run_pipeline
+from sinks import get_sink
 
 CURRENT_VERSION = "v2.16 - 2022-11-29"
+FILE_CHUNK_SIZE = 1024 * 1024
+HEX_TEXT_BYTES = frozenset(string.hexdigits.encode() + string.whitespace.encode())
 print(f"Hafslund&Elvia HAN tester version: {CURRENT_VERSION}")
 
 
-list2_file = open("list2.txt", "a")
-list3_file = open("list3.txt", "a")
-list1_file = open("list1.txt", "a")
-log_file = open("rawlog.txt", "a")
-ringbuffer_log = open("ringbuffer.txt", "a")
-rawlogfile_binary = open("rawlogfile_binary.txt", "ab")
-rawlogfile_bytes = open("rawlogfile_bytes", "a")
+LOG_ROTATE_BYTES = 64 * 1024 * 1024
+
+# opened at the first write, written in batches, see sinks.py
+log_file = get_sink("rawlog.txt")
+ringbuffer_log = get_sink("ringbuffer.txt", rotate_bytes=LOG_ROTATE_BYTES)
+rawlogfile_binary = get_sink("rawlogfile_binary.txt", rotate_bytes=LOG_ROTATE_BYTES)
+rawlogfile_bytes = get_sink("rawlogfile_bytes", rotate_bytes=LOG_ROTATE_BYTES)
 
 
 def parse_command_line(options):
@@ -87,56 +97,164 @@ def read_bytes(com_port, given_bytes=0):
         if num_bytes <= given_bytes:
             time.sleep(1)
     serial_string = com_port.read(num_bytes)
+    BYTES_READ.inc(len(serial_string))
     # jaws
     rawlogfile_binary.write(serial_string)
+    # every byte read once, as hex text (parse_file reads this back)
+    rawlogfile_bytes.write(hexify(serial_string))
     return bytearray(serial_string)
 
 
 def log_ringbuffer(buf):
-    ringbuffer_log.write(get_now())
-    ringbuffer_log.write("\n")
-    ringbuffer_log.write(hexify(buf))
-    rawlogfile_bytes.write(hexify(buf))
-    ringbuffer_log.write("\n")
-    # rawlogfile_binary.write(bytes(buf))
+    """Log the bytes of one poll of the port, with the time, so every byte is written once."""
+    ringbuffer_log.write(f"{get_now()}\n{hexify(buf)}\n")
+
+
+def print_readings(readings):
+    print(f"======= {datetime.datetime.now()} ===============")
+    print(f"\nList with {len(readings)} records")
+    for index, reading in enumerate(readings):
+        print("%3d: %18s %24s  %24s %s" % (index, reading.obis_code, reading.name,
+                                           reading.scaled_value, reading.unit_symbol))
 
 
-def parse_data(ringbuffer):
+def parse_data(framer, decoder=None, capture=None, exporter=None, receive_time=None, delta=None):
+    """
+    Decode and print every complete frame in the framer.
+
+    With a decoder (cosem.CosemDecoder) the frames are decoded to typed readings,
+    otherwise the string building decoder in hdlc is used.  With a capture
+    (capture.CaptureWriter) every frame is also recorded, with an exporter
+    (export.ColumnarExporter) the typed readings are also exported, stamped
+    with receive_time when the list has no clock.  With a delta
+    (delta.DeltaFilter) only the readings that changed are printed, the
+    export gets them all.  Framing, decoding and every output are timed in
+    the metrics.py histograms.
+    """
     outs2 = ""
-    while contains_full_message(ringbuffer):
-        next_message = extract_next_message(ringbuffer)
-        logit(f"{hexify(next_message)}", LogLevel.WARNING)
-        raw_data = simple_print_byte_array(next_message)
-        decode_this_message = next_message.copy()
-        outs2 = hdlc(decode_this_message)
-        outs2 += after_hdlc(decode_this_message)
-        outs2 += the_payload(decode_this_message)
-        log_ringbuffer(ringbuffer)
+    crc_failures = framer.crc_failures
+    while True:
+        with FRAME_SECONDS.time():
+            next_message = framer.next_frame()
+        if next_message is None:
+            break
+        if capture is not None:
+            with SINK_SECONDS.time("capture_sink"):
+                capture.write(next_message)
+        logit("Extracted message length: %d", len(next_message))
+        print(f"List: {which_list(next_message)}")
+        label = list_label(next_message)
+        if decoder is not None:
+            try:
+                with DECODE_SECONDS.time(label):
+                    readings = decoder.decode(next_message)
+                LISTS.inc(label_value=label)
+                printed = readings if delta is None else delta.changes(readings, now=receive_time)
+                with SINK_SECONDS.time("print_sink"):
+                    if printed:
+                        print_readings(printed)
+                if exporter is not None:
+                    with SINK_SECONDS.time("export_sink"):
+                        exporter.add(readings, receive_time)
+            except DecodeError as decode_error:
+                DECODE_ERRORS.inc()
+                print(f"Could not decode frame: {decode_error}")
+            continue
+
+        logit("Frame:\n%s", lazy_hexdump(next_message, breakit=True), lvl=LogLevel.WARNING)
+        decode_this_message = bytearray(next_message)
+        with DECODE_SECONDS.time(label):
+            outs2 = hdlc(decode_this_message)
+            outs2 += after_hdlc(decode_this_message)
+            outs2 += the_payload(decode_this_message)
+        LISTS.inc(label_value=label)
+
+    count_framer(framer)
+    if framer.crc_failures != crc_failures:
+        logit("Dropped %d frame(s) with bad HCS/FCS, %d in total",
+              framer.crc_failures - crc_failures, framer.crc_failures, lvl=LogLevel.ERROR)
+
+
+def is_hex_text(i_file):
+    """Captures are either raw bytes or hex text (like rawlogfile_bytes). Sniff the start of the file."""
+    with open(i_file, "rb") as capture:
+        start = capture.read(4096)
+    return bool(start) and all(byte in HEX_TEXT_BYTES for byte in start)
+
+
+def iter_file_data(i_file, chunk_size=FILE_CHUNK_SIZE):
+    """
+    Yield the serial data of a capture file in chunks of at most chunk_size bytes.
+
+    Binary captures are memory mapped and the chunks are memoryviews into the
+    map, valid until the next chunk is requested.  Hex text captures are read
+    and converted chunk_size characters at a time.  Either way only one chunk
+    is in memory, whatever the size of the file.  Capture container files
+    (capture.py) yield one frame per chunk.
+    """
+    if is_capture_file(i_file):
+        for record in CaptureReader(i_file):
+            yield record.frame
+        return
+
+    if is_hex_text(i_file):
+        with open(i_file, "rb") as capture:
+            rest = b""
+            while block := capture.read(chunk_size):
+                digits = rest + block.translate(None, string.whitespace.encode())
+                even = len(digits) & ~1
+                yield bytes.fromhex(digits[:even].decode("ascii"))
+                rest = digits[even:]
+        return
+
+    if os.path.getsize(i_file) == 0:
+        return
+    with open(i_file, "rb") as capture, mmap.mmap(capture.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            for index in range(0, len(view), chunk_size):
+                chunk = view[index:index + chunk_size]
+                yield chunk
+                chunk.release()
 
 
 def read_data_from_file(i_file):
-    """Read serial data from a text file."""
-    data = None
-    try:
-        lines_of_data = open(i_file).read()
-        lines_of_data.replace(" ", "")
-        lines_of_data.replace("\n", "")
-        data = bytes.fromhex(lines_of_data)
-    except UnicodeDecodeError as ude:
-        # maybe file is binary
-        data = open(i_file, 'rb').read()
-
-    byte_data = bytearray(data)
+    """Read serial data from a binary or hex text file."""
+    byte_data = bytearray()
+    for chunk in iter_file_data(i_file):
+        byte_data += chunk
     return byte_data
 
 
-def read_data_from_serial_port(com_port):
-    ringbuffer = []
+def parse_file(i_file, framer, decoder=None, exporter=None, delta=None):
+    """
+    Feed the capture through the framer one chunk at a time.
+
+    The frames of a capture container (capture.py) are stamped with their
+    recorded receive time.  With a delta (delta.DeltaFilter) only the readings
+    that changed are printed, as in parse_data().
+    """
+    if is_capture_file(i_file):
+        for record in CaptureReader(i_file):
+            framer.push(record.frame)
+            parse_data(framer, decoder, exporter=exporter, receive_time=record.timestamp, delta=delta)
+        return
+    for chunk in iter_file_data(i_file):
+        framer.push(chunk)
+        parse_data(framer, decoder, exporter=exporter, delta=delta)
+
+
+def read_data_from_serial_port(com_port, verify_crc=True, decoder=None, capture=None, exporter=None, delta=None):
+    """
+    Poll the port and decode the frames, forever.
 
-    log_file.write(get_now())
-    log_file.write("\n")
-    log_file.write(f"Hafslund&Elvia HAN tester version: {CURRENT_VERSION}")
-    log_file.write("\n")
+    Every poll decodes all the bytes it read before reading again, so there
+    is no backlog to bound here: the framer only holds the bytes of a frame
+    that is not complete yet.  read_data_threaded() is the one with a ring
+    buffer between reading and decoding.
+    """
+    framer = HdlcFramer(verify_crc=verify_crc)
+
+    log_file.write(f"{get_now()}\nHafslund&Elvia HAN tester version: {CURRENT_VERSION}\n")
 
     # ---------------
     # The main loop
@@ -146,13 +264,41 @@ def read_data_from_serial_port(com_port):
         time.sleep(1)
         if com_port.in_waiting > 0:
             try:
-                data = read_bytes(com_port, com_port.in_waiting)
-                ringbuffer.extend(data)
-                parse_data(ringbuffer)
+                serial_data = read_bytes(com_port, com_port.in_waiting)
+                log_ringbuffer(serial_data)
+                framer.push(serial_data)
+                parse_data(framer, decoder, capture, exporter, time.time(), delta)
+                if capture is not None:
+                    capture.flush()
             except IndexError as ix_e:
                 print(f"{ix_e}")
 
 
+def read_data_threaded(com_port, verify_crc=True, decoders=1, capture=None, exporter=None, ring=None, delta=None):
+    """
+    Read the port with pipeline.Pipeline until it fails or Ctrl-C, and return its statistics.
+
+    Printing, capturing and exporting run on the writer thread, so a slow
+    disk does not hold up reading the port.  With a delta (delta.DeltaFilter)
+    only the readings that changed are printed.
+    """
+    def print_sink(_, frame, readings):
+        print(f"List: {which_list(frame)}")
+        print_readings(readings)
+
+    sinks = [print_sink if delta is None else delta_sink(print_sink, delta)]
+    if capture is not None:
+        def capture_sink(receive_time, frame, _):
+            capture.write(frame, timestamp=receive_time)
+            capture.flush()
+        sinks.insert(0, capture_sink)
+    if exporter is not None:
+        def export_sink(receive_time, _, readings):
+            exporter.add(readings, receive_time)
+        sinks.append(export_sink)
+    return run_pipeline(Pipeline(com_port, sinks, verify_crc, decoders, ring))
+
+
 if __name__ == "__main__":
     options = {}
     parse_command_line(options)
@@ -0,0 +1,253 @@
+# pylint: disable=missing-docstring
+"""
+Bulk replay of binary capture files on all cores.
+
+Each capture is split into chunks, the chunks are framed and decoded in a
+ProcessPoolExecutor and the rows are merged in timestamp order and written
+with export.ColumnarExporter:
+
+    python replay.py OUTPUT CAPTURE [CAPTURE ...] [--workers=N] [--chunk-size=MB] [--no-crc-check]
+
+OUTPUT is a Parquet file, or a directory of raw float64 columns when
+pyarrow is not installed.
+
+A capture is either a capture container (capture.py), split on its records,
+or the raw bytes from the HAN port, split on frame starts found by scanning
+for flags.  Rows from a container are stamped with the clock of the list,
+or else the time the frame was received.  A raw capture has no receive
+times and only Aidon List 3 carries the clock (once an hour), so the rows in
+between get a time interpolated by their position between the clocks
+around them, and the rows before the first and after the last clock are
+extrapolated at the same rate.  Without two clocks they are NaN.
+
+Rows are not collected: every capture is read as a stream of chunk results,
+at most workers chunks ahead, and the streams are merged as they come and
+written batch by batch.  A container joins the merge only once the merge has
+reached the receive time of its first record, so only the captures that
+overlap in time are held open at once.
+"""
+import heapq
+import math
+import os
+import sys
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from capture import CaptureReader, is_capture_file, read_records
+from cosem import CosemDecoder, DecodeError
+from export import COLUMN_NAMES, COLUMNS, ColumnarExporter, readings_to_row, readings_to_scalers
+from framer import FLAG, FRAME_FORMAT_TYPE_3, HdlcFramer, frame_length
+
+CHUNK_SIZE = 4 * 1024 * 1024
+SCAN_WINDOW = 64 * 1024
+
+
+def is_frame_start(buf, index):
+    """True if buf[index] is an opening flag whose length field leads to a closing flag."""
+    if index + 2 >= len(buf) or buf[index] != FLAG or buf[index + 1] & 0xF0 != FRAME_FORMAT_TYPE_3:
+        return False
+    end = index + frame_length(buf[index + 1], buf[index + 2]) + 1
+    return end < len(buf) and buf[end] == FLAG
+
+
+def find_frame_start(capture, position, file_size):
+    """Return the index of the first frame start at or after position, or file_size."""
+    while position < file_size:
+        capture.seek(position)
+        # read a bit more than the window so a frame starting near its end can be verified
+        window = capture.read(SCAN_WINDOW + 2048)
+        index = window.find(FLAG)
+        while 0 <= index < SCAN_WINDOW:
+            if is_frame_start(window, index):
+                return position + index
+            index = window.find(FLAG, index + 1)
+        position += SCAN_WINDOW
+    return file_size
+
+
+def split_file(file_name, chunk_size=CHUNK_SIZE):
+    """Return (start, end) pairs covering the file, each starting at a frame start."""
+    file_size = os.path.getsize(file_name)
+    boundaries = [0]
+    with open(file_name, "rb") as capture:
+        position = chunk_size
+        while position < file_size:
+            start = find_frame_start(capture, position, file_size)
+            if start > boundaries[-1]:
+                boundaries.append(start)
+            position = max(start, position) + chunk_size
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def decode_chunk(file_name, start, end, verify_crc=True, container=False):
+    """
+    Decode the frames starting in file_name[start:end].
+
+    Returns (values, scalers, frames, crc_failures, decode_errors).  values
+    holds the export rows one after the other, the timestamp (NaN if neither
+    the list nor the capture has one) and one float per export column, and
+    scalers the scaler per column of each row.
+    """
+    values = array("d")
+    scalers = array("b")
+    decoder = CosemDecoder()
+    frames = crc_failures = errors = 0
+
+    if container:
+        framed = ((record.frame, record.timestamp) for record in read_records(file_name, start, end))
+    else:
+        with open(file_name, "rb") as capture:
+            capture.seek(start)
+            # the closing flag of the last frame is also the opening flag of the next chunk
+            data = capture.read(end - start + 1)
+        framer = HdlcFramer(verify_crc=verify_crc)
+        framer.push(data)
+        framed = ((frame, None) for frame in framer)
+
+    for frame, receive_time in framed:
+        frames += 1
+        try:
+            readings = decoder.decode(frame)
+        except DecodeError:
+            errors += 1
+            continue
+        row = readings_to_row(readings, receive_time)
+        values.append(math.nan if row[0] is None else row[0])
+        values.extend(row[1:])
+        scalers.extend(readings_to_scalers(readings))
+
+    if not container:
+        frames, crc_failures = framer.frames, framer.crc_failures
+    return values, scalers, frames, crc_failures, errors
+
+
+def chunk_results(executor, file_name, chunks, verify_crc, container, ahead, stats):
+    """Yield the decoded chunks of a capture in order, keeping at most ahead of them in the pool."""
+    futures = deque()
+    for start, end in chunks:
+        futures.append(executor.submit(decode_chunk, file_name, start, end, verify_crc, container))
+        if len(futures) >= ahead:
+            yield _count(futures.popleft().result(), stats)
+    while futures:
+        yield _count(futures.popleft().result(), stats)
+
+
+def _count(result, stats):
+    stats["frames"] += result[2]
+    stats["crc_failures"] += result[3]
+    stats["decode_errors"] += result[4]
+    return result
+
+
+def chunk_rows(results):
+    """Yield (row, scalers) for the rows of decoded chunks."""
+    width = len(COLUMN_NAMES)
+    for values, scalers, *_ in results:
+        for index in range(len(scalers) // len(COLUMNS)):
+            yield (tuple(values[index * width:(index + 1) * width]),
+                   tuple(scalers[index * len(COLUMNS):(index + 1) * len(COLUMNS)]))
+
+
+def interpolate_timestamps(rows):
+    """
+    Give rows without a timestamp one interpolated by their position between
+    the clocks around them, extrapolated before the first and after the last
+    clock, NaN without two clocks.  Only the rows since the last clock are
+    held back.
+    """
+    held = []
+    clock = rate = None
+    for position, (row, scalers) in enumerate(rows):
+        held.append((position, row, scalers))
+        if math.isnan(row[0]):
+            continue
+        if clock is not None:
+            rate = (row[0] - clock[1]) / (position - clock[0])
+            yield from _stamp(held, clock, rate)
+            held = []
+        clock = (position, row[0])
+    yield from _stamp(held, clock, rate)
+
+
+def _stamp(held, clock, rate):
+    for position, row, scalers in held:
+        if math.isnan(row[0]) and rate is not None:
+            row = (clock[1] + rate * (position - clock[0]), *row[1:])
+        yield row, scalers
+
+
+def merge_rows(streams):
+    """
+    Merge (first time, rows) streams in timestamp order, NaN timestamps first.
+
+    A stream is only started once the merge has reached its first time, -inf
+    starts it at once.
+    """
+    heap = [(first_time, sequence, None, None, rows) for sequence, (first_time, rows) in enumerate(streams)]
+    heapq.heapify(heap)
+    while heap:
+        _, sequence, row, scalers, rows = heapq.heappop(heap)
+        if row is not None:
+            yield row, scalers
+        following = next(rows, None)
+        if following is not None:
+            timestamp = following[0][0]
+            heapq.heappush(heap, (-math.inf if math.isnan(timestamp) else timestamp, sequence, *following, rows))
+
+
+def capture_stream(executor, file_name, chunk_size, verify_crc, ahead, stats):
+    """Return (first time, rows) of one capture for merge_rows()."""
+    if is_capture_file(file_name):
+        chunks = CaptureReader(file_name).chunks(chunk_size)
+        first = next(read_records(file_name), None)
+        rows = chunk_rows(chunk_results(executor, file_name, chunks, verify_crc, True, ahead, stats))
+        return (-math.inf if first is None else first.timestamp), rows
+    chunks = split_file(file_name, chunk_size)
+    rows = chunk_rows(chunk_results(executor, file_name, chunks, verify_crc, False, ahead, stats))
+    return -math.inf, interpolate_timestamps(rows)
+
+
+def replay(file_names, output, workers=None, chunk_size=CHUNK_SIZE, verify_crc=True):
+    """Decode the captures in parallel and export the merged rows to output. Returns the statistics."""
+    stats = {"rows": 0, "frames": 0, "crc_failures": 0, "decode_errors": 0}
+    ahead = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor, ColumnarExporter(output) as exporter:
+        streams = [capture_stream(executor, file_name, chunk_size, verify_crc, ahead, stats)
+                   for file_name in file_names]
+        for row, scalers in merge_rows(streams):
+            exporter.add_row(row, scalers)
+        exporter.flush()
+        stats["rows"] = exporter.rows
+    return stats
+
+
+def parse_command_line(argv):
+    options = {"workers": None, "chunk_size": CHUNK_SIZE, "verify_crc": True, "files": []}
+    for argument in argv[1:]:
+        if argument.startswith("--workers="):
+            options["workers"] = int(argument[len("--workers="):])
+        elif argument.startswith("--chunk-size="):
+            options["chunk_size"] = int(float(argument[len("--chunk-size="):]) * 1024 * 1024)
+        elif argument == "--no-crc-check":
+            options["verify_crc"] = False
+        elif argument.startswith("--"):
+            print(f"Unknown argument: {argument}")
+            sys.exit(0)
+        else:
+            options["files"].append(argument)
+    return options
+
+
+if __name__ == "__main__":
+    replay_options = parse_command_line(sys.argv)
+    if len(replay_options["files"]) < 2:
+        print("Usage: python replay.py OUTPUT CAPTURE [CAPTURE ...] [--workers=N] [--chunk-size=MB] [--no-crc-check]")
+        sys.exit(0)
+
+    output, *captures = replay_options["files"]
+    result = replay(captures, output, replay_options["workers"], replay_options["chunk_size"],
+                    replay_options["verify_crc"])
+    print(f"{result['rows']} rows from {result['frames']} frames written to {output}, "
+          f"{result['crc_failures']} CRC failures, {result['decode_errors']} decode errors")
@@ -0,0 +1,130 @@
+# pylint: disable=missing-docstring
+"""
+Fixed capacity byte ring buffer between the serial port and the framer.
+
+The storage is one bytearray allocated up front, so however far decoding
+falls behind the buffer never holds more than capacity bytes.  When a write
+does not fit, the policy decides what is lost:
+
+    DROP_OLDEST   the oldest unread bytes make room for the new ones (default,
+                  keeps the stream current)
+    DROP_NEWEST   the bytes that do not fit are discarded
+    BLOCK         the writer waits for the reader to make room, up to timeout
+                  seconds, and drops the rest as DROP_NEWEST would
+
+Lost bytes are counted in dropped_bytes.  dropped_frames estimates the
+frames they cut into: every flag byte dropped opens or closes a frame, and
+an overflow always damages at least one frame.
+
+Writes and reads may come from different threads.
+"""
+import threading
+
+from framer import FLAG
+
+RING_CAPACITY = 64 * 1024
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+BLOCK = "block"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class RingBuffer:
+    def __init__(self, capacity=RING_CAPACITY, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, use one of {', '.join(POLICIES)}")
+        self.data = bytearray(capacity)
+        self.capacity = capacity
+        self.policy = policy
+        self.head = 0
+        self.size = 0
+        self.dropped_bytes = 0
+        self.dropped_frames = 0
+        self.overflows = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+    def __len__(self):
+        return self.size
+
+    def free(self):
+        return self.capacity - self.size
+
+    def write(self, data, timeout=None) -> int:
+        """Store data, applying the overflow policy. Returns the number of bytes stored."""
+        data = memoryview(data).cast("B")
+        with self.lock:
+            if self.policy == BLOCK:
+                stored = 0
+                while stored < len(data):
+                    if not self.size < self.capacity and not self.not_full.wait_for(
+                            lambda: self.size < self.capacity, timeout):
+                        break
+                    part = data[stored:stored + self.capacity - self.size]
+                    self._put(part)
+                    stored += len(part)
+                    self.not_empty.notify_all()
+                if stored < len(data):
+                    self._count_dropped(data[stored:])
+                return stored
+
+            overflow = len(data) - self.free()
+            if overflow > 0:
+                if self.policy == DROP_NEWEST:
+                    self._count_dropped(data[len(data) - overflow:])
+                    data = data[:len(data) - overflow]
+                else:
+                    if len(data) > self.capacity:
+                        # the new data alone fills the buffer, only its tail is kept
+                        self._count_dropped(data[:len(data) - self.capacity], self._get(self.size))
+                        data = data[len(data) - self.capacity:]
+                    else:
+                        self._count_dropped(self._get(overflow))
+            self._put(data)
+            if data:
+                self.not_empty.notify_all()
+            return len(data)
+
+    def read(self, size=-1, timeout=0) -> bytes:
+        """
+        Return up to size bytes (all if size < 0), oldest first.
+
+        With timeout 0 an empty buffer returns b"" at once, otherwise the
+        read waits up to timeout seconds (forever if None) for data.
+        """
+        with self.lock:
+            if not self.size and timeout != 0:
+                self.not_empty.wait_for(lambda: self.size, timeout)
+            chunk = self._get(self.size if size < 0 else min(size, self.size))
+            if chunk:
+                self.not_full.notify_all()
+            return chunk
+
+    def clear(self):
+        with self.lock:
+            self.head = self.size = 0
+            self.not_full.notify_all()
+
+    def _put(self, data):
+        tail = (self.head + self.size) % self.capacity
+        first = min(len(data), self.capacity - tail)
+        self.data[tail:tail + first] = data[:first]
+        self.data[:len(data) - first] = data[first:]
+        self.size += len(data)
+
+    def _get(self, size) -> bytes:
+        first = min(size, self.capacity - self.head)
+        chunk = bytes(self.data[self.head:self.head + first]) + bytes(self.data[:size - first])
+        self.head = (self.head + size) % self.capacity
+        self.size -= size
+        return chunk
+
+    def _count_dropped(self, *parts):
+        noof_bytes = sum(len(part) for part in parts)
+        if not noof_bytes:
+            return
+        flags = sum(bytes(part).count(FLAG) for part in parts)
+        self.overflows += 1
+        self.dropped_bytes += noof_bytes
+        self.dropped_frames += max(1, (flags + 1) // 2)
@@ -0,0 +1,221 @@
+# pylint: disable=missing-docstring
+"""
+Batched, rotating log files.
+
+A FileSink collects what is written to it (bytes, or str as UTF-8) in
+memory and appends it to the file in one go, with a single os.writev() of
+all the pending pieces, when
+
+- max_batch bytes are pending, or
+- the oldest pending piece is max_delay seconds old (a background thread
+  checks every second), or
+- flush() or close() is called, or the program exits.
+
+The file is only opened at the first flush, so files nobody writes to are
+never created.  With rotate_bytes the file is rotated before it would grow
+past that size, with rotate_daily when the day changes.  A rotated file is
+renamed to NAME.YYYYmmdd-HHMMSS and gzipped on a background thread.
+
+Sinks are shared by file name, get_sink() returns the same sink to every
+module asking for the same file:
+
+    raw_log = get_sink("rawlogfile_binary.txt", rotate_bytes=64 * 1024 * 1024)
+    raw_log.write(data)
+"""
+import atexit
+import datetime
+import gzip
+import os
+import shutil
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import SINK_SECONDS
+
+MAX_BATCH = 64 * 1024
+MAX_DELAY = 5.0
+FLUSH_CHECK_INTERVAL = 1.0
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") and "SC_IOV_MAX" in os.sysconf_names else 1024
+
+_sinks = {}
+_sinks_lock = threading.RLock()
+# every open sink, for the flusher thread and close_all()
+_live_sinks = weakref.WeakSet()
+_flusher = None
+_compressor = None
+
+
+class FileSink:
+    def __init__(self, file_name, max_batch=MAX_BATCH, max_delay=MAX_DELAY, rotate_bytes=None, rotate_daily=False,
+                 compress=True):
+        self.file_name = file_name
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.rotate_bytes = rotate_bytes
+        self.rotate_daily = rotate_daily
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.first_pending = None
+        self.fd = None
+        self.size = 0
+        self.day = None
+        self.bytes_written = 0
+        self.flushes = 0
+        self.rotations = 0
+        self.metric_label = os.path.basename(file_name)
+        with _sinks_lock:
+            _live_sinks.add(self)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if not data:
+            return
+        with self.lock:
+            if self.first_pending is None:
+                self.first_pending = time.monotonic()
+                _start_flusher()
+            self.pending.append(bytes(data))
+            self.pending_bytes += len(data)
+            if self.pending_bytes >= self.max_batch:
+                self._flush()
+
+    def due(self, now):
+        first_pending = self.first_pending
+        return first_pending is not None and now - first_pending >= self.max_delay
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def _flush(self):
+        if not self.pending:
+            return
+        if self.fd is not None and self._must_rotate():
+            self._rotate()
+        if self.fd is None:
+            self._open()
+        pieces = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        self.first_pending = None
+        with SINK_SECONDS.time(self.metric_label):
+            written = _write_pieces(self.fd, pieces)
+        self.size += written
+        self.bytes_written += written
+        self.flushes += 1
+
+    def _open(self):
+        self.fd = os.open(self.file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        stat = os.fstat(self.fd)
+        self.size = stat.st_size
+        self.day = datetime.date.fromtimestamp(stat.st_mtime) if stat.st_size else datetime.date.today()
+
+    def _must_rotate(self):
+        if self.rotate_bytes is not None and self.size and self.size + self.pending_bytes > self.rotate_bytes:
+            return True
+        return self.rotate_daily and datetime.date.today() != self.day
+
+    def _rotate(self):
+        os.close(self.fd)
+        self.fd = None
+        rotated = f"{self.file_name}.{time.strftime('%Y%m%d-%H%M%S')}"
+        suffix = 0
+        while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+            suffix += 1
+            rotated = f"{self.file_name}.{time.strftime('%Y%m%d-%H%M%S')}.{suffix}"
+        os.replace(self.file_name, rotated)
+        self.rotations += 1
+        if self.compress:
+            _compress_in_background(rotated)
+
+
+def _write_pieces(fd, pieces):
+    """Write all pieces, with as few writev() calls as the OS allows. Returns the number of bytes written."""
+    total = 0
+    if not hasattr(os, "writev"):
+        data = b"".join(pieces)
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+        return len(data)
+
+    while pieces:
+        batch = pieces[:IOV_MAX]
+        written = os.writev(fd, batch)
+        total += written
+        # a short write leaves the rest of the batch for the next round
+        for index, piece in enumerate(batch):
+            if written < len(piece):
+                pieces = [piece[written:]] + pieces[index + 1:]
+                break
+            written -= len(piece)
+        else:
+            pieces = pieces[len(batch):]
+    return total
+
+
+def gzip_file(file_name):
+    with open(file_name, "rb") as source, gzip.open(file_name + ".gz", "wb") as target:
+        shutil.copyfileobj(source, target)
+    os.remove(file_name)
+
+
+def _compress_in_background(file_name):
+    global _compressor
+    if _compressor is None:
+        _compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="han-gzip")
+    _compressor.submit(gzip_file, file_name)
+
+
+def _flush_due_sinks():
+    while True:
+        time.sleep(FLUSH_CHECK_INTERVAL)
+        now = time.monotonic()
+        with _sinks_lock:
+            sinks = list(_live_sinks)
+        for sink in sinks:
+            if sink.due(now):
+                sink.flush()
+
+
+def _start_flusher():
+    global _flusher
+    if _flusher is None:
+        with _sinks_lock:
+            if _flusher is None:
+                _flusher = threading.Thread(target=_flush_due_sinks, name="han-sink-flusher", daemon=True)
+                _flusher.start()
+
+
+def get_sink(file_name, **kwargs) -> FileSink:
+    """Return the sink of file_name, created with kwargs (see FileSink) the first time it is asked for."""
+    with _sinks_lock:
+        sink = _sinks.get(file_name)
+        if sink is None:
+            sink = _sinks[file_name] = FileSink(file_name, **kwargs)
+        return sink
+
+
+def close_all():
+    with _sinks_lock:
+        sinks = list(_live_sinks)
+    for sink in sinks:
+        sink.close()
+    if _compressor is not None:
+        _compressor.shutdown(wait=True)
+
+
+atexit.register(close_all)
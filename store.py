@@ -0,0 +1,297 @@
+# pylint: disable=missing-docstring
+"""
+Decoded values in an SQLite database, for single box deployments.
+
+    meters    (id INTEGER PRIMARY KEY, name TEXT UNIQUE)
+    readings  (meter INTEGER, obis INTEGER, ts INTEGER, value REAL,
+               PRIMARY KEY (meter, obis, ts)) WITHOUT ROWID
+
+meter is the id of the meter name (the meter id the meter sends, or the
+port name) in meters, obis the six bytes of the OBIS code packed into an
+int (obis_registry.pack_obis), ts the time in milliseconds since the epoch
+and value the scaled value in W, var, Wh, varh, A or V.  Without a rowid
+the table is stored as a B-tree on (meter, obis, ts) with the value in its
+leaves, so the primary key is a covering index: a time range of one meter
+and code is one index range scan, whatever the size of the database.
+
+The database runs in WAL mode, so queries do not block the writer.  Rows
+are buffered and inserted with one executemany() per batch_size rows, or
+max_delay seconds after the first buffered row, or at flush() and close().
+Only numbers are stored, the clock and the text values of a list are left
+out, and so are lists with neither a clock nor a receive time: stamping them
+with the time they are stored at would put a replayed capture at one
+instant, where the primary key keeps one row per millisecond.
+
+    with SqliteStore("han.db") as store:
+        store.add(readings, receive_time)
+        rows = store.query("7359992907381295", "1.0.1.7.0.255", start, end, every=900)
+        energy = store.energy("7359992907381295", start, end)
+
+    python store.py DB [--load=CAPTURE] [--meter=ID] [--obis=CODE] [--start=ISO-TIME] [--end=ISO-TIME]
+                       [--every=SECONDS] [--energy]
+"""
+import datetime
+import sqlite3
+import sys
+import threading
+import time
+
+from obis_registry import REGISTRY, pack_obis
+
+BATCH_SIZE = 1000
+MAX_DELAY = 5.0
+# registry name of the active energy import register
+ACTIVE_ENERGY_IMPORT = "A+cumul"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meters (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS readings (
+    meter INTEGER NOT NULL,
+    obis INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    value REAL,
+    PRIMARY KEY (meter, obis, ts)
+) WITHOUT ROWID;
+"""
+
+
+def to_ms(timestamp):
+    return int(round(timestamp * 1000))
+
+
+def meter_name(value):
+    """The meter id of a list as text, it comes as a visible-string or an octet-string."""
+    return value.decode("ascii", "replace") if isinstance(value, bytes) else str(value)
+
+
+class SqliteStore:
+    """
+    Store the numeric readings of decoded lists, see the module docstring.
+
+    add() takes the readings and the time they were received, like
+    export.ColumnarExporter.add(), so the store can be used where an
+    exporter is.  The connection may be used from any thread, one at a time.
+    """
+
+    def __init__(self, path, batch_size=BATCH_SIZE, max_delay=MAX_DELAY):
+        self.path = path
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.meter_ids = dict((name, meter) for meter, name in self.connection.execute("SELECT id, name FROM meters"))
+        self.pending = []
+        self.first_pending = None
+        self.last_meter = None
+        self.rows = 0
+
+    def meter_id(self, name):
+        """Return the id of the meter name, adding it if it is new."""
+        name = str(name)
+        meter = self.meter_ids.get(name)
+        if meter is None:
+            with self.connection:
+                self.connection.execute("INSERT OR IGNORE INTO meters (name) VALUES (?)", (name,))
+            meter = self.meter_ids[name] = self.connection.execute(
+                "SELECT id FROM meters WHERE name = ?", (name,)).fetchone()[0]
+        return meter
+
+    def add(self, readings, timestamp=None, meter=None):
+        """
+        Buffer the numeric readings of a list.
+
+        The time is the clock of the list, else timestamp.  A list with
+        neither is skipped.  Without meter the meter id in the list is used,
+        or the last one seen (List 1 does not carry it).
+        """
+        clock = None
+        for reading in readings:
+            if reading.obis in REGISTRY.meter_id_codes and meter is None:
+                self.last_meter = meter_name(reading.value)
+            if clock is None and reading.timestamp is not None:
+                clock = reading.timestamp.timestamp()
+        if clock is None and timestamp is None:
+            return
+        if meter is None:
+            meter = self.last_meter if self.last_meter is not None else "unknown"
+        ts = to_ms(clock if clock is not None else timestamp)
+
+        with self.lock:
+            meter = self.meter_id(meter)
+            for reading in readings:
+                value = reading.scaled_value
+                if (reading.obis is None or not isinstance(value, (int, float)) or isinstance(value, bool)
+                        or reading.obis in REGISTRY.clock_codes):
+                    continue
+                self.pending.append((meter, pack_obis(reading.obis), ts, value))
+            if self.first_pending is None:
+                self.first_pending = time.monotonic()
+            if len(self.pending) >= self.batch_size or time.monotonic() - self.first_pending >= self.max_delay:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.first_pending = None
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO readings VALUES (?, ?, ?, ?)", self.pending)
+        self.rows += len(self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def meters(self):
+        """Return the names of all meters."""
+        return [name for (name,) in self.connection.execute("SELECT name FROM meters ORDER BY name")]
+
+    def codes(self, meter):
+        """Return the OBIS codes stored for the meter, as packed ints."""
+        meter = self.meter_ids.get(str(meter))
+        if meter is None:
+            return []
+        return [code for (code,) in self.connection.execute(
+            "SELECT DISTINCT obis FROM readings WHERE meter = ?", (meter,))]
+
+    def _range(self, meter, obis, start, end):
+        """Return the WHERE clause and its arguments for one code of the meter in a time range, None for no meter."""
+        meter = self.meter_ids.get(str(meter))
+        if meter is None:
+            return None
+        return ("WHERE meter = ? AND obis = ? AND ts >= ? AND ts < ?",
+                [meter, pack_obis(obis), to_ms(start) if start is not None else -(1 << 62),
+                 to_ms(end) if end is not None else 1 << 62])
+
+    def query(self, meter, obis, start=None, end=None, every=None):
+        """
+        Return the values of one code of the meter with start <= time < end (epoch seconds, open if None).
+
+        Without every the rows are (time, value), with every (seconds) the
+        values are downsampled to (start of the interval, count, mean, min, max)
+        per interval.
+        """
+        selection = self._range(meter, obis, start, end)
+        if selection is None:
+            return []
+        where, arguments = selection
+        if every is None:
+            return [(ts / 1000, value) for ts, value in self.connection.execute(
+                f"SELECT ts, value FROM readings {where} ORDER BY ts", arguments)]
+        interval = to_ms(every)
+        return [(bucket * interval / 1000, count, mean, low, high) for bucket, count, mean, low, high in
+                self.connection.execute(
+                    f"SELECT ts / ? AS bucket, COUNT(value), AVG(value), MIN(value), MAX(value) FROM readings {where} "
+                    "GROUP BY bucket ORDER BY bucket", [interval] + arguments)]
+
+    def energy(self, meter, start=None, end=None, obis=None):
+        """
+        Return (energy, first time, last time): the increase of a cumulative
+        register over its readings with start <= time < end, None if there are
+        less than two.  Without obis it is the active energy import register
+        the meter sends, whatever code its vendor uses for it.
+
+        The increase is summed from one reading to the next.  A reading below
+        the one before it is taken as a meter reset and that step is left
+        out, the register counts on from the new value.  The store only has
+        the scaled values, so a wrap of the 32 bit register counts as a reset
+        too: with the scalers the meters use that is at tens of GWh.
+        """
+        if obis is None:
+            known = {pack_obis(code) for code in REGISTRY.codes_named(ACTIVE_ENERGY_IMPORT)}
+            registers = set(self.codes(meter)) & known
+            if not registers:
+                return None
+            obis = registers.pop()
+        selection = self._range(meter, obis, start, end)
+        if selection is None:
+            return None
+        where, arguments = selection
+        noof_readings, energy, first, last = self.connection.execute(
+            "SELECT COUNT(*), TOTAL(MAX(step, 0)), MIN(ts), MAX(ts) FROM ("
+            f"SELECT ts, value - LAG(value) OVER (ORDER BY ts) AS step FROM readings {where})",
+            arguments).fetchone()
+        if noof_readings < 2:
+            return None
+        return energy, first / 1000, last / 1000
+
+
+def load_capture(store, file_name):
+    """Decode a capture file (capture.py) into the store, one meter per port unless the lists carry meter ids."""
+    # pylint: disable=import-outside-toplevel
+    from capture import CaptureReader
+    from cosem import CosemDecoder, DecodeError
+
+    decoder = CosemDecoder()
+    last_meter = {}
+    for record in CaptureReader(file_name):
+        try:
+            readings = decoder.decode(record.frame)
+        except DecodeError:
+            continue
+        for reading in readings:
+            if reading.obis in REGISTRY.meter_id_codes:
+                last_meter[record.port_id] = meter_name(reading.value)
+        store.add(readings, record.timestamp, last_meter.get(record.port_id, f"port-{record.port_id}"))
+    store.flush()
+
+
+def parse_time(text):
+    return datetime.datetime.fromisoformat(text).timestamp() if text else None
+
+
+if __name__ == "__main__":
+    options = {"load": None, "meter": None, "obis": "1.0.1.7.0.255", "start": None, "end": None, "every": None,
+               "energy": None, "file": None}
+    for argument in sys.argv[1:]:
+        if argument == "--energy":
+            options["energy"] = True
+        elif argument.startswith("--") and "=" in argument:
+            key, value = argument[2:].split("=", 1)
+            if key not in options:
+                print(f"Unknown argument: {argument}")
+                sys.exit(0)
+            options[key] = value
+        else:
+            options["file"] = argument
+    if options["file"] is None:
+        print("Usage: python store.py DB [--load=CAPTURE] [--meter=ID] [--obis=CODE] [--start=ISO-TIME] "
+              "[--end=ISO-TIME] [--every=SECONDS] [--energy]")
+        sys.exit(0)
+
+    with SqliteStore(options["file"]) as db:
+        if options["load"] is not None:
+            load_capture(db, options["load"])
+            print(f"{db.rows} values loaded from {options['load']}")
+        if options["meter"] is None:
+            for name in db.meters():
+                print(name)
+            sys.exit(0)
+
+        query_start = time.perf_counter()
+        first_time, last_time = parse_time(options["start"]), parse_time(options["end"])
+        if options["energy"]:
+            result = db.energy(options["meter"], first_time, last_time)
+            if result is None:
+                print("Less than two readings of the register in the range")
+            else:
+                print(f"{result[0]} Wh from {datetime.datetime.fromtimestamp(result[1])} "
+                      f"to {datetime.datetime.fromtimestamp(result[2])}")
+        else:
+            every = float(options["every"]) if options["every"] is not None else None
+            for row in db.query(options["meter"], options["obis"], first_time, last_time, every):
+                print(datetime.datetime.fromtimestamp(row[0]), *row[1:])
+        print(f"Query took {(time.perf_counter() - query_start) * 1000:.1f} ms", file=sys.stderr)